@@ -0,0 +1,590 @@
+"""
+Asyncio режим телеграм бота для получения отелей по запросу с сайта hotels.com.
+Те же команды и шаги, что и в main.py, но на AsyncTeleBot, aiohttp и asyncpg:
+один процесс обслуживает множество одновременных поисков без блокировки потоков.
+Запуск: python async_main.py
+"""
+from botrequests import startup  # первым: от его импорта считается время запуска
+import asyncio
+import datetime
+import json
+import traceback
+
+import aiohttp
+import requests
+from decouple import config
+from loguru import logger
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+
+from botrequests import async_api_requests, async_postgres_database, cards, destinations, metrics, \
+    sessions, calendar_keyboard, api_scheduler
+from botrequests.async_delivery import AsyncDeliveryEngine
+
+logger.add('debug.log', format='{time} {level} {message}',
+           level='DEBUG', rotation='10 MB', compression='zip'
+           )
+
+bot = AsyncTeleBot(config('Token'))
+delivery_engine = AsyncDeliveryEngine(bot)
+
+COMMANDS_TEXT = 'Привет, на данный момент я работаю исключительно с командами\n' \
+                r'/lowprice''\n'r'/highprice''\n'r'/bestdeal''\n'r'/history'
+
+# Следующий шаг диалога для каждого чата: chat_id -> (корутина, kwargs)
+_next_steps = {}
+
+# Фоновые задачи (предзагрузка фотографий, запись истории): ссылки держатся до завершения
+_background_tasks = set()
+
+
+def run_in_background(coroutine, name: str) -> asyncio.Task:
+    """
+    Запуск корутины фоновой задачей, результат которой не ждут. Ссылка на задачу
+    хранится до ее завершения, исключение записывается в logger.
+    :param coroutine: Корутина.
+    :param name: Название для лога.
+    :return: Задача.
+    """
+    task = asyncio.ensure_future(coroutine)
+    _background_tasks.add(task)
+
+    def done(finished: asyncio.Task) -> None:
+        _background_tasks.discard(finished)
+        if not finished.cancelled() and finished.exception() is not None:
+            logger.error('{name} - {ex!r}'.format(name=name, ex=finished.exception()))
+
+    task.add_done_callback(done)
+    return task
+
+
+def register_next_step(chat_id: int, handler, **kwargs) -> None:
+    """
+    Аналог bot.register_next_step_handler_by_chat_id для asyncio режима:
+    следующее текстовое сообщение чата будет передано в handler.
+    :param chat_id: ID чата
+    :param handler: Корутина-обработчик handler(message, **kwargs)
+    :return:
+    """
+    _next_steps[chat_id] = (handler, kwargs)
+
+
+@bot.message_handler(func=lambda message: message.chat.id in _next_steps)
+async def next_step(message: types.Message) -> None:
+    """
+    Обработчик сообщений чатов, у которых зарегистрирован следующий шаг.
+    Зарегистрирован первым, поэтому имеет приоритет над остальными обработчиками.
+    :param message: Сообщение от пользователя.
+    :return:
+    """
+    handler, kwargs = _next_steps.pop(message.chat.id)
+    try:
+        await handler(message, **kwargs)
+    except Exception:
+        logger.error(traceback.format_exc())
+        await bot.send_message(message.chat.id, 'Что-то пошло не так, начните заново с команды\n'
+                                                r'/lowprice''\n'r'/highprice''\n'r'/bestdeal')
+
+
+@logger.catch
+@bot.message_handler(commands=['start'])
+@metrics.HANDLERS.timed
+async def start_message(message: types.Message) -> None:
+    """
+    Функция обработчик команды start, добавляет пользователя в БД,
+    отправляет приветственное сообщение.
+    :param message:
+    :return:
+    """
+    await async_postgres_database.add_user(
+        message.from_user.id, str(message.from_user.first_name),
+        str(message.from_user.last_name), str(message.from_user.username)
+    )
+    await bot.send_message(message.chat.id, COMMANDS_TEXT)
+
+
+@logger.catch
+@bot.message_handler(commands=['lowprice', 'highprice', 'bestdeal'])
+@metrics.HANDLERS.timed
+async def search_command(message: types.Message) -> None:
+    """
+    Функция обработчик команд lowprice, highprice и bestdeal, отправляет сообщение
+    пользователю и переходит к следующему шагу.
+    :param message: Команда от пользователя.
+    :return:
+    """
+    command = message.text.lstrip('/')[0]
+    await bot.send_message(message.chat.id, 'Введите город в котором необходимо найти отели.')
+    register_next_step(message.chat.id, get_city, command=command)
+
+
+@logger.catch
+@bot.message_handler(commands=['history'])
+@metrics.HANDLERS.timed
+async def history(message: types.Message) -> None:
+    """
+    Функция обработчик для команды history, отправляет первую страницу истории.
+    :param message: Сообщение команда "history"
+    :return:
+    """
+    await send_history_page(message.from_user.id)
+
+
+@logger.catch
+@bot.callback_query_handler(func=lambda c: c.data.startswith('n'))
+@metrics.HANDLERS.timed
+async def history_next_page(callback_query: types.CallbackQuery) -> None:
+    """
+    Функция обработчик inline кнопки следующей страницы истории.
+    :param callback_query: запрос обратного вызова с ключом последней показанной записи
+    """
+    await bot.edit_message_reply_markup(callback_query.message.chat.id,
+                                        callback_query.message.message_id)
+    await send_history_page(callback_query.from_user.id,
+                            cards.parse_history_cursor(callback_query.data))
+
+
+async def send_history_page(user_id: int, before: tuple = None) -> None:
+    """
+    Функция отправки страницы истории с кнопкой "Показать еще" при наличии следующей.
+    :param user_id: ID пользователя
+    :param before: Ключ (datetime, seq) последней показанной записи
+    :return:
+    """
+    page_size = config('history_page_size', default=5, cast=int)
+    rows = await async_postgres_database.get_history(user_id, before, page_size)
+    if not rows:
+        await bot.send_message(user_id, 'История пуста.' if before is None else 'Больше записей нет.')
+        return
+    for row in rows[:page_size]:
+        text_message, keyboard = cards.history_message(
+            row['command'], row['datetime'], json.loads(row['hotels'] or '[]'))
+        await bot.send_message(user_id, text_message, reply_markup=keyboard)
+    if len(rows) > page_size:
+        keyboard = types.InlineKeyboardMarkup()
+        last = rows[page_size - 1]
+        keyboard.add(types.InlineKeyboardButton(
+            text='Показать еще', callback_data=cards.history_cursor(last['datetime'], last['seq'])))
+        await bot.send_message(user_id, 'Показаны последние записи.', reply_markup=keyboard)
+    logger.info('{id} - async history - ok'.format(id=user_id))
+
+
+@logger.catch
+@bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
+async def get_text_messages(message: types.Message) -> None:
+    """
+    Функция обработчик любого текстового сообщения, отправляет сообщение.
+    :param message: Сообщение от пользователя.
+    :return:
+    """
+    await bot.send_message(message.chat.id, COMMANDS_TEXT)
+
+
+@logger.catch
+@metrics.HANDLERS.timed
+async def get_city(message: types.Message, command: str) -> None:
+    """
+    Функция отправки inline кнопок уточняющих у пользователя необходимое ему местоположение.
+    :param message: Сообщение от пользователя должно содержать город поиска.
+    :param command: Сокращенное обозначение команды от пользователя.
+    :return:
+    """
+    suggestions = None
+    if message.text:
+        await bot.send_message(message.chat.id, "Работаю.")
+        suggestions = await async_api_requests.get_city_suggestions(message.text,
+                                                                    message.from_user.id)
+    if not suggestions or not suggestions['captions']:
+        await bot.send_message(
+            message.from_user.id, 'Не нашел такой город.\n'
+                                  'Давайте попробуем еще раз.\n'
+                                  'Введите город в котором необходимо найти отели.')
+        register_next_step(message.chat.id, get_city, command=command)
+        return
+
+    keyboard = types.InlineKeyboardMarkup()
+    for item, value in dict(suggestions['captions']).items():
+        keyboard.add(types.InlineKeyboardButton(
+            text=str(item), callback_data='{} {}'.format(command, value)))
+    text_message = 'Найдено {} совпадений выберите более подходящий вариант.'.format(
+        suggestions['moresuggestions'])
+    await bot.send_message(message.chat.id, text_message, reply_markup=keyboard)
+
+
+@logger.catch
+@bot.inline_handler(func=lambda inline_query: True)
+@metrics.HANDLERS.timed
+async def inline_destinations(inline_query: types.InlineQuery) -> None:
+    """
+    Функция обработчик inline запроса, как main.inline_destinations.
+    :param inline_query: Inline запрос пользователя.
+    :return:
+    """
+    matches = destinations.index.search(inline_query.query, limit=20)
+    captions = [(entry['caption'], entry['id']) for _, entry in matches]
+    await bot.answer_inline_query(inline_query.id, cards.inline_destinations(captions),
+                                  cache_time=config('inline_cache_time', default=300, cast=int))
+
+
+@logger.catch
+@bot.callback_query_handler(func=lambda c: c.data.startswith('q'))
+@metrics.HANDLERS.timed
+async def get_photo_answer(callback_query: types.CallbackQuery) -> None:
+    """
+    Функция обработчик inline кнопки получения фотографии.
+    :param callback_query: запрос обратного вызова с сообщением
+    """
+    await bot.send_message(callback_query.from_user.id, 'Сколько фотографий требуется? (Max=10)')
+    register_next_step(callback_query.from_user.id, get_photo_number,
+                       hotel_id=callback_query.data[1:])
+
+
+@logger.catch
+@bot.callback_query_handler(func=lambda c: c.data[:1] in sessions.COMMANDS and c.data[1:2] == ' ')
+@metrics.HANDLERS.timed
+async def get_city_callback(callback_query: types.CallbackQuery) -> None:
+    """
+    Функция обработчик города следования, начинает сессию поиска и переходит к следующему шагу:
+    для bestdeal к цене, для lowprice и highprice к дате заезда.
+    :param callback_query: запрос обратного вызова с сообщением
+    """
+    user_id = callback_query.from_user.id
+    sessions.start_session(user_id, callback_query.data)
+    if callback_query.data.startswith('b'):
+        await bot.send_message(user_id, 'Введите минимальную стоимость в USD за ночь')
+        register_next_step(user_id, get_price_min)
+    else:
+        await get_check_in(user_id)
+
+
+async def get_check_in(chat_id: int) -> None:
+    """
+    Функция вызова даты въезда
+    :param chat_id: ID чата
+    """
+    await bot.send_message(chat_id, "Выберите дату заезда")
+    calendar, text = calendar_keyboard.build(1, datetime.date.today())
+    await bot.send_message(chat_id, text, reply_markup=calendar)
+
+
+@logger.catch
+@bot.callback_query_handler(func=calendar_keyboard.callback_filter(1))
+@metrics.HANDLERS.timed
+async def calendar_1(callback_query: types.CallbackQuery) -> None:
+    """
+    Функция обработчик календаря даты заезда.
+    :param callback_query: запрос обратного вызова с сообщением
+    """
+    chat_id = callback_query.message.chat.id
+    # навигация по календарю только читает сессию, без записи диалога в БД
+    session = sessions.peek_session(chat_id)
+    if session is None:
+        await session_expired(chat_id)
+        return
+    result, key, text = calendar_keyboard.process(1, datetime.date.today(), callback_query.data)
+    if not result and key:
+        await bot.edit_message_text(text, chat_id,
+                                    callback_query.message.message_id, reply_markup=key)
+    elif result:
+        await bot.edit_message_text(f"Вы выбрали {result}", chat_id,
+                                    callback_query.message.message_id)
+        sessions.update_session(chat_id, check_in=result)
+        await get_check_out(chat_id, result)
+
+
+async def get_check_out(chat_id: int, check_in: datetime.date) -> None:
+    """
+    Функция вызова даты выезда
+    :param chat_id: ID чата
+    :param check_in: Дата заезда
+    """
+    await bot.send_message(chat_id, "Выберите дату выезда")
+    calendar, text = calendar_keyboard.build(2, check_in + datetime.timedelta(days=1))
+    await bot.send_message(chat_id, text, reply_markup=calendar)
+
+
+@logger.catch
+@bot.callback_query_handler(func=calendar_keyboard.callback_filter(2))
+@metrics.HANDLERS.timed
+async def calendar_2(callback_query: types.CallbackQuery) -> None:
+    """
+    Функция обработчик календаря даты выезда.
+    :param callback_query: запрос обратного вызова с сообщением
+    """
+    chat_id = callback_query.message.chat.id
+    session = sessions.peek_session(chat_id)
+    if session is None or session.check_in is None:
+        await session_expired(chat_id)
+        return
+    result, key, text = calendar_keyboard.process(
+        2, session.check_in + datetime.timedelta(days=1), callback_query.data)
+    if not result and key:
+        await bot.edit_message_text(text, chat_id,
+                                    callback_query.message.message_id, reply_markup=key)
+    elif result:
+        await bot.edit_message_text(f"Вы выбрали {result}", chat_id,
+                                    callback_query.message.message_id)
+        sessions.update_session(chat_id, check_out=result)
+        await bot.send_message(
+            chat_id, 'Введите кол-во отелей, которые необходимо вывести в результате(max=10)')
+        register_next_step(chat_id, results_to_user, user_id=chat_id)
+
+
+async def read_number(message: types.Message, error_text: str, retry_handler,
+                      minimum: str = None, **retry_kwargs) -> [str, None]:
+    """
+    Общая проверка числа, введенного на шаге bestdeal. При ошибке отправляет
+    error_text и повторяет текущий шаг.
+    :param message: Сообщение от пользователя.
+    :param error_text: Текст сообщения при ошибке.
+    :param retry_handler: Корутина текущего шага для повтора.
+    :param minimum: Значение, меньше которого вводить нельзя.
+    :return: Введенное число строкой или None при ошибке.
+    """
+    try:
+        if minimum is not None and float(message.text) < float(minimum):
+            raise ValueError
+        float(message.text)
+    except ValueError:
+        await bot.send_message(message.from_user.id, error_text)
+        register_next_step(message.from_user.id, retry_handler, **retry_kwargs)
+        return None
+    return message.text
+
+
+@logger.catch
+@metrics.HANDLERS.timed
+async def get_price_min(message: types.Message) -> None:
+    """
+    Функция для получения минимальной стоимости команды bestdeal.
+    :param message: Сообщение от пользователя.
+    :return:
+    """
+    price_min = await read_number(message, 'Минимальная цена должна быть числом.\n'
+                                           'Давайте попробуем еще раз.\n'
+                                           'Введите минимальную стоимость в USD за ночь.',
+                                  get_price_min)
+    if price_min is None:
+        return
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        await session_expired(message.from_user.id)
+        return
+    sessions.update_session(message.from_user.id, price_min=int(float(price_min)))
+    await bot.send_message(message.from_user.id, 'Введите максимальную стоимость в USD за ночь.')
+    register_next_step(message.from_user.id, get_price_max, price_min=price_min)
+
+
+@logger.catch
+@metrics.HANDLERS.timed
+async def get_price_max(message: types.Message, price_min: str) -> None:
+    """
+    Функция для получения максимальной стоимости команды bestdeal.
+    :param message: Сообщение от пользователя.
+    :param price_min: Минимальная цена, которую пользователь ввел на прошлом шагу.
+    :return:
+    """
+    price_max = await read_number(message, 'Максимальная цена должна быть числом '
+                                           'и не меньше минимальной.\n'
+                                           'Давайте попробуем еще раз.\n'
+                                           'Введите максимальную стоимость в USD за ночь.',
+                                  get_price_max, minimum=price_min, price_min=price_min)
+    if price_max is None:
+        return
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        await session_expired(message.from_user.id)
+        return
+    sessions.update_session(message.from_user.id, price_max=int(float(price_max)))
+    await bot.send_message(message.from_user.id, 'Введите минимальное удаление от центра. В километрах.')
+    register_next_step(message.from_user.id, get_distance_min)
+
+
+@logger.catch
+@metrics.HANDLERS.timed
+async def get_distance_min(message: types.Message) -> None:
+    """
+    Функция для получения минимальной дистанции команды bestdeal.
+    :param message: Сообщение от пользователя.
+    :return:
+    """
+    distance_min = await read_number(message, 'Минимальное удаление от центра должно быть числом.\n'
+                                              'А число с точкой написано через "."\n'
+                                              'Давайте попробуем еще раз.\n'
+                                              'Введите минимальное удаление от центра. В километрах.',
+                                     get_distance_min)
+    if distance_min is None:
+        return
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        await session_expired(message.from_user.id)
+        return
+    sessions.update_session(message.from_user.id, distance_min=float(distance_min))
+    await bot.send_message(message.from_user.id, 'Введите максимальное удаление от центра. В километрах.')
+    register_next_step(message.from_user.id, get_distance_max, distance_min=distance_min)
+
+
+@logger.catch
+@metrics.HANDLERS.timed
+async def get_distance_max(message: types.Message, distance_min: str) -> None:
+    """
+    Функция для получения максимальной дистанции команды bestdeal.
+    :param message: Сообщение от пользователя.
+    :param distance_min: Минимальная дистанция, которую пользователь ввел на прошлом шагу.
+    :return:
+    """
+    distance_max = await read_number(message, 'Максимальная дистанция должна быть числом '
+                                              'и не меньше минимальной.\n'
+                                              'А число с точкой написано через "."\n'
+                                              'Давайте попробуем еще раз.\n'
+                                              'Введите максимальное удаление от центра. В километрах.',
+                                     get_distance_max, minimum=distance_min, distance_min=distance_min)
+    if distance_max is None:
+        return
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        await session_expired(message.from_user.id)
+        return
+    sessions.update_session(message.from_user.id, distance_max=float(distance_max))
+    await get_check_in(message.from_user.id)
+
+
+@logger.catch
+@metrics.HANDLERS.timed
+async def results_to_user(message: types.Message, user_id: int) -> None:
+    """
+    Функция отправки пользователю найденного результата.
+    Отели приходят асинхронным генератором по мере поиска, карточки отправляются сразу,
+    а сообщение о запросе обновляется с количеством найденных отелей.
+    :param message: Количество результатов для показа пользователя
+    :param user_id: ID пользователя
+    :return:
+    """
+    session = sessions.get_session(user_id)
+    if session is None:
+        await session_expired(user_id)
+        return
+    try:
+        hotels_number = min(int(message.text), 10)
+        if hotels_number < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        await bot.send_message(user_id, 'Количество отелей должно быть целым числом от 1 до 10.\n'
+                                        'Давайте попробуем еще раз.')
+        register_next_step(user_id, results_to_user, user_id=user_id)
+        return
+
+    found = []
+    try:
+        status = await bot.send_message(user_id, 'Делаю запрос. Это может занять несколько минут.')
+        query = session.query()
+        await async_postgres_database.save_search(user_id, query)
+        sortorder = session.command
+
+        if sortorder == "DISTANCE_FROM_LANDMARK":
+            hotels = async_api_requests.iter_best_deal(hotels_number, query)
+        else:
+            hotels = async_api_requests.iter_properties_list(hotels_number, query)
+
+        async def hotel_cards():
+            async for result in hotels:
+                found.append(result)
+                run_in_background(async_api_requests.get_photo(result.id), 'async prefetch photo')
+                yield cards.hotel_card(result)
+
+        async def progress(sent: int) -> None:
+            await update_status(status, 'Ищу отели. Найдено: {sent} из {total}...'.format(
+                sent=sent, total=hotels_number))
+
+        await delivery_engine.deliver(user_id, hotel_cards(), on_sent=progress)
+        await update_status(status, 'Поиск завершен. Найдено отелей: {}.'.format(len(found)))
+    except api_scheduler.QuotaExceeded:
+        logger.warning('{id} - async results_to_user - api quota exceeded'.format(id=user_id))
+        await bot.send_message(user_id, "Лимит запросов к сервису отелей исчерпан. Попробуйте позже.")
+        return
+    except (asyncio.TimeoutError, requests.exceptions.Timeout) as ex:
+        logger.warning('{id} - async results_to_user - {ex!r}'.format(id=user_id, ex=ex))
+        await bot.send_message(user_id, "Превышено максимальное ожидание от сервера. Попробуйте чуть позже")
+        return
+    except (aiohttp.ClientError, requests.exceptions.RequestException) as ex:
+        logger.warning('{id} - async results_to_user - {ex!r}'.format(id=user_id, ex=ex))
+        await bot.send_message(user_id, "Сервер отелей не отвечает. Попробуйте чуть позже")
+        return
+    if not found:
+        await bot.send_message(user_id, "Похоже я ничего не нашел по вашему запросу.")
+        return
+
+    # история пишется в фоне и не задерживает ответ пользователю
+    run_in_background(async_postgres_database.add_history(
+        user_id, sortorder, datetime.datetime.now(),
+        json.dumps([hotel.as_dict() for hotel in found])), 'async add_history')
+    sessions.end_session(user_id)
+    await bot.send_message(user_id, "Это всё что я смог найти для Вас.")
+    logger.info('{id} - async results_to_user - ok'.format(id=user_id))
+
+
+async def update_status(status: types.Message, text: str) -> None:
+    """
+    Асинхронный аналог main.update_status: ошибка редактирования сообщения
+    о ходе поиска не прерывает поиск.
+    :param status: Сообщение, которое редактируется.
+    :param text: Новый текст.
+    :return:
+    """
+    try:
+        await delivery_engine.call(status.chat.id, bot.edit_message_text, text,
+                                   status.chat.id, status.message_id)
+    except asyncio_helper.ApiTelegramException as ex:
+        logger.warning('{id} - update_status - {ex}'.format(id=status.chat.id, ex=ex))
+
+
+@logger.catch
+@metrics.HANDLERS.timed
+async def get_photo_number(message: types.Message, hotel_id: str) -> None:
+    """
+    Функция для отправки фотографий по определенному отелю пользователю.
+    :param message: Количество фотографий
+    :param hotel_id: ID отеля
+    :return:
+    """
+    json_data = await async_api_requests.get_photo(hotel_id)
+    await delivery_engine.send_photos(message.from_user.id,
+                                      cards.photo_urls(json_data, min(int(message.text), 10)))
+    await bot.send_message(message.from_user.id, 'Hotel Id: {hotel_id}'.format(hotel_id=hotel_id),
+                           reply_markup=cards.more_photos_keyboard(hotel_id))
+
+
+async def session_expired(user_id: int) -> None:
+    """
+    Функция для отправки сообщения, если сессия поиска устарела или не начиналась.
+    :param user_id: ID пользователя.
+    :return:
+    """
+    await bot.send_message(user_id, 'Поиск устарел, начните заново с команды\n'
+                                    r'/lowprice''\n'r'/highprice''\n'r'/bestdeal')
+
+
+async def run() -> None:
+    """
+    Запуск бота в asyncio режиме с закрытием сессий и пула БД при остановке.
+    :return:
+    """
+    startup.timer.mark('imports')
+    logger.info("Start async_main.py")
+    await async_postgres_database.migrate()
+    startup.timer.mark('migrations')
+    metrics.start_server()
+    startup.timer.mark('metrics')
+    startup.timer.report('ready')
+    startup.timer.watch(bot)
+    try:
+        await bot.polling(non_stop=True)
+    finally:
+        await delivery_engine.close()
+        await async_api_requests.close_session()
+        await async_postgres_database.close_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
@@ -0,0 +1,289 @@
+"""
+Офлайн бенчмарки горячих путей бота.
+Внешние сервисы заменяются локальными (benchmarks/stand_ins.py): hotels4 api отвечает
+записанными json, Telegram Bot API - успешными сообщениями. Бенчмарки БД выполняются
+только с флагом --db на отдельной локальной БД Postgres, параметры которой задаются
+переменными окружения database, user, password, host, port (они важнее значений из .env).
+
+Запуск из корня репозитория:
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --db --output bench.json --compare previous.json
+
+Результат пишется в json: окружение, коммит и для каждого бенчмарка количество
+повторов, среднее, медиана, p95, минимум и максимум в миллисекундах.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.stand_ins import StandInServer, load_fixture
+
+BENCH_USER_ID = 2000000000
+BENCH_CHAT_ID = 1
+
+
+def configure(stand_in: StandInServer) -> None:
+    """
+    Настройка бота на заменители до импорта модулей бота: все значения
+    читаются из окружения при импорте, а окружение важнее .env.
+    :param stand_in: Запущенный сервер заменителей.
+    """
+    os.environ['Token'] = '123456:BENCH'
+    os.environ['rapid_api_key'] = 'bench'
+    os.environ['api_base_url'] = stand_in.url
+    os.environ['api_retries'] = '0'
+    os.environ['destinations_index_path'] = ''
+    os.environ['api_usage_path'] = ''
+    os.environ['file_ids_path'] = ''
+    for name in ('api_rate_limit', 'api_burst', 'telegram_global_rate', 'telegram_chat_rate',
+                 'telegram_chat_burst'):
+        os.environ[name] = '1000000'
+
+
+def measure(func, iterations: int, warmup: int, setup=None) -> dict:
+    """
+    Замер функции: несколько прогревочных вызовов, затем iterations замеров.
+    :param func: Функция без аргументов.
+    :param iterations: Количество замеров.
+    :param warmup: Количество прогревочных вызовов.
+    :param setup: Функция, вызываемая перед каждым вызовом вне замера.
+    :return: Статистика в миллисекундах.
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+    timings = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'mean_ms': round(statistics.mean(timings), 4),
+        'median_ms': round(statistics.median(timings), 4),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+        'min_ms': round(timings[0], 4),
+        'max_ms': round(timings[-1], 4),
+        'stdev_ms': round(statistics.stdev(timings), 4) if len(timings) > 1 else 0.0,
+    }
+
+
+def bench_api(iterations: int, warmup: int) -> dict:
+    """
+    Бенчмарки подсказок городов (get_city), фильтрации bestdeal и карточек отелей.
+    """
+    import telebot
+    import main
+    from botrequests import api_requests, bestdeal, cards, destinations, fast_json, \
+        hotels as hotels_model
+
+    message = telebot.types.Message.de_json({
+        'message_id': 1, 'date': 0, 'text': 'paris',
+        'chat': {'id': BENCH_CHAT_ID, 'type': 'private'},
+        'from': {'id': BENCH_CHAT_ID, 'is_bot': False, 'first_name': 'bench'}
+    })
+    locations = load_fixture('locations_v2_search')
+    raw_hotels = load_fixture('properties_list')['data']['body']['searchResults']['results']
+    hotels = hotels_model.parse_results(raw_hotels)
+    properties_content = json.dumps(load_fixture('properties_list')).encode('utf-8')
+    check_in = datetime.date.today() + datetime.timedelta(days=30)
+    query = [504261, check_in, check_in + datetime.timedelta(days=3), 'DISTANCE_FROM_LANDMARK',
+             50, 500, 3.0, 12.0]
+    lowprice_query = [504261, check_in, check_in + datetime.timedelta(days=3), 'PRICE']
+
+    def reset_city_lookup() -> None:
+        api_requests.suggestions_cache.clear()
+        destinations.index = destinations.DestinationIndex()
+
+    results = {
+        'get_city.parse_suggestions': measure(
+            lambda: api_requests.parse_suggestions(locations), iterations, warmup),
+        'get_city.suggestions_miss': measure(
+            lambda: api_requests.get_city_suggestions(message), iterations, warmup,
+            setup=reset_city_lookup),
+        'get_city.suggestions_index': measure(
+            lambda: api_requests.get_city_suggestions(message), iterations, warmup,
+            setup=api_requests.suggestions_cache.clear),
+        'get_city.suggestions_hit': measure(
+            lambda: api_requests.get_city_suggestions(message), iterations, warmup),
+        'destinations.search_prefix': measure(
+            lambda: destinations.index.search('par'), iterations, warmup),
+        'destinations.search_typo': measure(
+            lambda: destinations.index.search('prais'), iterations, warmup),
+        'best_deal_request.miss': measure(
+            lambda: bestdeal.best_deal_request(BENCH_CHAT_ID, 10, query), iterations, warmup,
+            setup=api_requests.properties_cache.clear),
+        'best_deal_request.first_hotel_miss': measure(
+            lambda: next(bestdeal.iter_best_deal(BENCH_CHAT_ID, 10, query)), iterations, warmup,
+            setup=api_requests.properties_cache.clear),
+        'best_deal_request.hit': measure(
+            lambda: bestdeal.best_deal_request(BENCH_CHAT_ID, 10, query), iterations, warmup),
+        'get_properties_list.miss': measure(
+            lambda: api_requests.get_properties_list(BENCH_CHAT_ID, 10, lowprice_query),
+            iterations, warmup, setup=api_requests.properties_cache.clear),
+        'fast_json.properties_page': measure(
+            lambda: hotels_model.parse_results(
+                fast_json.iter_items(properties_content, fast_json.RESULTS_PATH)),
+            iterations, warmup),
+        'hotels.parse_results': measure(
+            lambda: hotels_model.parse_results(raw_hotels), iterations, warmup),
+        'hotel_card': measure(lambda: [cards.hotel_card(hotel) for hotel in hotels[:10]],
+                              iterations, warmup),
+        'send_media_result': measure(
+            lambda: main.send_media_result(BENCH_CHAT_ID, hotels[0]), iterations, warmup),
+        'deliver.10_cards': measure(
+            lambda: main.delivery_engine.deliver(
+                BENCH_CHAT_ID, map(main.build_media_result, bestdeal.iter_best_deal(
+                    BENCH_CHAT_ID, 10, query))),
+            iterations, warmup),
+    }
+    return results
+
+
+def bench_database(iterations: int, warmup: int) -> dict:
+    """
+    Бенчмарки каждой функции postgres_database на отдельной БД.
+    Записи пользователей бенчмарка удаляются в конце.
+    """
+    import telebot
+    from botrequests import hotels as hotels_model, postgres_database
+
+    user_ids = iter(range(BENCH_USER_ID, BENCH_USER_ID + 10 * (iterations + warmup) + 10))
+
+    def new_user() -> None:
+        postgres_database.add_user(telebot.types.Message.de_json({
+            'message_id': 1, 'date': 0, 'text': '/start',
+            'chat': {'id': BENCH_USER_ID, 'type': 'private'},
+            'from': {'id': next(user_ids), 'is_bot': False, 'first_name': 'bench',
+                     'last_name': 'bench', 'username': 'bench'}
+        }))
+
+    hotels = hotels_model.parse_results(
+        load_fixture('properties_list')['data']['body']['searchResults']['results'])[:10]
+    history_data = json.dumps([hotel.as_dict() for hotel in hotels])
+    check_in = datetime.date.today() + datetime.timedelta(days=30)
+    query = [504261, check_in, check_in + datetime.timedelta(days=3), 'DISTANCE_FROM_LANDMARK',
+             50, 500, 0.5, 8.2]
+
+    def history_rows(count: int) -> list:
+        now = datetime.datetime.now()
+        return [(BENCH_USER_ID, 'DISTANCE_FROM_LANDMARK',
+                 (now - datetime.timedelta(seconds=index)).strftime('%Y-%m-%d %H:%M:%S'),
+                 history_data) for index in range(count)]
+
+    postgres_database.migrate()
+    try:
+        postgres_database.add_history_batch(history_rows(100))
+        last = postgres_database.get_history(BENCH_USER_ID, limit=5)[4]
+        before = (last[1], last[3])
+        results = {
+            'postgres.migrate': measure(postgres_database.migrate, iterations, warmup),
+            'postgres.add_user': measure(new_user, iterations, warmup),
+            'postgres.save_search': measure(
+                lambda: postgres_database.save_search(BENCH_USER_ID, query), iterations, warmup),
+            'postgres.get_full_info': measure(
+                lambda: postgres_database.get_full_info(BENCH_USER_ID), iterations, warmup),
+            'postgres.add_history': measure(
+                lambda: postgres_database.add_history(*history_rows(1)[0]), iterations, warmup),
+            'postgres.add_history_batch.100': measure(
+                lambda: postgres_database.add_history_batch(history_rows(100)),
+                iterations, warmup),
+            'postgres.get_history': measure(
+                lambda: postgres_database.get_history(BENCH_USER_ID, limit=5),
+                iterations, warmup),
+            'postgres.get_history.next_page': measure(
+                lambda: postgres_database.get_history(BENCH_USER_ID, before=before, limit=5),
+                iterations, warmup),
+        }
+    finally:
+        with postgres_database.pooled_cursor('bench_cleanup') as cursor:
+            cursor.execute("DELETE FROM history WHERE id=%s;", (BENCH_USER_ID,))
+            cursor.execute("DELETE FROM users WHERE id>=%s AND id<%s;",
+                           (BENCH_USER_ID, BENCH_USER_ID + 10 * (iterations + warmup) + 10))
+        postgres_database.close_pool()
+    return results
+
+
+def git_commit() -> [str, None]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                               text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, previous_path: str) -> None:
+    """
+    Печать сравнения медиан с предыдущим запуском.
+    """
+    with open(previous_path, encoding='utf-8') as file:
+        previous = json.load(file)['results']
+    print('{:<36} {:>12} {:>12} {:>8}'.format('benchmark', 'before, ms', 'after, ms', 'ratio'))
+    for name, stats in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]['median_ms']
+        after = stats['median_ms']
+        ratio = after / before if before else float('inf')
+        print('{:<36} {:>12.3f} {:>12.3f} {:>8.2f}'.format(name, before, after, ratio))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Офлайн бенчмарки горячих путей бота')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--db', action='store_true',
+                        help='выполнить бенчмарки postgres_database на локальной БД')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='json предыдущего запуска для сравнения')
+    parser.add_argument('--verbose', action='store_true', help='не отключать логи бота')
+    args = parser.parse_args()
+
+    stand_in = StandInServer().start()
+    configure(stand_in)
+
+    import telebot
+    from loguru import logger
+    telebot.apihelper.API_URL = stand_in.url + 'bot{0}/{1}'
+
+    try:
+        import main as bot_main  # noqa: F401 импорт настраивает бота на заменители
+        from botrequests import fast_json
+        if not args.verbose:
+            logger.remove()
+        results = bench_api(args.iterations, args.warmup)
+        if args.db:
+            results.update(bench_database(args.iterations, args.warmup))
+    finally:
+        stand_in.stop()
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'json_backend': fast_json.backend(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'warmup': args.warmup,
+        'stand_in_requests': stand_in.requests,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    print('saved {count} results to {path}'.format(count=len(results), path=args.output))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
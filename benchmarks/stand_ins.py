@@ -0,0 +1,163 @@
+"""
+Локальные заменители внешних сервисов для бенчмарков, работают без сети:
+    hotels4 api: ответы из записанных json в benchmarks/fixtures
+    Telegram Bot API: принимает любой метод и отвечает успешным сообщением
+    Изображения отелей: небольшой jpeg по любому пути /img/
+"""
+import copy
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Заглушка jpeg около 2 КБ, как небольшая миниатюра: содержимое изображения не важно
+JPEG = b'\xff\xd8\xff\xe0' + bytes(2048) + b'\xff\xd9'
+
+# Шаг удаления между отелями на страницах properties/list, миль
+DISTANCE_STEP = 0.18
+
+
+def load_fixture(name: str) -> dict:
+    """
+    Загрузка записанного ответа hotels4.
+    :param name: Имя файла без расширения.
+    :return: Ответ api.
+    """
+    with open(os.path.join(FIXTURES, name + '.json'), encoding='utf-8') as file:
+        return json.load(file)
+
+
+class StandInServer:
+    """
+    HTTP сервер заменителей в отдельном потоке на случайном свободном порту.
+    Считает запросы по путям, чтобы бенчмарк мог проверить, сколько вызовов api сделано.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0) -> None:
+        self.locations = load_fixture('locations_v2_search')
+        self.properties = load_fixture('properties_list')
+        self.photos = load_fixture('get_hotel_photos')
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self.url = 'http://{}:{}/'.format(*self.server.server_address)
+        self._thread = threading.Thread(target=self.server.serve_forever, name='stand-ins',
+                                        daemon=True)
+
+    def start(self) -> 'StandInServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, path: str) -> None:
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def next_message_id(self) -> int:
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def properties_page(self, params: dict) -> dict:
+        """
+        Страница properties/list: отели из записанного ответа с уникальными id
+        и удалением, растущим от страницы к странице, как при сортировке по удалению.
+        """
+        page_number = int(params.get('pageNumber', 1))
+        page_size = int(params.get('pageSize', 25))
+        template = self.properties['data']['body']['searchResults']['results']
+        offset = (page_number - 1) * page_size
+        results = []
+        for index in range(page_size):
+            hotel = copy.deepcopy(template[index % len(template)])
+            hotel['id'] = hotel['id'] + offset * 1000 + index
+            hotel['landmarks'][0]['distance'] = '{:.1f} miles'.format(
+                (offset + index + 1) * DISTANCE_STEP)
+            hotel['optimizedThumbUrls']['srpDesktop'] = '{url}img/{id}.jpg'.format(
+                url=self.url, id=hotel['id'])
+            results.append(hotel)
+        response = copy.copy(self.properties)
+        response['data'] = {'body': dict(self.properties['data']['body'])}
+        search_results = dict(response['data']['body']['searchResults'])
+        search_results['results'] = results
+        search_results['pagination'] = dict(search_results['pagination'],
+                                            currentPage=page_number,
+                                            nextPageNumber=page_number + 1)
+        response['data']['body']['searchResults'] = search_results
+        return response
+
+    def telegram_result(self, method: str):
+        """
+        Ответ Telegram Bot API для метода: сообщение (или список сообщений для sendMediaGroup).
+        """
+        message = {'message_id': self.next_message_id(), 'date': int(time.time()),
+                   'chat': {'id': 1, 'type': 'private'}, 'text': ''}
+        method = method.lower()
+        if method == 'sendphoto':
+            message['photo'] = [{'file_id': 'bench{}'.format(message['message_id']),
+                                 'file_unique_id': 'bench', 'width': 1, 'height': 1}]
+        if method == 'sendmediagroup':
+            return [message]
+        if method in ('answercallbackquery', 'deletewebhook', 'setwebhook', 'deletemessage'):
+            return True
+        if method == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        return message
+
+
+def _make_handler(stand_in: StandInServer):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            self._dispatch()
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            self._dispatch()
+
+        def _dispatch(self) -> None:
+            parts = urlsplit(self.path)
+            path = parts.path.strip('/')
+            params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+            stand_in.count(path.split('/')[-1] if path.startswith('bot') else path)
+
+            if path.startswith('img/'):
+                self._send(200, JPEG, 'image/jpeg')
+            elif path.startswith('bot'):
+                result = stand_in.telegram_result(path.split('/')[-1])
+                self._send_json({'ok': True, 'result': result})
+            elif path == 'locations/v2/search':
+                self._send_json(stand_in.locations)
+            elif path == 'properties/list':
+                self._send_json(stand_in.properties_page(params))
+            elif path == 'properties/get-hotel-photos':
+                self._send_json(dict(stand_in.photos, hotelId=int(params.get('id', 0))))
+            else:
+                self._send_json({'message': 'not found'}, status=404)
+
+        def _send_json(self, data, status: int = 200) -> None:
+            self._send(status, json.dumps(data).encode('utf-8'), 'application/json')
+
+        def _send(self, status: int, body: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
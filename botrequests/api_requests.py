@@ -1,86 +1,328 @@
 """
 Основные реквесты api, включает, поиск города, команды lowprice, highprice, и поиск фотографий
 """
-import json
-import requests
+import re
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 import telebot.types
 from decouple import config
 from loguru import logger
+from botrequests import api_scheduler, destinations, fast_json, hotels, http_client, metrics
+from botrequests.cache import TTLCache
+from botrequests.single_flight import SingleFlight
 
-logger.add('debug.log', format='{time} {level} {message}',
-           level='DEBUG', rotation='10 MB', compression='zip'
-           )
+HIGHLIGHT_PATTERN = re.compile(r"<span class='highlighted'>|</span>")
 
-headers = {
-    'x-rapidapi-host': "hotels4.p.rapidapi.com",
-    'x-rapidapi-key': config('rapid_api_key')
-}
+# Кэш подсказок городов: ключ (запрос, locale, currency), значение - уже очищенные подписи
+suggestions_cache = TTLCache(
+    maxsize=config('suggestions_cache_size', default=2048, cast=int),
+    ttl=config('suggestions_cache_ttl', default=6 * 60 * 60, cast=int),
+    max_weight=config('suggestions_cache_bytes', default=4 * 1024 * 1024, cast=int),
+    weigher=lambda value: sum(len(caption) + 32 for caption, _ in value['captions'])
+)
 
+# Размер страницы properties/list, достаточный для любого hotels_number (не более 10)
+PROPERTIES_PAGE_SIZE = 10
 
-def get_request_search(message: [telebot.types.Message]) -> dict:
+# Кэш страниц properties/list: ключ (destinationId, checkIn, checkOut, sortOrder,
+# priceMin, priceMax, pageNumber), значение - список hotels.Hotel страницы
+properties_cache = TTLCache(
+    maxsize=config('properties_cache_size', default=512, cast=int),
+    ttl=config('properties_cache_ttl', default=5 * 60, cast=int),
+    stale_ttl=config('properties_cache_stale_ttl', default=10 * 60, cast=int)
+    if config('properties_serve_stale', default=True, cast=bool) else 0
+)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# Одинаковые одновременные запросы страниц (один город, даты, сортировка и фильтры
+# из разных чатов) выполняются одним запросом к api
+properties_flight = SingleFlight('properties')
+
+# Кэш фотографий отелей: ключ hotel_id, значение - список baseUrl и размеров
+photos_cache = TTLCache(
+    maxsize=config('photos_cache_size', default=1024, cast=int),
+    ttl=config('photos_cache_ttl', default=24 * 60 * 60, cast=int)
+)
+_photo_executor = ThreadPoolExecutor(
+    max_workers=config('photos_prefetch_workers', default=2, cast=int),
+    thread_name_prefix='photo-prefetch'
+)
+_photo_futures = {}
+_photo_futures_lock = threading.Lock()
+
+metrics.register_cache('suggestions', suggestions_cache)
+metrics.register_cache('properties', properties_cache)
+metrics.register_cache('photos', photos_cache)
+
+
+def normalize_query(text: str) -> str:
+    """
+    Приведение запроса пользователя к виду ключа кэша: без лишних пробелов, в нижнем регистре.
+    :param text: Текст запроса.
+    :return: Нормализованный запрос.
+    """
+    return ' '.join(text.split()).lower()
+
+
+@metrics.STAGES.timed
+def get_city_suggestions(message: telebot.types.Message,
+                         locale: str = 'en_US', currency: str = 'USD') -> dict:
+    """
+    Функция получения вариантов местоположения по запросу пользователя.
+    Сначала ищет ответ в кэше, затем в локальном индексе destinations (для en_US),
+    и только если индекс такого города не знает, делает запрос get_request_search
+    (кириллица транслитерируется), пополняет индекс и сохраняет уже очищенные
+    от разметки подписи.
+    :param message: Сообщение от пользователя, содержит город для поиска.
+    :param locale: Язык ответа api.
+    :param currency: Валюта ответа api.
+    :return: Словарь с ключами captions (список пар подпись, destinationId) и moresuggestions.
+    """
+    key = (normalize_query(message.text), locale, currency)
+    suggestions = suggestions_cache.get(key)
+    if suggestions is not None:
+        logger.info('{id} - get_city_suggestions - cache'.format(id=str(message.from_user.id)))
+        return suggestions
+
+    use_index = locale == destinations.LOCALE
+    if use_index:
+        suggestions = destinations.index.lookup(message.text, destinations.MIN_SCORE)
+        if suggestions is not None:
+            logger.info('{id} - get_city_suggestions - index'.format(id=str(message.from_user.id)))
+            suggestions_cache.set(key, suggestions)
+            return suggestions
+
+    json_data = get_request_search(message, locale=locale, currency=currency)
+    if use_index:
+        destinations.index.add_response(message.text, json_data)
+    suggestions = parse_suggestions(json_data)
+    suggestions_cache.set(key, suggestions)
+    return suggestions
+
+
+def parse_suggestions(json_data: dict) -> dict:
+    """
+    Функция разбора ответа locations/v2/search: подписи городов очищаются от разметки.
+    :param json_data: Ответ api.
+    :return: Словарь с ключами captions (список пар подпись, destinationId) и moresuggestions.
+    """
+    captions = [
+        (HIGHLIGHT_PATTERN.sub('', entities['caption']), entities['destinationId'])
+        for entities in json_data['suggestions'][0]['entities']
+    ]
+    return {'captions': captions, 'moresuggestions': json_data['moresuggestions']}
+
+
+def get_request_search(message: [telebot.types.Message],
+                       locale: str = 'en_US', currency: str = 'USD') -> dict:
     """
     Функция реквест-запрос получает список городов и ID, подходящих по запросу.
     Полученный json файл десериализуется и записывается в переменную
     results затем функция возвращает её.
     :param message: Сообщение от пользователя, содержит город для поиска.
+    :param locale: Язык ответа api.
+    :param currency: Валюта ответа api.
     :return: Словарь с найденными городами.
     """
 
-    # rapid_api_key = config('rapid_api_key')
-    city = message.text.capitalize()
-    url = "https://hotels4.p.rapidapi.com/locations/v2/search"
+    city = destinations.transliterate(message.text).capitalize()
+    querystring = {"query": city, "locale": locale, "currency": currency}
 
-    querystring = {"query": city, "locale": "en_US", "currency": "USD"}
-
-    response = requests.request("GET", url, headers=headers, params=querystring, timeout=50)
-    json_data = json.loads(response.text)
+    response = http_client.get('locations/v2/search', querystring)
+    json_data = fast_json.loads(response.content)
     logger.info('{id} - get_request_search - ok'.format(id=str(message.from_user.id)))
     return json_data
 
 
+@metrics.STAGES.timed
 def get_properties_list(chat_id: int, hotels_number: int, query: list) -> [None, dict]:
     """
     Функция реквест-запрос, получающая заданное количество отелей указанной сортировки.
-    Полученный json файл десериализуется и записывается в переменную
-    results затем функция возвращает её.
+    Отели берутся из первой страницы get_properties_page (с кэшем)
+    и записываются в переменную results затем функция возвращает её.
     :param query: Список необходимых для запроса переменных.
     :param chat_id: ID пользователя.
     :param hotels_number: Количество отелей, которые будут в results.
-    :return: Словарь с найденными отелями.
+    :return: Список hotels.Hotel с найденными отелями.
     """
-    url = "https://hotels4.p.rapidapi.com/properties/list"
     destination_id = str(query[0])
     check_in = str(query[1])
     check_out = str(query[2])
     sortorder = query[3]
-    page_size = hotels_number
 
-    querystring = {
-        "destinationId": destination_id, "pageNumber": "1", "pageSize": page_size,
-        "checkIn": check_in, "checkOut": check_out, "adults1": "1", "sortOrder": sortorder,
-        "locale": "en_US", "currency": "USD"
-    }
-
-    response = requests.request("GET", url, headers=headers, params=querystring, timeout=50)
-    json_data = json.loads(response.text)
-    results = json_data['data']['body']['searchResults']['results']
+    results = get_properties_page(destination_id, check_in, check_out, sortorder)[:hotels_number]
     if not results:
         return None
 
-    logger.info(str(chat_id), '{id} - get_properties_list - ok'.format(id=str(chat_id)))
+    logger.info('{id} - get_properties_list - ok'.format(id=str(chat_id)))
+    return results
+
+
+@metrics.STAGES.timed
+def get_properties_page(destination_id: str, check_in: str, check_out: str, sortorder: str,
+                        page_number: int = 1, price_min: str = None, price_max: str = None) -> list:
+    """
+    Функция получения одной страницы properties/list из PROPERTIES_PAGE_SIZE отелей.
+    Страница ищется в кэше по всем параметрам поиска. Устаревшая запись
+    отдается сразу и обновляется в фоне (если включен properties_serve_stale).
+    При промахе одинаковые одновременные запросы объединяются в один через properties_flight.
+    Первая страница запрашивается с приоритетом поиска пользователя, следующие
+    страницы bestdeal - с приоритетом PAGES, фоновое обновление - BACKGROUND.
+    :param destination_id: ID местоположения.
+    :param check_in: Дата заезда.
+    :param check_out: Дата выезда.
+    :param sortorder: Метод сортировки.
+    :param page_number: Номер страницы.
+    :param price_min: Минимальная цена (только для bestdeal).
+    :param price_max: Максимальная цена (только для bestdeal).
+    :return: Список отелей страницы.
+    """
+    key = (str(destination_id), str(check_in), str(check_out), sortorder,
+           price_min, price_max, int(page_number))
+    results, fresh = properties_cache.get_entry(key)
+    if results is not None:
+        if not fresh:
+            _refresh_properties_page(key)
+        return results
+
+    priority = api_scheduler.INTERACTIVE if key[-1] == 1 else api_scheduler.PAGES
+    return properties_flight.do(key, _load_properties_page, key, priority)
+
+
+def _load_properties_page(key: tuple, priority: int) -> list:
+    """
+    Запрос страницы и запись ее в кэш, выполняется внутри properties_flight.
+    :param key: Ключ страницы в кэше.
+    :param priority: Класс приоритета api_scheduler.
+    :return: Список отелей страницы.
+    """
+    results = _request_properties_page(*key, priority=priority)
+    properties_cache.set(key, results)
     return results
 
 
+def _refresh_properties_page(key: tuple) -> None:
+    """
+    Фоновое обновление устаревшей страницы в кэше. Для каждого ключа
+    одновременно работает не более одного обновления.
+    :param key: Ключ страницы в кэше.
+    :return:
+    """
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def refresh():
+        try:
+            properties_flight.do(key, _load_properties_page, key, api_scheduler.BACKGROUND)
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def _request_properties_page(destination_id: str, check_in: str, check_out: str, sortorder: str,
+                             price_min: [str, None], price_max: [str, None], page_number: int,
+                             priority: int = api_scheduler.INTERACTIVE) -> list:
+    """
+    Функция реквест-запрос одной страницы properties/list.
+    :param priority: Класс приоритета api_scheduler.
+    :return: Список hotels.Hotel страницы.
+    """
+    querystring = {
+        "destinationId": destination_id, "pageNumber": str(page_number),
+        "pageSize": PROPERTIES_PAGE_SIZE, "checkIn": check_in, "checkOut": check_out,
+        "adults1": "1", "sortOrder": sortorder, "locale": "en_US", "currency": "USD"
+    }
+    if price_min is not None:
+        querystring["priceMin"] = price_min
+    if price_max is not None:
+        querystring["priceMax"] = price_max
+
+    response = http_client.get('properties/list', querystring, priority)
+    return hotels.parse_results(fast_json.iter_items(response.content, fast_json.RESULTS_PATH))
+
+
+@metrics.STAGES.timed
 def get_photo(hotel_id: str) -> dict:
     """
-    Функция реквест-запрос, получающая фотографии отеля по ID. Возвращает dict.
+    Функция получения фотографий отеля по ID. Возвращает dict.
+    Сначала ищет фотографии в кэше и в предзагрузке. Предзагрузка, которая еще
+    не началась, отменяется, а начавшаяся повышается до приоритета INTERACTIVE
+    (чтобы не ждать в очереди за фоновыми запросами) и ожидается, поэтому запрос
+    к api не повторяется. Сам запрос выполняется, только если предзагрузки нет,
+    она отменена или завершилась ошибкой (например, QuotaExceeded фонового
+    запроса из-за api_quota_reserve).
+    :param hotel_id: ID отеля.
+    :return: Словарь с ссылками на фотографии.
+    """
+    hotel_id = str(hotel_id)
+    json_data = photos_cache.get(hotel_id)
+    if json_data is not None:
+        logger.info('Hotel {id} - get_photo - cache'.format(id=hotel_id))
+        return json_data
+
+    with _photo_futures_lock:
+        prefetch = _photo_futures.get(hotel_id)
+    if prefetch is not None:
+        future, ticket = prefetch
+        if not future.cancel():
+            ticket.promote(api_scheduler.INTERACTIVE)
+            try:
+                return future.result()
+            except Exception as ex:
+                logger.warning('Hotel {id} - get_photo - prefetch failed: {ex!r}'.format(
+                    id=hotel_id, ex=ex))
+    return _load_photo(hotel_id)
+
+
+def prefetch_photos(hotel_ids: list) -> None:
+    """
+    Функция фоновой предзагрузки фотографий для показанных пользователю отелей,
+    чтобы ответ на "Хочу фотографии!" отдавался из памяти.
+    :param hotel_ids: Список ID отелей.
+    :return:
+    """
+    for hotel_id in map(str, hotel_ids):
+        if photos_cache.get(hotel_id) is not None:
+            continue
+        with _photo_futures_lock:
+            if hotel_id in _photo_futures:
+                continue
+            ticket = api_scheduler.Ticket(api_scheduler.BACKGROUND)
+            future = _photo_executor.submit(_load_photo, hotel_id, ticket)
+            _photo_futures[hotel_id] = future, ticket
+        future.add_done_callback(lambda _, key=hotel_id: _forget_photo_future(key))
+
+
+def _forget_photo_future(hotel_id: str) -> None:
+    with _photo_futures_lock:
+        _photo_futures.pop(hotel_id, None)
+
+
+def _load_photo(hotel_id: str,
+                priority: [int, api_scheduler.Ticket] = api_scheduler.INTERACTIVE) -> dict:
+    """
+    Функция реквест-запрос, получающая фотографии отеля по ID.
+    В кэш сохраняются только поля, которые используются при отправке фотографий.
     :param hotel_id: ID отеля.
+    :param priority: Класс приоритета api_scheduler (Ticket с BACKGROUND для предзагрузки).
     :return: Словарь с ссылками на фотографии.
     """
-    url = "https://hotels4.p.rapidapi.com/properties/get-hotel-photos"
     querystring = {"id": hotel_id}
 
-    response = requests.request("GET", url, headers=headers, params=querystring, timeout=50)
-    json_data = json.loads(response.text)
+    response = http_client.get('properties/get-hotel-photos', querystring, priority)
+    json_data = fast_json.loads(response.content)
+    json_data = {'hotelImages': [
+        {'baseUrl': image['baseUrl'], 'sizes': image['sizes'][:1]}
+        for image in json_data['hotelImages']
+    ]}
+    photos_cache.set(hotel_id, json_data)
     logger.info('Hotel {id} - get_photo - ok'.format(id=hotel_id))
     return json_data
@@ -0,0 +1,377 @@
+"""
+Планировщик запросов к hotels4 api с учетом квоты RapidAPI:
+    Token bucket по лимиту тарифа в секунду
+    Приоритеты: поиск пользователя, затем страницы bestdeal, затем фоновые запросы
+    Чтение заголовков квоты X-RateLimit-Requests-* из ответов
+    Адаптивное снижение частоты и пауза после 429
+    Счетчик запросов за месяц, общий для всех процессов бота и сохраняемый на диск
+"""
+import asyncio
+import atexit
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from decouple import config
+from loguru import logger
+
+from botrequests import metrics
+from botrequests.rate_limit import TokenBucket
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Классы приоритета: меньше - важнее
+INTERACTIVE = 0
+PAGES = 1
+BACKGROUND = 2
+PRIORITY_NAMES = ('interactive', 'pages', 'background')
+
+# Как часто ожидающий запрос проверяет очередь, пока впереди более важные запросы
+POLL_INTERVAL = 0.05
+
+QUEUE = metrics.Gauge('bot_api_queue', 'Запросы к api, ожидающие очереди', ('priority',))
+
+
+class QuotaExceeded(requests.exceptions.RequestException):
+    """
+    Месячная квота RapidAPI исчерпана (или остался только резерв для поиска пользователя).
+    """
+
+
+class Ticket:
+    """
+    Класс приоритета запроса, который можно повысить, пока запрос ждет очереди:
+    например, фоновой предзагрузки, результат которой уже ждет пользователь.
+    """
+
+    def __init__(self, priority: int) -> None:
+        """
+        :param priority: Начальный класс приоритета.
+        """
+        self.priority = priority
+
+    def promote(self, priority: int) -> None:
+        """
+        Повышение приоритета, ожидающий запрос переходит в более важный класс
+        при следующей проверке очереди.
+        :param priority: Новый класс приоритета, понижение игнорируется.
+        """
+        self.priority = min(self.priority, priority)
+
+
+class ApiUsage:
+    """
+    Счетчик запросов за текущий месяц с сохранением в json файл.
+    Остаток квоты берется из заголовков ответа, а между ответами уменьшается локально.
+    Файл общий для всех процессов бота: при сохранении к записанному в файле счетчику
+    прибавляются только новые запросы этого процесса (под блокировкой файла),
+    поэтому квота, израсходованная остановленными процессами, не теряется.
+    """
+
+    def __init__(self, path: str = None, monthly_quota: int = 0, save_every: int = 20) -> None:
+        """
+        :param path: Файл счетчика, None - без сохранения.
+        :param monthly_quota: Месячный лимит тарифа, 0 - неизвестен до первого ответа.
+        :param save_every: Сохранять файл через каждые save_every запросов.
+        """
+        self.path = path
+        self.save_every = save_every
+        self.month = self._current_month()
+        self.requests = 0
+        self.limit = monthly_quota or None
+        self.remaining = None
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def _current_month() -> str:
+        return datetime.date.today().strftime('%Y-%m')
+
+    def _rollover(self) -> None:
+        month = self._current_month()
+        if month != self.month:
+            self.month = month
+            self.requests = 0
+            self.remaining = None
+
+    def available(self) -> [int, None]:
+        """
+        Остаток квоты на месяц.
+        :return: Количество запросов или None, если лимит неизвестен.
+        """
+        with self._lock:
+            self._rollover()
+            if self.remaining is not None:
+                return self.remaining
+            if self.limit is not None:
+                return max(0, self.limit - self.requests)
+            return None
+
+    def count(self) -> None:
+        """
+        Учет отправленного запроса.
+        """
+        with self._lock:
+            self._rollover()
+            self.requests += 1
+            if self.remaining is not None:
+                self.remaining = max(0, self.remaining - 1)
+            self._unsaved += 1
+            save = self._unsaved >= self.save_every
+        if save:
+            self.save()
+
+    def update(self, headers) -> None:
+        """
+        Обновление лимита и остатка из заголовков ответа RapidAPI.
+        :param headers: Заголовки ответа (без учета регистра).
+        """
+        limit = headers.get('X-RateLimit-Requests-Limit')
+        remaining = headers.get('X-RateLimit-Requests-Remaining')
+        with self._lock:
+            if limit and limit.isdigit():
+                self.limit = int(limit)
+            if remaining and remaining.isdigit():
+                self.remaining = int(remaining)
+
+    def save(self) -> None:
+        """
+        Сохранение счетчика в файл: новые запросы процесса добавляются к счетчику
+        в файле, остаток квоты берется наименьший. Файл заменяется целиком атомарно,
+        одновременная запись из нескольких процессов упорядочивается блокировкой.
+        """
+        with self._lock:
+            if not self.path:
+                self._unsaved = 0
+                return
+            delta, self._unsaved = self._unsaved, 0
+            month, limit, remaining = self.month, self.limit, self.remaining
+        try:
+            with open(self.path + '.lock', 'a') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                data = self._read()
+                if data.get('month') == month:
+                    requests_total = data.get('requests', 0) + delta
+                    if data.get('remaining') is not None:
+                        remaining = data['remaining'] if remaining is None \
+                            else min(remaining, data['remaining'])
+                else:
+                    requests_total = delta
+                data = {'month': month, 'requests': requests_total,
+                        'limit': limit or data.get('limit'), 'remaining': remaining}
+                temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    json.dump(data, file)
+                os.replace(temp_path, self.path)
+        except OSError as ex:
+            logger.error('api_usage - cannot save {path} - {ex}'.format(path=self.path, ex=ex))
+            with self._lock:
+                self._unsaved += delta
+            return
+        with self._lock:
+            if self.month == month:
+                self.requests = requests_total + self._unsaved
+                if remaining is not None:
+                    self.remaining = max(0, remaining - self._unsaved)
+
+    def _read(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError) as ex:
+            logger.error('api_usage - cannot load {path} - {ex}'.format(path=self.path, ex=ex))
+            return {}
+
+    def _load(self) -> None:
+        data = self._read()
+        if data.get('month') == self.month:
+            self.requests = data.get('requests', 0)
+            self.remaining = data.get('remaining')
+        self.limit = self.limit or data.get('limit')
+
+
+class ApiScheduler:
+    """
+    Очередь запросов к api с приоритетами поверх token bucket.
+    Запрос получает токен, только если нет ожидающих запросов более важного класса.
+    """
+
+    def __init__(self, rate: float, burst: float, usage: ApiUsage, quota_reserve: int = 0,
+                 queue_timeout: float = None, max_backoff: float = 60) -> None:
+        """
+        :param rate: Лимит тарифа, запросов в секунду.
+        :param burst: Размер всплеска.
+        :param usage: Счетчик месячной квоты.
+        :param quota_reserve: Остаток квоты, который доступен только поиску пользователя.
+        :param queue_timeout: Максимальное ожидание в очереди, секунд.
+        :param max_backoff: Максимальная пауза после 429, секунд.
+        """
+        self.rate = rate
+        self.bucket = TokenBucket(rate=rate, capacity=burst)
+        self.usage = usage
+        self.quota_reserve = quota_reserve
+        self.queue_timeout = queue_timeout
+        self.max_backoff = max_backoff
+        self.throttled = 0
+        self._waiting = [0] * len(PRIORITY_NAMES)
+        self._cond = threading.Condition()
+
+    def acquire(self, priority: [int, Ticket] = INTERACTIVE) -> None:
+        """
+        Ожидание очереди для одного запроса.
+        :param priority: Класс приоритета или Ticket, приоритет которого может быть
+            повышен во время ожидания.
+        :raises QuotaExceeded: Если квота исчерпана для этого приоритета.
+        :raises requests.exceptions.Timeout: Если очередь не подошла за queue_timeout.
+        """
+        ticket = priority if isinstance(priority, Ticket) else Ticket(priority)
+        deadline = self._deadline()
+        with self._cond:
+            current = ticket.priority
+            self._enter(current)
+            try:
+                while True:
+                    current = self._requeue(ticket, current)
+                    wait = self._try_acquire(current)
+                    if wait <= 0:
+                        break
+                    self._cond.wait(self._wait_time(wait, deadline))
+            finally:
+                self._leave(current)
+        self.usage.count()
+
+    async def acquire_async(self, priority: [int, Ticket] = INTERACTIVE) -> None:
+        """
+        Аналог acquire для asyncio: ожидание без блокировки event loop.
+        """
+        ticket = priority if isinstance(priority, Ticket) else Ticket(priority)
+        deadline = self._deadline()
+        with self._cond:
+            current = ticket.priority
+            self._enter(current)
+        try:
+            while True:
+                with self._cond:
+                    current = self._requeue(ticket, current)
+                    wait = self._try_acquire(current)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(self._wait_time(wait, deadline))
+        finally:
+            with self._cond:
+                self._leave(current)
+        self.usage.count()
+
+    def on_response(self, status: int, headers) -> float:
+        """
+        Учет ответа api: обновление квоты из заголовков, после 429 пауза
+        и снижение частоты вдвое, после успешного ответа частота постепенно
+        возвращается к лимиту тарифа.
+        :param status: HTTP статус ответа.
+        :param headers: Заголовки ответа.
+        :return: Пауза в секундах после 429, иначе 0.
+        """
+        self.usage.update(headers)
+        if status != 429:
+            with self._cond:
+                self.throttled = 0
+                self.bucket.rate = min(self.rate, self.bucket.rate + self.rate * 0.1)
+            return 0
+
+        with self._cond:
+            self.throttled += 1
+            self.bucket.rate = max(self.rate * 0.1, self.bucket.rate / 2)
+            retry_after = headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                backoff = min(self.max_backoff, int(retry_after))
+            else:
+                backoff = random.uniform(0, min(self.max_backoff, 2 ** self.throttled))
+            self.bucket.pause(backoff)
+            self._cond.notify_all()
+        logger.warning('api 429 - pause {sec:.1f} s, rate {rate:.2f}/s'.format(
+            sec=backoff, rate=self.bucket.rate))
+        return backoff
+
+    def stats(self) -> dict:
+        """
+        Состояние планировщика для мониторинга.
+        """
+        with self._cond:
+            waiting = dict(zip(PRIORITY_NAMES, self._waiting))
+        return {'rate': self.bucket.rate, 'waiting': waiting,
+                'monthly_requests': self.usage.requests, 'remaining': self.usage.available()}
+
+    def _deadline(self) -> [float, None]:
+        return None if self.queue_timeout is None else time.monotonic() + self.queue_timeout
+
+    @staticmethod
+    def _wait_time(wait: float, deadline: [float, None]) -> float:
+        if deadline is None:
+            return wait
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout('api scheduler queue timeout')
+        return min(wait, remaining)
+
+    def _enter(self, priority: int) -> None:
+        self._waiting[priority] += 1
+        QUEUE.inc(PRIORITY_NAMES[priority])
+
+    def _leave(self, priority: int) -> None:
+        self._waiting[priority] -= 1
+        QUEUE.dec(PRIORITY_NAMES[priority])
+        self._cond.notify_all()
+
+    def _requeue(self, ticket: Ticket, current: int) -> int:
+        """
+        Перевод ожидающего запроса в класс, до которого повышен его Ticket.
+        :return: Текущий класс приоритета запроса.
+        """
+        if ticket.priority != current:
+            self._leave(current)
+            current = ticket.priority
+            self._enter(current)
+        return current
+
+    def _try_acquire(self, priority: int) -> float:
+        available = self.usage.available()
+        if available is not None:
+            if available <= 0 or (priority > INTERACTIVE and available <= self.quota_reserve):
+                raise QuotaExceeded('RapidAPI monthly quota: {count} requests left'.format(
+                    count=available))
+        if any(self._waiting[:priority]):
+            return POLL_INTERVAL
+        return self.bucket.try_acquire()
+
+
+usage = ApiUsage(
+    path=config('api_usage_path', default='api_usage.json') or None,
+    monthly_quota=config('api_monthly_quota', default=0, cast=int)
+)
+scheduler = ApiScheduler(
+    rate=config('api_rate_limit', default=5, cast=float),
+    burst=config('api_burst', default=5, cast=float),
+    usage=usage,
+    quota_reserve=config('api_quota_reserve', default=50, cast=int),
+    queue_timeout=config('api_queue_timeout', default=30, cast=float),
+    max_backoff=config('api_max_backoff', default=60, cast=float)
+)
+atexit.register(usage.save)
+metrics.register_gauge('bot_api_rate', 'Текущий лимит запросов к api в секунду',
+                       lambda: scheduler.bucket.rate)
+metrics.register_gauge('bot_api_monthly_requests', 'Запросы к api за текущий месяц',
+                       lambda: usage.requests)
+metrics.register_gauge('bot_api_quota_remaining', 'Остаток месячной квоты api, -1 если неизвестен',
+                       lambda: -1 if usage.available() is None else usage.available())
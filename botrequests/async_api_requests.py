@@ -0,0 +1,292 @@
+"""
+Асинхронные реквесты api для asyncio режима бота (async_main.py):
+поиск города, страницы properties/list и фотографии отеля.
+Используют общую aiohttp сессию и те же кэши, что и api_requests.
+"""
+import asyncio
+import random
+import time
+
+import aiohttp
+from decouple import config
+from loguru import logger
+
+from botrequests import api_requests, api_scheduler, bestdeal, destinations, fast_json, hotels, \
+    http_client, metrics
+from botrequests.single_flight import AsyncSingleFlight
+
+_session = None
+
+# Объединение одинаковых одновременных запросов страниц, как api_requests.properties_flight
+properties_flight = AsyncSingleFlight('async_properties')
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """
+    Функция ленивого создания общей aiohttp сессии с пулом keep-alive соединений.
+    :return: Сессия aiohttp.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=config('api_pool_size', default=10, cast=int),
+            ttl_dns_cache=300
+        )
+        _session = aiohttp.ClientSession(headers=http_client.HEADERS, connector=connector)
+    return _session
+
+
+async def close_session() -> None:
+    """
+    Функция закрытия сессии при остановке бота.
+    :return:
+    """
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+
+async def get(endpoint: str, params: dict, priority: int = api_scheduler.INTERACTIVE) -> dict:
+    """
+    Функция GET запроса к методу api, как get_content.
+    :return: Десериализованный json ответа.
+    """
+    return fast_json.loads(await get_content(endpoint, params, priority))
+
+
+async def get_content(endpoint: str, params: dict,
+                      priority: int = api_scheduler.INTERACTIVE) -> bytes:
+    """
+    Функция GET запроса к методу api, повторяет запрос при ошибке сети
+    или ответе 5xx с экспоненциальной задержкой и jitter, после 429 - после
+    паузы api_scheduler. Каждая попытка ждет своей очереди в api_scheduler.
+    :param endpoint: Метод api, например 'properties/list'.
+    :param params: Параметры запроса.
+    :param priority: Класс приоритета api_scheduler.
+    :return: Тело ответа в байтах.
+    :raises aiohttp.ClientResponseError: Если ответ 4xx, или 5xx и 429 после повторов.
+    """
+    connect_timeout, read_timeout = http_client.TIMEOUTS.get(endpoint, http_client.DEFAULT_TIMEOUT)
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    params = {key: str(value) for key, value in params.items()}
+    retries = config('api_retries', default=3, cast=int)
+    session = await get_session()
+
+    with metrics.API.track(endpoint):
+        for attempt in range(retries + 1):
+            await api_scheduler.scheduler.acquire_async(priority)
+            try:
+                async with session.get(http_client.BASE_URL + endpoint, params=params,
+                                       timeout=timeout) as response:
+                    api_scheduler.scheduler.on_response(response.status, response.headers)
+                    if response.status == 429 and attempt < retries:
+                        continue
+                    logger.debug('{endpoint} - {status}'.format(endpoint=endpoint,
+                                                                status=response.status))
+                    response.raise_for_status()
+                    return await response.read()
+            except aiohttp.ClientResponseError as ex:
+                # 4xx не повторяется: ответ не изменится
+                if ex.status < 500 or attempt == retries:
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+
+async def get_city_suggestions(text: str, user_id: int,
+                               locale: str = 'en_US', currency: str = 'USD') -> dict:
+    """
+    Асинхронный аналог api_requests.get_city_suggestions, использует тот же индекс destinations.
+    :param text: Город для поиска.
+    :param user_id: ID пользователя для лога.
+    :param locale: Язык ответа api.
+    :param currency: Валюта ответа api.
+    :return: Словарь с ключами captions (список пар подпись, destinationId) и moresuggestions.
+    """
+    key = (api_requests.normalize_query(text), locale, currency)
+    suggestions = api_requests.suggestions_cache.get(key)
+    if suggestions is not None:
+        return suggestions
+
+    use_index = locale == destinations.LOCALE
+    if use_index:
+        suggestions = destinations.index.lookup(text, destinations.MIN_SCORE)
+        if suggestions is not None:
+            api_requests.suggestions_cache.set(key, suggestions)
+            return suggestions
+
+    querystring = {"query": destinations.transliterate(text).capitalize(),
+                   "locale": locale, "currency": currency}
+    json_data = await get('locations/v2/search', querystring)
+    if use_index:
+        destinations.index.add_response(text, json_data)
+    suggestions = api_requests.parse_suggestions(json_data)
+    api_requests.suggestions_cache.set(key, suggestions)
+    logger.info('{id} - async get_city_suggestions - ok'.format(id=user_id))
+    return suggestions
+
+
+async def get_properties_page(destination_id: str, check_in: str, check_out: str, sortorder: str,
+                              page_number: int = 1, price_min: str = None,
+                              price_max: str = None) -> list:
+    """
+    Асинхронный аналог api_requests.get_properties_page, использует тот же кэш страниц,
+    одинаковые одновременные запросы объединяются через properties_flight.
+    :return: Список отелей страницы.
+    """
+    key = (str(destination_id), str(check_in), str(check_out), sortorder,
+           price_min, price_max, int(page_number))
+    results, fresh = api_requests.properties_cache.get_entry(key)
+    if results is not None and fresh:
+        return results
+    if results is not None:
+        asyncio.ensure_future(_refresh_properties_page(key))
+        return results
+
+    priority = api_scheduler.INTERACTIVE if key[-1] == 1 else api_scheduler.PAGES
+    return await properties_flight.do(key, _load_properties_page, key, priority)
+
+
+async def _load_properties_page(key: tuple, priority: int) -> list:
+    results = await _request_properties_page(key, priority)
+    api_requests.properties_cache.set(key, results)
+    return results
+
+
+async def _refresh_properties_page(key: tuple) -> None:
+    try:
+        await properties_flight.do(key, _load_properties_page, key, api_scheduler.BACKGROUND)
+    except (aiohttp.ClientError, asyncio.TimeoutError, api_scheduler.QuotaExceeded) as ex:
+        logger.error('async refresh properties page - {ex}'.format(ex=ex))
+
+
+async def _request_properties_page(key: tuple, priority: int = api_scheduler.INTERACTIVE) -> list:
+    destination_id, check_in, check_out, sortorder, price_min, price_max, page_number = key
+    querystring = {
+        "destinationId": destination_id, "pageNumber": page_number,
+        "pageSize": api_requests.PROPERTIES_PAGE_SIZE, "checkIn": check_in, "checkOut": check_out,
+        "adults1": "1", "sortOrder": sortorder, "locale": "en_US", "currency": "USD"
+    }
+    if price_min is not None:
+        querystring["priceMin"] = price_min
+    if price_max is not None:
+        querystring["priceMax"] = price_max
+    content = await get_content('properties/list', querystring, priority)
+    return hotels.parse_results(fast_json.iter_items(content, fast_json.RESULTS_PATH))
+
+
+async def get_photo(hotel_id: str) -> dict:
+    """
+    Асинхронный аналог api_requests.get_photo, использует тот же кэш фотографий.
+    :param hotel_id: ID отеля.
+    :return: Словарь с ссылками на фотографии.
+    """
+    hotel_id = str(hotel_id)
+    json_data = api_requests.photos_cache.get(hotel_id)
+    if json_data is not None:
+        return json_data
+
+    json_data = await get('properties/get-hotel-photos', {"id": hotel_id})
+    json_data = {'hotelImages': [
+        {'baseUrl': image['baseUrl'], 'sizes': image['sizes'][:1]}
+        for image in json_data['hotelImages']
+    ]}
+    api_requests.photos_cache.set(hotel_id, json_data)
+    logger.info('Hotel {id} - async get_photo - ok'.format(id=hotel_id))
+    return json_data
+
+
+async def best_deal_request(hotels_number: int, query: list) -> list:
+    """
+    Асинхронный аналог bestdeal.best_deal_request: все отели iter_best_deal одним списком.
+    :param hotels_number: Количество отелей.
+    :param query: Параметры поиска в порядке get_full_info.
+    :return: Список подходящих отелей.
+    """
+    return [hotel async for hotel in iter_best_deal(hotels_number, query)]
+
+
+async def iter_best_deal(hotels_number: int, query: list):
+    """
+    Асинхронный аналог bestdeal.iter_best_deal: запрашивает страницы properties/list
+    окном по bestdeal.PAGE_WINDOW параллельно, проходит их по порядку и отдает каждый
+    подходящий отель, как только пришла его страница. Оставшиеся страницы отменяются,
+    как только набрано hotels_number отелей или превышено максимальное удаление.
+    :param hotels_number: Количество отелей.
+    :param query: Параметры поиска в порядке get_full_info.
+    :return: Асинхронный генератор hotels.Hotel.
+    """
+    started = time.perf_counter()
+    first_ms = None
+    destination_id, check_in, check_out, sortorder, price_min, price_max, \
+        distance_min, distance_max = query
+    distance_min, distance_max = float(distance_min), float(distance_max)
+
+    def fetch(page_number: int) -> asyncio.Task:
+        return asyncio.ensure_future(get_properties_page(
+            destination_id, check_in, check_out, sortorder, page_number, str(price_min), str(price_max)
+        ))
+
+    last_page = min(bestdeal.PAGE_WINDOW, bestdeal.MAX_PAGES)
+    tasks = {page: fetch(page) for page in range(1, last_page + 1)}
+    found = 0
+    page_number = 1
+    finished = False
+    try:
+        while not finished and page_number in tasks:
+            results = await tasks.pop(page_number)
+            if not results:
+                break
+            matched = []
+            for i_hotel in results:
+                distance = i_hotel.distance
+                if distance is None:
+                    # без удаления отель нельзя проверить фильтром bestdeal
+                    continue
+                if distance > distance_max:
+                    finished = True
+                    break
+                if distance >= distance_min:
+                    matched.append(i_hotel)
+                    if found + len(matched) >= hotels_number:
+                        finished = True
+                        break
+            page_number += 1
+            if finished:
+                # отмена доходит до запроса в properties_flight, если его больше никто не ждет
+                for task in tasks.values():
+                    task.cancel()
+            elif last_page < bestdeal.MAX_PAGES:
+                last_page += 1
+                tasks[last_page] = fetch(last_page)
+            for i_hotel in matched:
+                if first_ms is None:
+                    first_ms = round((time.perf_counter() - started) * 1000)
+                found += 1
+                yield i_hotel
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+    stats = {'chat_id': None, 'pages_used': page_number - 1, 'pages_requested': last_page,
+             'hotels': found, 'first_ms': first_ms,
+             'ms': round((time.perf_counter() - started) * 1000)}
+    bestdeal.search_stats.append(stats)
+    logger.info('async best_deal_request - ok, pages {pages_used}/{pages_requested}, '
+                'hotels {hotels}, first {first_ms} ms, {ms} ms'.format(**stats))
+
+
+async def iter_properties_list(hotels_number: int, query: list):
+    """
+    Асинхронный генератор отелей команд lowprice и highprice для того же
+    потокового показа, что и iter_best_deal: отели первой страницы get_properties_page.
+    :param hotels_number: Количество отелей.
+    :param query: Параметры поиска в порядке get_full_info.
+    :return: Асинхронный генератор hotels.Hotel.
+    """
+    destination_id, check_in, check_out, sortorder = query[:4]
+    for i_hotel in (await get_properties_page(destination_id, check_in, check_out,
+                                              sortorder))[:hotels_number]:
+        yield i_hotel
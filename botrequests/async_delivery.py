@@ -0,0 +1,230 @@
+"""
+Асинхронная отправка карточек отелей для asyncio режима бота (async_main.py):
+изображения загружаются параллельно, карточки отправляются в исходном порядке
+по мере поиска с ограничением частоты и повтором после ответа 429, уже отправлявшиеся
+изображения отправляются по file_id.
+"""
+import asyncio
+
+import aiohttp
+from decouple import config
+from loguru import logger
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+
+from botrequests.cache import TTLCache
+from botrequests.delivery import MAX_IMAGE_BYTES
+from botrequests.file_ids import file_ids
+from botrequests.rate_limit import Pauses, TokenBucket
+
+
+class AsyncDeliveryEngine:
+    """
+    Асинхронный аналог delivery.DeliveryEngine: карточки чата отправляются по одной
+    в порядке показа, отчет on_sent идет отдельной задачей.
+    """
+
+    def __init__(self, bot: AsyncTeleBot) -> None:
+        """
+        :param bot: Экземпляр асинхронного бота.
+        """
+        self.bot = bot
+        self.max_retries = config('telegram_max_retries', default=3, cast=int)
+        self.global_bucket = TokenBucket(
+            rate=config('telegram_global_rate', default=30, cast=float),
+            capacity=config('telegram_global_rate', default=30, cast=float)
+        )
+        self.chat_rate = config('telegram_chat_rate', default=1, cast=float)
+        self.chat_burst = config('telegram_chat_burst', default=20, cast=float)
+        self.chat_buckets = TTLCache(maxsize=10000, ttl=60)
+        self.chat_pauses = Pauses()
+        self.image_timeout = aiohttp.ClientTimeout(
+            total=config('delivery_image_timeout', default=10, cast=float))
+        self._images = None
+
+    async def deliver(self, chat_id: int, cards, on_sent=None) -> int:
+        """
+        Отправка карточек в чат в исходном порядке, как delivery.DeliveryEngine.deliver:
+        cards читается в отдельной задаче, подготовка каждой карточки запускается,
+        как только она получена, отправка не ждет конца поиска.
+        :param chat_id: ID чата.
+        :param cards: Список, итерируемый объект или асинхронный генератор
+            словарей карточек, None пропускается.
+        :param on_sent: Корутинная функция on_sent(sent), вызывается отдельной задачей
+            после отправленных карточек (промежуточные значения могут пропускаться),
+            последний вызов завершается до возврата из deliver.
+        :return: Количество отправленных карточек.
+        """
+        pending = asyncio.Queue()
+        latest = 0
+        reporter = None
+
+        async def report() -> None:
+            reported = 0
+            while reported != latest:
+                reported = latest
+                try:
+                    await on_sent(reported)
+                except Exception as ex:
+                    logger.error('{id} - async deliver - on_sent - {ex}'.format(id=chat_id, ex=ex))
+
+        async def produce() -> None:
+            try:
+                if hasattr(cards, '__aiter__'):
+                    async for card in cards:
+                        if card is not None:
+                            pending.put_nowait(asyncio.ensure_future(self._prepare(card)))
+                else:
+                    for card in cards:
+                        if card is not None:
+                            pending.put_nowait(asyncio.ensure_future(self._prepare(card)))
+            except Exception as ex:
+                pending.put_nowait(ex)
+            finally:
+                pending.put_nowait(None)
+
+        producer = asyncio.ensure_future(produce())
+        sent = 0
+        error = None
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    error = item
+                    continue
+                card = await item
+                try:
+                    await self.send_card(chat_id, card)
+                except asyncio_helper.ApiTelegramException as ex:
+                    logger.error('{id} - async deliver - {ex}'.format(id=chat_id, ex=ex))
+                else:
+                    sent += 1
+                    if on_sent is not None:
+                        latest = sent
+                        if reporter is None or reporter.done():
+                            reporter = asyncio.ensure_future(report())
+            if reporter is not None:
+                await reporter
+        finally:
+            producer.cancel()
+        if error is not None:
+            raise error
+        return sent
+
+    async def send_card(self, chat_id: int, card: dict):
+        """
+        Отправка одной карточки, как delivery.DeliveryEngine.send_card: по file_id,
+        затем загруженным файлом, при отказе Telegram принять файл - по исходному URL.
+        :param chat_id: ID чата.
+        :param card: Словарь карточки.
+        :return: Отправленное сообщение.
+        """
+        file_id = file_ids.get(card['photo'])
+        if file_id is not None:
+            try:
+                return await self._send_photo(chat_id, card, file_id)
+            except asyncio_helper.ApiTelegramException as ex:
+                if ex.error_code != 400:
+                    raise
+                file_ids.forget(card['photo'])
+
+        photo = card.get('photo_file') or card['photo']
+        try:
+            message = await self._send_photo(chat_id, card, photo)
+        except asyncio_helper.ApiTelegramException:
+            if photo is card['photo']:
+                raise
+            message = await self._send_photo(chat_id, card, card['photo'])
+        file_ids.remember(card['photo'], message)
+        return message
+
+    async def send_photos(self, chat_id: int, urls: list) -> list:
+        """
+        Отправка альбома фотографий, как delivery.DeliveryEngine.send_photos.
+        :param chat_id: ID чата.
+        :param urls: Список URL изображений.
+        :return: Список отправленных сообщений.
+        """
+        known = {url: file_ids.get(url) for url in urls}
+        media = [types.InputMediaPhoto(known[url] or url) for url in urls]
+        try:
+            messages = await self.call(chat_id, self.bot.send_media_group, chat_id, media)
+        except asyncio_helper.ApiTelegramException as ex:
+            if ex.error_code != 400 or not any(known.values()):
+                raise
+            for url, file_id in known.items():
+                if file_id is not None:
+                    file_ids.forget(url)
+            messages = await self.call(chat_id, self.bot.send_media_group, chat_id,
+                                       [types.InputMediaPhoto(url) for url in urls])
+        for url, message in zip(urls, messages):
+            file_ids.remember(url, message)
+        return messages
+
+    async def _send_photo(self, chat_id: int, card: dict, photo):
+        return await self.call(chat_id, self.bot.send_photo, chat_id, photo,
+                               caption=card['caption'], parse_mode=card.get('parse_mode'),
+                               reply_markup=card.get('reply_markup'))
+
+    async def call(self, chat_id: int, method, *args, **kwargs):
+        """
+        Вызов метода бота с учетом ограничений частоты и повтором после 429.
+        :param chat_id: ID чата, для которого считается ограничение.
+        :param method: Корутина бота, например bot.send_photo.
+        :return: Результат метода.
+        """
+        for attempt in range(self.max_retries + 1):
+            wait = self.chat_pauses.remaining(chat_id)
+            if wait:
+                await asyncio.sleep(wait)
+            await self._acquire(self._chat_bucket(chat_id))
+            await self._acquire(self.global_bucket)
+            try:
+                return await method(*args, **kwargs)
+            except asyncio_helper.ApiTelegramException as ex:
+                if ex.error_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = (ex.result_json.get('parameters') or {}).get('retry_after', 1)
+                logger.warning('{id} - telegram 429, retry after {sec} s'.format(
+                    id=chat_id, sec=retry_after))
+                self.chat_pauses.pause(chat_id, retry_after)
+
+    async def close(self) -> None:
+        if self._images is not None:
+            await self._images.close()
+
+    @staticmethod
+    async def _acquire(bucket: TokenBucket) -> None:
+        wait = bucket.try_acquire()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = bucket.try_acquire()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _prepare(self, card: dict) -> dict:
+        """
+        Загрузка изображения карточки. При ошибке карточка отправится по URL.
+        :param card: Словарь карточки.
+        :return: Карточка с загруженным файлом в photo_file.
+        """
+        if card['photo'] in file_ids:
+            return card
+        if self._images is None:
+            self._images = aiohttp.ClientSession(timeout=self.image_timeout)
+        try:
+            async with self._images.get(card['photo']) as response:
+                if response.status == 200:
+                    content = await response.content.read(MAX_IMAGE_BYTES + 1)
+                    if len(content) <= MAX_IMAGE_BYTES:
+                        card['photo_file'] = content
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            logger.warning('delivery - image {url} - {ex}'.format(url=card['photo'], ex=ex))
+        return card
@@ -0,0 +1,176 @@
+"""
+Асинхронная работа с БД для asyncio режима бота (async_main.py) через asyncpg:
+те же таблицы и запросы, что и в postgres_database.
+"""
+import datetime
+import traceback
+
+import asyncpg
+from decouple import config
+from loguru import logger
+
+from botrequests import schema
+
+HISTORY_QUERY = (
+    "SELECT command, datetime, ("
+    "SELECT json_agg(json_build_object('id', hotel->'id', 'name', hotel->'name')) "
+    "FROM json_array_elements(results) AS hotel) AS hotels, seq "
+    "FROM history WHERE id=$1 AND json_typeof(results)='array' {keyset}"
+    "ORDER BY datetime DESC, seq DESC LIMIT {limit};"
+)
+
+_pool = None
+
+
+async def get_pool() -> asyncpg.Pool:
+    """
+    Функция ленивого создания пула подключений asyncpg.
+    :return: Пул подключений.
+    """
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(
+            database=config('database'),
+            user=config('user'),
+            password=config('password'),
+            host=config('host'),
+            port=config('port'),
+            min_size=config('db_pool_min', default=1, cast=int),
+            max_size=config('db_pool_max', default=10, cast=int),
+            timeout=config('db_connect_timeout', default=5, cast=float)
+        )
+    return _pool
+
+
+async def close_pool() -> None:
+    """
+    Функция закрытия пула при остановке бота.
+    :return:
+    """
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def schema_version(connection: asyncpg.Connection) -> int:
+    """
+    Последняя примененная версия схемы.
+    :param connection: Подключение к БД.
+    :return: Номер версии, 0 - если таблицы schema_version еще нет.
+    """
+    if not await connection.fetchval("SELECT to_regclass('schema_version') IS NOT NULL;"):
+        return 0
+    return await connection.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+
+
+async def migrate() -> int:
+    """
+    Функция применения миграций схемы, как postgres_database.migrate.
+    :return: Версия схемы после миграции.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as connection:
+        async with connection.transaction():
+            current = await schema_version(connection)
+            if current >= schema.LATEST:
+                return current
+            await connection.execute("SELECT pg_advisory_xact_lock($1);", schema.LOCK_KEY)
+            await connection.execute(schema.VERSION_TABLE)
+            current = await schema_version(connection)
+            for version, name, statements in schema.pending(current):
+                for statement in statements:
+                    await connection.execute(statement)
+                await connection.execute("INSERT INTO schema_version (version, name) "
+                                         "VALUES ($1, $2);", version, name)
+                logger.info('Схема БД: применена миграция {version} - {name}'.format(
+                    version=version, name=name))
+                current = version
+    return current
+
+
+async def add_user(user_id: int, first_name: str, last_name: str, user_name: str) -> None:
+    """
+    Функция добавления нового пользователя в БД.
+    :return:
+    """
+    pool = await get_pool()
+    try:
+        await pool.execute("INSERT INTO users (id, first_name, last_name, user_name) "
+                           "VALUES ($1, $2, $3, $4);", user_id, first_name, last_name, user_name)
+    except asyncpg.UniqueViolationError as ex:
+        logger.error(ex)
+    else:
+        logger.info('{id} - async post.add_user - ok'.format(id=user_id))
+
+
+async def add_history(user_id: int, sortorder: str, date_time: datetime.datetime,
+                      history_data: str) -> None:
+    """
+    Функция добавления истории в БД.
+    :param user_id: Id пользователя отправившего команду
+    :param sortorder: Команда отправленная пользователям
+    :param date_time: Дата и время. Объект datatime.
+    :param history_data: Результаты отправленные пользователю в формате json.
+    :return:
+    """
+    command = {'DISTANCE_FROM_LANDMARK': 'Bestdeal', 'PRICE': 'Lowprice',
+               'PRICE_HIGHEST_FIRST': 'Highprice'}.get(sortorder, sortorder)
+    pool = await get_pool()
+    try:
+        await pool.execute("INSERT INTO history (id, command, datetime, results) "
+                           "VALUES ($1, $2, $3, $4);", user_id, command, date_time, history_data)
+    except (asyncpg.PostgresError, OSError):
+        logger.error(traceback.format_exc())
+
+
+async def get_history(user_id: int, before: tuple = None, limit: int = 5) -> list:
+    """
+    Функция извлечения страницы истории для пользователя, от новых записей к старым.
+    :param user_id: ID пользователя
+    :param before: Ключ последней показанной записи (datetime, seq), None - первая страница
+    :param limit: Количество записей на странице
+    :return: Список записей (command, datetime, hotels, seq) до limit + 1 штук
+    """
+    pool = await get_pool()
+    if before is None:
+        return await pool.fetch(HISTORY_QUERY.format(keyset='', limit='$2'), user_id, limit + 1)
+    return await pool.fetch(
+        HISTORY_QUERY.format(keyset='AND (datetime, seq) < ($2, $3) ', limit='$4'),
+        user_id, before[0], before[1], limit + 1)
+
+
+async def get_full_info(chat_id: int) -> asyncpg.Record:
+    """
+    Функция извлечения полной информации для запроса.
+    :param chat_id: ID пользователя
+    :return: Запись в том же порядке полей, что и postgres_database.get_full_info
+    """
+    pool = await get_pool()
+    return await pool.fetchrow(
+        "SELECT destination_id, check_in, check_out, command, "
+        "price_min, price_max, distance_min,"
+        "distance_max FROM users WHERE id=$1", chat_id
+    )
+
+
+async def save_search(chat_id: int, query: list) -> None:
+    """
+    Функция сохранения всех параметров поиска одним запросом (upsert).
+    :param chat_id: ID пользователя
+    :param query: Список параметров в порядке get_full_info
+    :return:
+    """
+    values = [round(value) if isinstance(value, float) else value for value in query]
+    pool = await get_pool()
+    await pool.execute(
+        "INSERT INTO users (id, destination_id, check_in, check_out, command, "
+        "price_min, price_max, distance_min, distance_max) "
+        "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) "
+        "ON CONFLICT (id) DO UPDATE SET destination_id=EXCLUDED.destination_id, "
+        "check_in=EXCLUDED.check_in, check_out=EXCLUDED.check_out, "
+        "command=EXCLUDED.command, price_min=EXCLUDED.price_min, "
+        "price_max=EXCLUDED.price_max, distance_min=EXCLUDED.distance_min, "
+        "distance_max=EXCLUDED.distance_max;",
+        chat_id, *values
+    )
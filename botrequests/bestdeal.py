@@ -1,65 +1,132 @@
-import main
-import telebot
-import re
+"""
+Реквест команды bestdeal: отели в заданном диапазоне цены и удаления от центра.
+Страницы properties/list (сортировка по удалению) запрашиваются окном
+по несколько штук параллельно, обрабатываются по порядку, и поиск
+останавливается, как только отели выходят за максимальное удаление.
+Отели отдаются генератором по мере прихода страниц.
+"""
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 from decouple import config
-import json
+from loguru import logger
 
-bot = telebot.TeleBot(config('Token'))
+from botrequests import api_requests, api_scheduler, metrics
 
+# Сколько страниц запрашивается одновременно и сколько всего страниц можно пройти за поиск
+PAGE_WINDOW = config('bestdeal_page_window', default=3, cast=int)
+MAX_PAGES = config('bestdeal_max_pages', default=20, cast=int)
 
-def best_deal_request(chat_id, hotels_number, query):
-    try:
-        url = "https://hotels4.p.rapidapi.com/properties/list"
-        hotels_list = list()
-        rapid_api_key = str(config('rapid_api_key'))
+# Статистика последних поисков: страницы и время, для подбора PAGE_WINDOW
+search_stats = deque(maxlen=config('bestdeal_stats_size', default=100, cast=int))
+
+_executor = ThreadPoolExecutor(max_workers=config('bestdeal_workers', default=8, cast=int),
+                               thread_name_prefix='bestdeal')
 
-        destination_id = str(query[0])
-        check_in = str(query[1])
-        check_out = str(query[2])
-        sortorder = query[3]
-        price_min = query[4]
-        price_max = query[5]
-        page_number = '1'
-        page_size = hotels_number
-        distance_min = round(float(query[6]) / 1, 609344498)
-        distance_max = round(float(query[7]) / 1, 609344498)
 
-        headers = {
-            'x-rapidapi-host': "hotels4.p.rapidapi.com",
-            'x-rapidapi-key': rapid_api_key
-        }
+@metrics.STAGES.timed
+def best_deal_request(chat_id: int, hotels_number: int, query: list) -> [list, None]:
+    """
+    Функция реквест-запрос команды bestdeal: все отели iter_best_deal одним списком.
+    :param chat_id: ID пользователя.
+    :param hotels_number: Количество отелей.
+    :param query: Список необходимых для запроса переменных.
+    :return: Список подходящих отелей или None, если ничего не найдено.
+    :raises api_scheduler.QuotaExceeded: Если месячная квота api исчерпана.
+    :raises requests.exceptions.Timeout: Если api не ответил вовремя.
+    """
+    return list(iter_best_deal(chat_id, hotels_number, query)) or None
 
-        querystring = {
-            "destinationId": destination_id, "pageNumber": page_number, "pageSize": page_size, "checkIn": check_in,
-            "checkOut": check_out, "adults1": "1", "priceMin": price_min, "priceMax": price_max,
-            "sortOrder": sortorder, "locale": "en_US", "currency": "USD"
-        }
 
-        while len(hotels_list) < hotels_number:
-            try:
-                response = requests.request("GET", url, headers=headers, params=querystring, timeout=50)
-                json_data = json.loads(response.text)
-                results = json_data['data']['body']['searchResults']['results']
-                if not results:
-                    bot.register_next_step_handler_by_chat_id(chat_id, main.request_mistake, user_id=chat_id)
-                for i_hotel in results:
-                    distance = re.findall(r'\d[,.]?\d', i_hotel['landmarks'][0]['distance'])[0].replace(',', '.')
-                    if float(distance) > float(distance_max):
-                        raise ValueError('Превышено максимальное расстояние от центра города')
-                    elif float(distance) >= int(distance_min):
-                        hotels_list.append(i_hotel)
+def iter_best_deal(chat_id: int, hotels_number: int, query: list):
+    """
+    Генератор отелей команды bestdeal: отдает каждый подходящий отель,
+    как только пришла его страница, не дожидаясь остальных страниц.
+    Запрашивает страницы окном по PAGE_WINDOW параллельно, проходит их по порядку
+    и отбирает отели с удалением от distance_min до distance_max. Как только удаление
+    превысило distance_max или набралось hotels_number отелей, оставшиеся
+    страницы отменяются.
+    :param chat_id: ID пользователя.
+    :param hotels_number: Количество отелей.
+    :param query: Список необходимых для запроса переменных.
+    :return: Генератор hotels.Hotel.
+    :raises api_scheduler.QuotaExceeded: Если месячная квота api исчерпана.
+    :raises requests.exceptions.Timeout: Если api не ответил вовремя, сообщение
+        пользователю отправляет вызывающий код.
+    """
+    started = time.perf_counter()
+    first_ms = None
+    destination_id = str(query[0])
+    check_in = str(query[1])
+    check_out = str(query[2])
+    sortorder = query[3]
+    price_min = str(query[4])
+    price_max = str(query[5])
+    distance_min = float(query[6])
+    distance_max = float(query[7])
 
-                querystring['pageNumber'] = str(int(querystring.get('pageNumber')) + 1)
+    def fetch(page_number: int) -> list:
+        return api_requests.get_properties_page(destination_id, check_in, check_out, sortorder,
+                                                page_number, price_min, price_max)
+
+    found = 0
+    futures = {}
+    page_number = 1
+    pages_submitted = 0
+    finished = False
+    try:
+        for pages_submitted in range(1, min(PAGE_WINDOW, MAX_PAGES) + 1):
+            futures[pages_submitted] = _executor.submit(fetch, pages_submitted)
 
-            except ValueError:
+        while not finished and page_number in futures:
+            results = futures.pop(page_number).result()
+            if not results:
                 break
-    except requests.exceptions.Timeout:
-        bot.send_message(chat_id, "Превышено максимальное ожидание от сервера. Попробуйте чуть позже")
+            matched = []
+            for i_hotel in results:
+                distance = i_hotel.distance
+                if distance is None:
+                    # без удаления отель нельзя проверить фильтром bestdeal
+                    continue
+                if distance > distance_max:
+                    finished = True
+                    break
+                if distance >= distance_min:
+                    matched.append(i_hotel)
+                    if found + len(matched) >= hotels_number:
+                        finished = True
+                        break
+            page_number += 1
+            if finished:
+                # дальше страницы не нужны, они отменяются до отправки отелей
+                for future in futures.values():
+                    future.cancel()
+            elif pages_submitted < MAX_PAGES:
+                # следующая страница окна запрашивается, только когда эта страница
+                # показала, что поиск не закончен
+                pages_submitted += 1
+                futures[pages_submitted] = _executor.submit(fetch, pages_submitted)
+            for i_hotel in matched:
+                if first_ms is None:
+                    first_ms = round((time.perf_counter() - started) * 1000)
+                found += 1
+                yield i_hotel
 
-    except Exception as ex:
-        print(ex)
+    except (api_scheduler.QuotaExceeded, requests.exceptions.Timeout):
+        raise
+    except (requests.exceptions.RequestException, KeyError, IndexError, AttributeError, ValueError):
+        logger.error(traceback.format_exc())
+        return
+    finally:
+        for future in futures.values():
+            future.cancel()
 
-    else:
-        main.logger.info(str(chat_id)," - best_deal_request - ok" )
-        return results
+    stats = {'chat_id': chat_id, 'pages_used': page_number - 1, 'pages_requested': pages_submitted,
+             'hotels': found, 'first_ms': first_ms,
+             'ms': round((time.perf_counter() - started) * 1000)}
+    search_stats.append(stats)
+    logger.info('{chat_id} - best_deal_request - ok, pages {pages_used}/{pages_requested}, '
+                'hotels {hotels}, first {first_ms} ms, {ms} ms'.format(**stats))
@@ -0,0 +1,127 @@
+"""
+Кэш в памяти процесса с ограничением по времени жизни (TTL)
+и вытеснением давно неиспользуемых записей (LRU).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Потокобезопасный TTL/LRU кэш.
+    Размер ограничен количеством записей maxsize и, при наличии weigher,
+    суммарным весом max_weight (например приблизительным размером в байтах).
+    Считает попадания и промахи для мониторинга.
+    При stale_ttl > 0 просроченные записи еще stale_ttl секунд доступны
+    через get_entry, чтобы их можно было отдать и обновить в фоне.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, max_weight: int = None, weigher=None,
+                 stale_ttl: float = 0) -> None:
+        """
+        :param maxsize: Максимальное количество записей.
+        :param ttl: Время жизни записи в секундах.
+        :param max_weight: Максимальный суммарный вес записей.
+        :param weigher: Функция веса записи weigher(value) -> int.
+        :param stale_ttl: Сколько секунд после истечения TTL запись еще можно отдать устаревшей.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_weight = max_weight
+        self.weigher = weigher
+        self.hits = 0
+        self.misses = 0
+        self._weight = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Получение значения по ключу. Просроченная запись удаляется и считается промахом.
+        :param key: Ключ.
+        :param default: Значение при отсутствии записи.
+        :return: Значение из кэша или default.
+        """
+        value, fresh = self.get_entry(key, allow_stale=False)
+        if fresh:
+            return value
+        return default
+
+    def get_entry(self, key, allow_stale: bool = True) -> tuple:
+        """
+        Получение значения вместе с признаком свежести.
+        Устаревшая запись в пределах stale_ttl возвращается с признаком False.
+        :param key: Ключ.
+        :param allow_stale: Отдавать ли устаревшую запись.
+        :return: Кортеж (значение или None, True если запись не просрочена).
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                now = time.monotonic()
+                if item[0] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return item[1], True
+                if item[0] + self.stale_ttl > now:
+                    if allow_stale:
+                        self._data.move_to_end(key)
+                        self.hits += 1
+                        return item[1], False
+                else:
+                    self._remove(key)
+            self.misses += 1
+            return None, False
+
+    def set(self, key, value) -> None:
+        """
+        Запись значения в кэш, при переполнении вытесняются самые старые записи.
+        :param key: Ключ.
+        :param value: Значение.
+        :return:
+        """
+        weight = self.weigher(value) if self.weigher else 0
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + self.ttl, value, weight)
+            self._weight += weight
+            while self._data and (len(self._data) > self.maxsize or
+                                  (self.max_weight is not None and self._weight > self.max_weight)):
+                self._remove(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        """
+        Удаление записи из кэша.
+        :param key: Ключ.
+        :param default: Значение при отсутствии записи.
+        :return: Удаленное значение или default.
+        """
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def stats(self) -> dict:
+        """
+        Статистика кэша.
+        :return: Словарь с количеством попаданий, промахов, записей и суммарным весом.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'weight': self._weight}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _remove(self, key):
+        _, value, weight = self._data.pop(key)
+        self._weight -= weight
+        return value
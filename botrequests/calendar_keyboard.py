@@ -0,0 +1,83 @@
+"""
+Календарь выбора дат заезда и выезда на telegram_bot_calendar.
+Библиотека (вместе с Babel) импортируется при первом показе календаря,
+а не при запуске бота: фильтры callback обработчиков проверяют только
+префикс callback_data и библиотеку не используют.
+Клавиатура полностью определяется календарем, минимальной датой и callback_data
+(шаг и страница), поэтому готовые клавиатуры запоминаются в LRU кэше и повторные
+нажатия не строят календарь заново.
+"""
+import datetime
+
+from decouple import config
+
+from botrequests import metrics
+from botrequests.cache import TTLCache
+
+# Префикс callback_data кнопок календаря telegram_bot_calendar: cbcal_<calendar_id>_...
+CALLBACK_PREFIX = 'cbcal'
+LOCALE = 'ru'
+
+# Клавиатуры: (calendar_id, locale, min_date, текущая дата или callback_data) -> результат
+keyboards_cache = TTLCache(
+    maxsize=config('calendar_cache_size', default=4096, cast=int),
+    ttl=24 * 60 * 60
+)
+metrics.register_cache('calendar', keyboards_cache)
+
+
+def callback_filter(calendar_id: int):
+    """
+    Фильтр callback_query_handler для календаря, как DetailedTelegramCalendar.func.
+    :param calendar_id: ID календаря (1 - заезд, 2 - выезд).
+    :return: Функция-фильтр callback_query.
+    """
+    prefix = '{}_{}'.format(CALLBACK_PREFIX, calendar_id)
+    return lambda callback_query: callback_query.data.startswith(prefix)
+
+
+def build(calendar_id: int, min_date: datetime.date) -> tuple:
+    """
+    Первая клавиатура календаря (выбор года).
+    :param calendar_id: ID календаря.
+    :param min_date: Минимальная дата, которую можно выбрать.
+    :return: Клавиатура и текст сообщения к ней.
+    """
+    # первая страница зависит от текущей даты, она входит в ключ
+    key = (calendar_id, LOCALE, min_date, datetime.date.today())
+    cached = keyboards_cache.get(key)
+    if cached is not None:
+        return cached
+
+    from telegram_bot_calendar import DetailedTelegramCalendar, LSTEP
+
+    calendar, step = DetailedTelegramCalendar(
+        calendar_id=calendar_id, locale=LOCALE, min_date=min_date
+    ).build()
+    cached = calendar, 'Выберите {}'.format(LSTEP[step])
+    keyboards_cache.set(key, cached)
+    return cached
+
+
+def process(calendar_id: int, min_date: datetime.date, data: str) -> tuple:
+    """
+    Обработка нажатия кнопки календаря.
+    :param calendar_id: ID календаря.
+    :param min_date: Минимальная дата, которую можно выбрать.
+    :param data: callback_data нажатой кнопки.
+    :return: Выбранная дата (или None), следующая клавиатура (или None)
+        и текст сообщения к ней.
+    """
+    cache_key = (calendar_id, LOCALE, min_date, data)
+    cached = keyboards_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    from telegram_bot_calendar import DetailedTelegramCalendar, LSTEP
+
+    result, key, step = DetailedTelegramCalendar(
+        calendar_id=calendar_id, locale=LOCALE, min_date=min_date
+    ).process(data)
+    cached = result, key, 'Выберите {}'.format(LSTEP[step]) if key else None
+    keyboards_cache.set(cache_key, cached)
+    return cached
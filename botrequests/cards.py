@@ -0,0 +1,134 @@
+"""
+Подготовка сообщений для пользователя, общая для обычного и asyncio режимов бота:
+    Карточка отеля
+    Ссылки на фотографии отеля
+    Сообщение истории поиска
+    Ответ на inline запрос с местоположениями
+"""
+import datetime
+import random
+import re
+
+import telebot.types
+
+from botrequests.hotels import Hotel
+
+SIZE_PATTERN = re.compile(r'{size}.jpg')
+
+
+def hotel_card(hotel: Hotel) -> dict:
+    """
+    Функция подготовки карточки отеля.
+    :param hotel: Отель
+    :return: Словарь карточки (photo, caption, parse_mode, reply_markup)
+    """
+    hotel_id = hotel.id
+    message_text = f'Hotel ID: {hotel_id}\n' \
+                   f'Name: {hotel.name}\n' \
+                   f'Start rating: {hotel.star_rating}\n' \
+                   f'Address: {hotel.address}\n' \
+                   f'Price: {hotel.price} ' \
+                   f'Total price: {hotel.total_price}'
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
+
+    url = 'https://hotels.com/ho{id}'.format(id=hotel_id)
+    url_button = telebot.types.InlineKeyboardButton(text="Перейти на Hotels.com", url=url)
+
+    inline_button_1 = telebot.types.InlineKeyboardButton(
+        text='Хочу фотографии!', callback_data='q{hotel_id}'.format(hotel_id=hotel_id)
+    )
+    keyboard.add(inline_button_1, url_button)
+    return {'photo': hotel.thumbnail, 'caption': message_text,
+            'parse_mode': 'HTML', 'reply_markup': keyboard}
+
+
+def photo_urls(json_data: dict, number: int) -> list:
+    """
+    Функция выбора случайных фотографий отеля.
+    :param json_data: Словарь с фотографиями из get_photo
+    :param number: Количество фотографий
+    :return: Список ссылок на фотографии
+    """
+    urls = []
+    for _ in range(number):
+        image = random.choice(json_data['hotelImages'])
+        suffix = '{}.jpg'.format(image['sizes'][0]['suffix'])
+        urls.append(SIZE_PATTERN.sub(suffix, image['baseUrl']))
+    return urls
+
+
+def more_photos_keyboard(hotel_id: str) -> telebot.types.InlineKeyboardMarkup:
+    """
+    Клавиатура с кнопкой "Еще фотографий!" для отеля.
+    :param hotel_id: ID отеля
+    :return: Inline клавиатура
+    """
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
+    keyboard.add(telebot.types.InlineKeyboardButton(
+        text='Еще фотографий!', callback_data='q{hotel_id}'.format(hotel_id=hotel_id)))
+    return keyboard
+
+
+def history_cursor(date_time, seq: int) -> str:
+    """
+    Функция подготовки callback_data кнопки "Показать еще" истории.
+    :param date_time: Дата и время последней показанной записи
+    :param seq: seq последней показанной записи
+    :return: callback_data вида n<datetime>|<seq>
+    """
+    return 'n{}|{}'.format(date_time.isoformat(), seq)
+
+
+def parse_history_cursor(data: str) -> tuple:
+    """
+    Функция разбора callback_data кнопки "Показать еще" истории.
+    Кнопки, отправленные до появления seq, содержат только дату.
+    :param data: callback_data вида n<datetime>|<seq>
+    :return: Ключ (datetime, seq) для postgres_database.get_history
+    """
+    date_time, _, seq = data[1:].partition('|')
+    return datetime.datetime.fromisoformat(date_time), int(seq) if seq else 0
+
+
+def history_message(command: str, date_time, hotels: list) -> tuple:
+    """
+    Функция подготовки сообщения с одной записью истории.
+    :param command: Команда поиска
+    :param date_time: Дата и время поиска
+    :param hotels: Список отелей с полями id и name
+    :return: Кортеж (текст сообщения, inline клавиатура со ссылками на отели)
+    """
+    keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
+    hotels_name = []
+
+    for hotel in hotels:
+        url = 'https://hotels.com/ho{id}'.format(id=hotel['id'])
+        url_button = telebot.types.InlineKeyboardButton(text=hotel['name'], url=url)
+        hotels_name.append(hotel['name'])
+        keyboard.add(url_button)
+
+    hotels_name = ", ".join(hotels_name)
+    text_message = f"Command: {command}\n" \
+                   f"Date and Time: {date_time}\n" \
+                   f"Hotel name: {hotels_name}"
+    return text_message, keyboard
+
+
+def inline_destinations(captions: list) -> list:
+    """
+    Функция подготовки ответа на inline запрос: местоположение с кнопками команд поиска,
+    кнопки обрабатываются так же, как выбор местоположения после команды.
+    :param captions: Список пар (подпись, destinationId)
+    :return: Список InlineQueryResultArticle
+    """
+    results = []
+    for caption, destination_id in captions:
+        keyboard = telebot.types.InlineKeyboardMarkup(row_width=3)
+        keyboard.add(*[telebot.types.InlineKeyboardButton(
+            text=text, callback_data='{} {}'.format(command, destination_id))
+            for text, command in (('Lowprice', 'l'), ('Highprice', 'h'), ('Bestdeal', 'b'))])
+        results.append(telebot.types.InlineQueryResultArticle(
+            id=str(destination_id), title=caption,
+            input_message_content=telebot.types.InputTextMessageContent(caption),
+            reply_markup=keyboard))
+    return results
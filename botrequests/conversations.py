@@ -0,0 +1,197 @@
+"""
+Сохранение незавершенных диалогов в БД, чтобы после перезапуска бота они продолжались
+с того же шага:
+    Следующий шаг (register_next_step_handler) хранится как имя обработчика и его kwargs
+    Вместе с ним хранится сессия мастера поиска
+    Изменения по чатам объединяются и записываются фоновым потоком пачкой
+    При запуске все диалоги загружаются одним запросом, а в многопроцессном режиме
+    диалог чата загружается процессом-обработчиком при первом обновлении этого чата
+"""
+import atexit
+import datetime
+import json
+import threading
+import time
+
+from decouple import config
+from loguru import logger
+from telebot import Handler
+from telebot.handler_backends import MemoryHandlerBackend
+
+from botrequests import postgres_database, sessions
+from botrequests.cache import TTLCache
+
+
+class ConversationStore:
+    """
+    Отложенная запись состояния диалогов: отмечаются только изменившиеся чаты,
+    их текущее состояние читается и сохраняется при записи.
+    """
+
+    def __init__(self, flush_interval: float, max_age: float) -> None:
+        """
+        :param flush_interval: Через сколько секунд после изменения состояние записывается в БД.
+        :param max_age: Возраст в секундах, после которого диалог не восстанавливается
+            (как TTL сессии).
+        """
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+        self.backend = None
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        # Чаты, диалоги которых загружены этим процессом (ensure_loaded)
+        self._loaded = TTLCache(maxsize=config('session_store_size', default=100000, cast=int),
+                                ttl=max_age)
+
+    def mark(self, chat_id: int) -> None:
+        """
+        Отметка, что состояние диалога чата изменилось.
+        :param chat_id: ID чата.
+        """
+        with self._lock:
+            self._dirty.add(chat_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='conversations',
+                                                daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def flush(self) -> None:
+        """
+        Запись всех отмеченных чатов: чаты со следующим шагом или сессией сохраняются,
+        остальные удаляются.
+        """
+        with self._lock:
+            chat_ids, self._dirty = self._dirty, set()
+        if not chat_ids or self.backend is None:
+            return
+        now = datetime.datetime.now()
+        rows = []
+        deleted = []
+        for chat_id in chat_ids:
+            handlers = self.backend.dump(chat_id)
+            session = sessions.peek_session(chat_id)
+            if not handlers and session is None:
+                deleted.append(chat_id)
+                continue
+            rows.append((chat_id, json.dumps(handlers),
+                         json.dumps(session.as_dict() if session is not None else None), now))
+        if not postgres_database.save_conversations(rows, deleted):
+            with self._lock:
+                self._dirty.update(chat_ids)
+
+    def restore(self, namespace: dict) -> int:
+        """
+        Загрузка диалогов из БД при запуске бота.
+        :param namespace: Словарь, в котором ищутся обработчики по имени (globals() модуля бота).
+        :return: Количество восстановленных диалогов.
+        """
+        started = time.perf_counter()
+        count = 0
+        for chat_id, handlers, session in postgres_database.load_conversations(self.max_age):
+            self._apply(chat_id, handlers, session, namespace)
+            count += 1
+        logger.info('conversations - restored {count} in {ms:.0f} ms'.format(
+            count=count, ms=(time.perf_counter() - started) * 1000))
+        return count
+
+    def ensure_loaded(self, chat_id: int, namespace: dict) -> None:
+        """
+        Загрузка диалога чата из БД перед первым обновлением чата в процессе-обработчике.
+        Чат, не получавший обновлений дольше max_age (TTL закрепления за процессом),
+        мог обрабатываться другим процессом, поэтому его состояние в памяти
+        заменяется сохраненным в БД.
+        :param chat_id: ID чата.
+        :param namespace: Словарь, в котором ищутся обработчики по имени (globals() модуля бота).
+        """
+        loaded = self._loaded.get(chat_id) is not None
+        self._loaded.set(chat_id, True)
+        if loaded:
+            return
+        self.backend.handlers.pop(chat_id, None)
+        sessions.forget_session(chat_id)
+        row = postgres_database.load_conversation(chat_id, self.max_age)
+        if row is not None:
+            self._apply(chat_id, row[0], row[1], namespace)
+            logger.debug('{id} - conversations - restored'.format(id=chat_id))
+
+    def _apply(self, chat_id: int, handlers: list, session: dict, namespace: dict) -> None:
+        """
+        Восстановление следующих шагов и сессии чата без отметки об изменении.
+        """
+        if session is not None:
+            sessions.restore_session(chat_id, sessions.SearchSession.from_dict(session))
+        for name, args, kwargs in handlers or ():
+            callback = namespace.get(name)
+            if callback is None:
+                logger.warning('{id} - conversations - unknown handler {name}'.format(
+                    id=chat_id, name=name))
+                continue
+            self.backend.load(chat_id, Handler(callback, *args, **kwargs))
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class PersistentHandlerBackend(MemoryHandlerBackend):
+    """
+    Хранилище следующих шагов TeleBot (next_step_backend) в памяти,
+    каждое изменение которого отмечается в ConversationStore.
+    """
+
+    def __init__(self, store: ConversationStore) -> None:
+        super().__init__()
+        self.store = store
+        store.backend = self
+
+    def register_handler(self, handler_group_id, handler) -> None:
+        super().register_handler(handler_group_id, handler)
+        self.store.mark(handler_group_id)
+
+    def clear_handlers(self, handler_group_id) -> None:
+        super().clear_handlers(handler_group_id)
+        self.store.mark(handler_group_id)
+
+    def get_handlers(self, handler_group_id):
+        handlers = super().get_handlers(handler_group_id)
+        if handlers:
+            self.store.mark(handler_group_id)
+        return handlers
+
+    def load(self, handler_group_id, handler: Handler) -> None:
+        """
+        Добавление восстановленного шага без отметки об изменении.
+        """
+        MemoryHandlerBackend.register_handler(self, handler_group_id, handler)
+
+    def dump(self, handler_group_id) -> list:
+        """
+        Следующие шаги чата в виде json: список [имя обработчика, args, kwargs].
+        Шаги с аргументами, которые нельзя сохранить в json, пропускаются.
+        """
+        result = []
+        for handler in list(self.handlers.get(handler_group_id) or ()):
+            item = [handler.callback.__name__, list(handler.args), handler.kwargs]
+            try:
+                json.dumps(item)
+            except (TypeError, ValueError):
+                logger.warning('{id} - conversations - cannot save {name}'.format(
+                    id=handler_group_id, name=item[0]))
+                continue
+            result.append(item)
+        return result
+
+
+store = ConversationStore(
+    flush_interval=config('conversations_flush_interval', default=0.5, cast=float),
+    max_age=config('session_ttl', default=60 * 60, cast=int)
+)
+handler_backend = PersistentHandlerBackend(store)
+sessions.add_listener(store.mark)
+atexit.register(store.flush)
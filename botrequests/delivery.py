@@ -0,0 +1,260 @@
+"""
+Отправка карточек отелей пользователю:
+    Параллельная подготовка карточек (загрузка изображений) в пуле потоков
+    Отправка в исходном порядке по мере поиска, не дожидаясь всех результатов
+    Ограничение частоты сообщений Telegram: общее и для каждого чата
+    Автоматический повтор после ответа 429 с retry_after
+    Повторная отправка изображений по file_id Telegram вместо URL
+"""
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import telebot
+from decouple import config
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from botrequests import metrics
+from botrequests.cache import TTLCache
+from botrequests.file_ids import file_ids
+from botrequests.rate_limit import Pauses, TokenBucket
+
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+
+class _Progress:
+    """
+    Вызов on_sent(sent) в пуле потоков, вне пути отправки карточек: пока идет
+    один вызов, промежуточные значения пропускаются, вызывается только последнее.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, on_sent) -> None:
+        self.executor = executor
+        self.on_sent = on_sent
+        self.latest = 0
+        self.reported = 0
+        self.future = None
+        self._lock = threading.Lock()
+
+    def update(self, sent: int) -> None:
+        with self._lock:
+            self.latest = sent
+            if self.future is None:
+                self.future = self.executor.submit(self._run)
+
+    def wait(self) -> None:
+        """
+        Ожидание вызова с последним значением.
+        """
+        with self._lock:
+            future = self.future
+        if future is not None:
+            future.result()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if self.reported == self.latest:
+                    self.future = None
+                    return
+                self.reported = self.latest
+            try:
+                self.on_sent(self.reported)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+
+class DeliveryEngine:
+    """
+    Движок отправки сообщений с ограничением частоты.
+    Самая долгая часть отправки карточки - загрузка Telegram'ом изображения по URL,
+    поэтому изображения загружаются заранее параллельно, а в Telegram
+    отправляются уже готовые файлы строго в порядке показа.
+    Карточки одного чата отправляются по одной: Telegram показывает сообщения
+    в порядке получения запросов, и параллельные sendPhoto перемешали бы карточки.
+    Отчет о ходе отправки (on_sent) идет параллельно и не задерживает следующую карточку.
+    """
+
+    def __init__(self, bot: telebot.TeleBot) -> None:
+        """
+        :param bot: Экземпляр бота.
+        """
+        self.bot = bot
+        self.max_retries = config('telegram_max_retries', default=3, cast=int)
+        self.global_bucket = TokenBucket(
+            rate=config('telegram_global_rate', default=30, cast=float),
+            capacity=config('telegram_global_rate', default=30, cast=float)
+        )
+        self.chat_rate = config('telegram_chat_rate', default=1, cast=float)
+        self.chat_burst = config('telegram_chat_burst', default=20, cast=float)
+        self.chat_buckets = TTLCache(maxsize=10000, ttl=60)
+        # пауза после 429 хранится до ее окончания, а не TTL лимитера чата
+        self.chat_pauses = Pauses()
+        workers = config('delivery_workers', default=10, cast=int)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='delivery')
+        self.images = requests.Session()
+        self.images.mount('https://', HTTPAdapter(pool_maxsize=workers))
+        self.image_timeout = config('delivery_image_timeout', default=10, cast=float)
+
+    @metrics.STAGES.timed
+    def deliver(self, chat_id: int, cards, on_sent=None) -> int:
+        """
+        Отправка карточек в чат. cards может быть генератором, который отдает карточки
+        по мере поиска: он читается в отдельном потоке, подготовка каждой карточки
+        запускается, как только она получена, а отправка идет по порядку по мере
+        готовности, не дожидаясь конца поиска. Исключение из cards пробрасывается
+        после отправки уже полученных карточек.
+        :param chat_id: ID чата.
+        :param cards: Итерируемый объект со словарями карточек
+            (photo, caption, reply_markup, parse_mode). None пропускается.
+        :param on_sent: Функция on_sent(sent), вызывается в пуле потоков после отправленных
+            карточек (промежуточные значения могут пропускаться), последний вызов
+            завершается до возврата из deliver.
+        :return: Количество отправленных карточек.
+        """
+        pending = queue.Queue()
+        progress = _Progress(self.executor, on_sent) if on_sent is not None else None
+
+        def produce() -> None:
+            try:
+                for card in cards:
+                    if card is not None:
+                        pending.put(self.executor.submit(self._prepare, card))
+            except Exception as ex:
+                pending.put(ex)
+            finally:
+                pending.put(None)
+
+        threading.Thread(target=produce, name='delivery-source', daemon=True).start()
+        sent = 0
+        error = None
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                error = item
+                continue
+            card = item.result()
+            try:
+                self.send_card(chat_id, card)
+            except telebot.apihelper.ApiTelegramException:
+                logger.error(traceback.format_exc())
+            else:
+                sent += 1
+                if progress is not None:
+                    progress.update(sent)
+        if progress is not None:
+            progress.wait()
+        if error is not None:
+            raise error
+        return sent
+
+    def send_card(self, chat_id: int, card: dict) -> telebot.types.Message:
+        """
+        Отправка одной карточки. Изображение, которое уже отправлялось, отправляется
+        по file_id; если Telegram его не принял, запись удаляется из file_ids.
+        Если заранее загруженный файл не принят, повторяет отправку по исходному URL.
+        :param chat_id: ID чата.
+        :param card: Словарь карточки.
+        :return: Отправленное сообщение.
+        """
+        file_id = file_ids.get(card['photo'])
+        if file_id is not None:
+            try:
+                return self._send_photo(chat_id, card, file_id)
+            except telebot.apihelper.ApiTelegramException as ex:
+                if ex.error_code != 400:
+                    raise
+                file_ids.forget(card['photo'])
+
+        photo = card.get('photo_file') or card['photo']
+        try:
+            message = self._send_photo(chat_id, card, photo)
+        except telebot.apihelper.ApiTelegramException:
+            if photo is card['photo']:
+                raise
+            message = self._send_photo(chat_id, card, card['photo'])
+        file_ids.remember(card['photo'], message)
+        return message
+
+    def send_photos(self, chat_id: int, urls: list) -> list:
+        """
+        Отправка альбома фотографий: уже отправлявшиеся изображения - по file_id.
+        Если Telegram не принял file_id, они удаляются из file_ids и альбом
+        отправляется по URL.
+        :param chat_id: ID чата.
+        :param urls: Список URL изображений.
+        :return: Список отправленных сообщений.
+        """
+        known = {url: file_ids.get(url) for url in urls}
+        media = [telebot.types.InputMediaPhoto(known[url] or url) for url in urls]
+        try:
+            messages = self.call(chat_id, self.bot.send_media_group, chat_id, media)
+        except telebot.apihelper.ApiTelegramException as ex:
+            if ex.error_code != 400 or not any(known.values()):
+                raise
+            for url, file_id in known.items():
+                if file_id is not None:
+                    file_ids.forget(url)
+            messages = self.call(chat_id, self.bot.send_media_group, chat_id,
+                                 [telebot.types.InputMediaPhoto(url) for url in urls])
+        for url, message in zip(urls, messages):
+            file_ids.remember(url, message)
+        return messages
+
+    def _send_photo(self, chat_id: int, card: dict, photo) -> telebot.types.Message:
+        return self.call(chat_id, self.bot.send_photo, chat_id, photo,
+                         caption=card['caption'], parse_mode=card.get('parse_mode'),
+                         reply_markup=card.get('reply_markup'))
+
+    def call(self, chat_id: int, method, *args, **kwargs):
+        """
+        Вызов метода бота с учетом ограничений частоты и повтором после 429.
+        :param chat_id: ID чата, для которого считается ограничение.
+        :param method: Метод бота, например bot.send_photo.
+        :return: Результат метода.
+        """
+        for attempt in range(self.max_retries + 1):
+            wait = self.chat_pauses.remaining(chat_id)
+            if wait:
+                time.sleep(wait)
+            self._chat_bucket(chat_id).acquire()
+            self.global_bucket.acquire()
+            try:
+                return method(*args, **kwargs)
+            except telebot.apihelper.ApiTelegramException as ex:
+                if ex.error_code != 429 or attempt == self.max_retries:
+                    raise
+                retry_after = (ex.result_json.get('parameters') or {}).get('retry_after', 1)
+                logger.warning('{id} - telegram 429, retry after {sec} s'.format(
+                    id=chat_id, sec=retry_after))
+                self.chat_pauses.pause(chat_id, retry_after)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _prepare(self, card: dict) -> dict:
+        """
+        Загрузка изображения карточки. При ошибке карточка отправится по URL.
+        Изображение с известным file_id не загружается.
+        :param card: Словарь карточки.
+        :return: Карточка с загруженным файлом в photo_file.
+        """
+        if card['photo'] in file_ids:
+            return card
+        try:
+            response = self.images.get(card['photo'], timeout=self.image_timeout)
+            if response.ok and len(response.content) <= MAX_IMAGE_BYTES:
+                card['photo_file'] = response.content
+        except requests.exceptions.RequestException as ex:
+            logger.warning('delivery - image {url} - {ex}'.format(url=card['photo'], ex=ex))
+        return card
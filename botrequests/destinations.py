@@ -0,0 +1,267 @@
+"""
+Локальный индекс местоположений для подсказок городов без запроса к api:
+    Пополняется из каждого ответа locations/v2/search и сохраняется на диск
+    Поиск по префиксу названия и по триграммам (с опечатками)
+    Запросы кириллицей транслитерируются в латиницу
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+from decouple import config
+from loguru import logger
+
+TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh',
+    'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+
+# Язык подписей в индексе: индекс пополняется и используется только для этого locale
+LOCALE = 'en_US'
+
+# Сколько совпадений по префиксу просматривается за один поиск
+MAX_PREFIX_MATCHES = 200
+
+
+def transliterate(text: str) -> str:
+    """
+    Транслитерация кириллицы в латиницу, остальные символы не меняются.
+    :param text: Текст.
+    :return: Текст латиницей в нижнем регистре.
+    """
+    return text.lower().translate(TRANSLIT)
+
+
+def normalize(text: str) -> str:
+    """
+    Приведение названия или запроса к ключу индекса: латиница без диакритики,
+    нижний регистр, только буквы и цифры, разделенные одним пробелом.
+    :param text: Текст.
+    :return: Ключ индекса.
+    """
+    text = unicodedata.normalize('NFKD', transliterate(text))
+    text = ''.join(char if char.isalnum() else ' ' for char in text
+                   if not unicodedata.combining(char))
+    return ' '.join(text.split())
+
+
+def trigrams(text: str) -> set:
+    """
+    Триграммы ключа с границами слова, например "  pa", " par", ..., "is ".
+    :param text: Нормализованный текст.
+    :return: Множество триграмм.
+    """
+    padded = '  {} '.format(text)
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+class DestinationIndex:
+    """
+    Потокобезопасный индекс местоположений.
+    Хранит местоположения (destinationId -> подпись и название), ответы на уже
+    заданные запросы и строит в памяти отсортированный список названий для поиска
+    по префиксу и триграммный индекс для поиска с опечатками.
+    """
+
+    def __init__(self, path: str = None, save_interval: float = 60,
+                 max_queries: int = 10000) -> None:
+        """
+        :param path: Файл индекса, None - без сохранения на диск.
+        :param save_interval: Не чаще скольких секунд сохранять изменения на диск.
+        :param max_queries: Сколько ответов на заданные запросы хранить (LRU),
+            местоположения из вытесненных ответов остаются в индексе.
+        """
+        self.path = path
+        self.save_interval = save_interval
+        self.max_queries = max_queries
+        self._entries = {}
+        self._queries = OrderedDict()
+        self._captions = {}
+        self._names = []
+        self._postings = {}
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add_response(self, query: str, json_data: dict) -> None:
+        """
+        Пополнение индекса ответом locations/v2/search.
+        :param query: Запрос пользователя, на который получен ответ.
+        :param json_data: Ответ api.
+        """
+        entities = json_data['suggestions'][0]['entities']
+        with self._lock:
+            for entity in entities:
+                self._add_entry(str(entity['destinationId']), entity['caption'],
+                                entity.get('name') or entity['caption'])
+            key = normalize(query)
+            self._queries[key] = {
+                'ids': [str(entity['destinationId']) for entity in entities],
+                'moresuggestions': json_data['moresuggestions']
+            }
+            self._queries.move_to_end(key)
+            self._trim_queries()
+            self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def lookup(self, query: str, min_score: float, limit: int = 10) -> [dict, None]:
+        """
+        Ответ на запрос города из индекса в формате api_requests.get_city_suggestions.
+        Ответ есть, если такой запрос уже задавался или лучшее совпадение
+        не хуже min_score, иначе нужен запрос к api.
+        :param query: Запрос пользователя.
+        :param min_score: Минимальная оценка совпадения от 0 до 1.
+        :param limit: Максимальное количество вариантов.
+        :return: Словарь с ключами captions и moresuggestions или None.
+        """
+        key = normalize(query)
+        with self._lock:
+            known = self._queries.get(key)
+            if known is not None:
+                self._queries.move_to_end(key)
+                return {'captions': [(self._entries[destination_id]['caption'], destination_id)
+                                     for destination_id in known['ids'][:limit]],
+                        'moresuggestions': known['moresuggestions']}
+        matches = self.search(query, limit)
+        if not matches or matches[0][0] < min_score:
+            return None
+        return {'captions': [(entry['caption'], entry['id']) for _, entry in matches],
+                'moresuggestions': len(matches)}
+
+    def search(self, query: str, limit: int = 10, min_similarity: float = 0.3) -> list:
+        """
+        Поиск местоположений: совпадение с подписью или уже заданным запросом (1.0),
+        совпадение названия (1.0), префикс названия (от 0.5 до 1.0 по доле совпавшей длины)
+        и похожесть триграмм с коэффициентом Дайса не ниже min_similarity.
+        :param query: Запрос пользователя.
+        :param limit: Максимальное количество результатов.
+        :param min_similarity: Минимальная похожесть для поиска с опечатками.
+        :return: Список пар (оценка, местоположение) по убыванию оценки.
+        """
+        key = normalize(query)
+        if not key:
+            return []
+        scores = {}
+        with self._lock:
+            known = self._queries.get(key)
+            if known is not None:
+                for position, destination_id in enumerate(known['ids']):
+                    scores[destination_id] = 1.0 - position * 1e-6
+            if key in self._captions:
+                scores[self._captions[key]] = 1.0
+
+            start = bisect.bisect_left(self._names, (key, ''))
+            for name, destination_id in self._names[start:start + MAX_PREFIX_MATCHES]:
+                if not name.startswith(key):
+                    break
+                score = 0.5 + 0.5 * len(key) / len(name)
+                scores[destination_id] = max(scores.get(destination_id, 0), score)
+
+            query_grams = trigrams(key)
+            common = Counter()
+            for gram in query_grams:
+                common.update(self._postings.get(gram, ()))
+            for destination_id, count in common.items():
+                entry_grams = self._entries[destination_id]['grams']
+                similarity = 2 * count / (len(query_grams) + entry_grams)
+                if similarity >= min_similarity:
+                    scores[destination_id] = max(scores.get(destination_id, 0), similarity)
+
+            matches = sorted(((score, self._entries[destination_id])
+                              for destination_id, score in scores.items()),
+                             key=lambda item: (-item[0], item[1]['caption']))
+        return matches[:limit]
+
+    def load(self) -> None:
+        """
+        Загрузка индекса из файла, триграммы строятся заново.
+        """
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as ex:
+            logger.error('destinations - cannot load {path} - {ex}'.format(path=self.path, ex=ex))
+            return
+        with self._lock:
+            for destination_id, entry in data.get('destinations', {}).items():
+                self._add_entry(destination_id, entry['caption'], entry['name'])
+            self._queries.update(data.get('queries', {}))
+            self._trim_queries()
+        logger.info('destinations - loaded {count} destinations'.format(count=len(self._entries)))
+
+    def save(self) -> None:
+        """
+        Сохранение индекса в файл, если он изменился. Файл заменяется целиком атомарно.
+        """
+        with self._lock:
+            self._saved_at = time.monotonic()
+            if not self.path or not self._dirty:
+                return
+            data = {
+                'destinations': {destination_id: {'caption': entry['caption'],
+                                                  'name': entry['name']}
+                                 for destination_id, entry in self._entries.items()},
+                'queries': dict(self._queries)
+            }
+            self._dirty = False
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            logger.error('destinations - cannot save {path} - {ex}'.format(path=self.path, ex=ex))
+            with self._lock:
+                self._dirty = True
+
+    def _trim_queries(self) -> None:
+        while len(self._queries) > self.max_queries:
+            self._queries.popitem(last=False)
+
+    def _add_entry(self, destination_id: str, caption: str, name: str) -> None:
+        caption = caption.replace("<span class='highlighted'>", '').replace('</span>', '')
+        old = self._entries.get(destination_id)
+        if old is not None:
+            if old['caption'] == caption and old['name'] == name:
+                return
+            self._remove_entry(destination_id)
+        key = normalize(name)
+        grams = trigrams(key)
+        self._entries[destination_id] = {'id': destination_id, 'caption': caption,
+                                         'name': name, 'key': key, 'grams': len(grams)}
+        self._captions[normalize(caption)] = destination_id
+        bisect.insort(self._names, (key, destination_id))
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(destination_id)
+
+    def _remove_entry(self, destination_id: str) -> None:
+        entry = self._entries.pop(destination_id)
+        self._captions.pop(normalize(entry['caption']), None)
+        index = bisect.bisect_left(self._names, (entry['key'], destination_id))
+        if index < len(self._names) and self._names[index] == (entry['key'], destination_id):
+            del self._names[index]
+        for gram in trigrams(entry['key']):
+            self._postings.get(gram, set()).discard(destination_id)
+
+
+MIN_SCORE = config('destinations_min_score', default=0.85, cast=float)
+
+index = DestinationIndex(
+    path=config('destinations_index_path', default='destinations.json') or None,
+    save_interval=config('destinations_save_interval', default=60, cast=float),
+    max_queries=config('destinations_max_queries', default=10000, cast=int)
+)
+atexit.register(index.save)
@@ -0,0 +1,66 @@
+"""
+Разбор json ответов hotels4 api прямо из байтов ответа, без декодирования в str:
+    orjson, если установлен, иначе стандартный json
+    Потоковый разбор больших страниц properties/list через ijson, если установлен:
+    по одному извлекаются только объекты отелей, дерево всего ответа не строится
+"""
+import io
+import json
+
+from decouple import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Путь к списку отелей в ответе properties/list
+RESULTS_PATH = 'data.body.searchResults.results'
+
+# Ответы не меньше этого размера в байтах разбираются потоково (если установлен ijson)
+STREAM_THRESHOLD = config('json_stream_threshold', default=64 * 1024, cast=int)
+
+
+def backend() -> str:
+    """
+    Используемые библиотеки разбора, для лога и бенчмарков.
+    :return: Например "orjson+ijson" или "json".
+    """
+    name = 'orjson' if orjson is not None else 'json'
+    return name + '+ijson' if ijson is not None else name
+
+
+def loads(content: [bytes, str]):
+    """
+    Разбор json документа целиком.
+    :param content: Тело ответа.
+    :return: Десериализованный json.
+    :raises ValueError: Если тело не является json.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def iter_items(content: bytes, path: str):
+    """
+    Генератор элементов массива, лежащего в документе по пути path (ключи через точку).
+    Большие ответы разбираются потоково через ijson, остальные - через loads.
+    :param content: Тело ответа.
+    :param path: Путь к массиву, например RESULTS_PATH.
+    :return: Генератор элементов массива.
+    :raises KeyError: Если пути нет в документе при разборе через loads,
+        при потоковом разборе генератор просто пуст.
+    """
+    if ijson is not None and len(content) >= STREAM_THRESHOLD:
+        yield from ijson.items(io.BytesIO(content), path + '.item', use_float=True)
+        return
+    data = loads(content)
+    for key in path.split('.'):
+        data = data[key]
+    yield from data
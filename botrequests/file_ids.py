@@ -0,0 +1,160 @@
+"""
+Соответствие URL изображения и file_id Telegram:
+после первой успешной отправки изображение отправляется по file_id,
+и Telegram не загружает его заново. Размер ограничен (LRU), записи устаревают
+по времени и удаляются, если Telegram перестал принимать file_id.
+Хранится на диске в json файле.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from decouple import config
+from loguru import logger
+
+from botrequests import metrics
+
+
+class FileIdStore:
+    """
+    Потокобезопасное LRU хранилище URL -> file_id с сохранением на диск.
+    """
+
+    def __init__(self, path: str = None, maxsize: int = 10000, ttl: float = 30 * 24 * 60 * 60,
+                 save_interval: float = 60) -> None:
+        """
+        :param path: Файл хранилища, None - без сохранения на диск.
+        :param maxsize: Максимальное количество записей.
+        :param ttl: Время жизни записи в секундах.
+        :param save_interval: Не чаще скольких секунд сохранять изменения на диск.
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, url: str) -> bool:
+        with self._lock:
+            item = self._data.get(url)
+            return item is not None and item[1] > time.time()
+
+    def get(self, url: str) -> [str, None]:
+        """
+        file_id для URL изображения.
+        :param url: URL изображения.
+        :return: file_id или None.
+        """
+        with self._lock:
+            item = self._data.get(url)
+            if item is not None and item[1] > time.time():
+                self._data.move_to_end(url)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[url]
+                self._dirty = True
+            self.misses += 1
+            return None
+
+    def set(self, url: str, file_id: str) -> None:
+        """
+        Запись file_id для URL, при переполнении вытесняются давно не использованные записи.
+        :param url: URL изображения.
+        :param file_id: file_id, полученный от Telegram.
+        """
+        with self._lock:
+            self._data[url] = (file_id, time.time() + self.ttl)
+            self._data.move_to_end(url)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def remember(self, url: str, message) -> None:
+        """
+        Запись file_id самого большого размера фотографии из отправленного сообщения.
+        :param url: URL изображения, которое было отправлено.
+        :param message: Сообщение, которое вернул Telegram.
+        """
+        if message is not None and getattr(message, 'photo', None):
+            self.set(url, message.photo[-1].file_id)
+
+    def forget(self, url: str) -> None:
+        """
+        Удаление записи, например если Telegram не принял file_id.
+        :param url: URL изображения.
+        """
+        with self._lock:
+            if self._data.pop(url, None) is not None:
+                self._dirty = True
+        logger.info('file_ids - forget {url}'.format(url=url))
+
+    def stats(self) -> dict:
+        """
+        Статистика для мониторинга, как у TTLCache.stats.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'weight': 0}
+
+    def load(self) -> None:
+        """
+        Загрузка из файла без устаревших записей.
+        """
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError) as ex:
+            logger.error('file_ids - cannot load {path} - {ex}'.format(path=self.path, ex=ex))
+            return
+        now = time.time()
+        with self._lock:
+            for url, (file_id, expires) in data.items():
+                if expires > now:
+                    self._data[url] = (file_id, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def save(self) -> None:
+        """
+        Сохранение в файл, если были изменения. Файл заменяется целиком атомарно.
+        """
+        with self._lock:
+            self._saved_at = time.monotonic()
+            if not self.path or not self._dirty:
+                return
+            data = dict(self._data)
+            self._dirty = False
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(data, file)
+            os.replace(temp_path, self.path)
+        except OSError as ex:
+            logger.error('file_ids - cannot save {path} - {ex}'.format(path=self.path, ex=ex))
+            with self._lock:
+                self._dirty = True
+
+
+file_ids = FileIdStore(
+    path=config('file_ids_path', default='file_ids.json') or None,
+    maxsize=config('file_ids_size', default=10000, cast=int),
+    ttl=config('file_ids_ttl', default=30 * 24 * 60 * 60, cast=int),
+    save_interval=config('file_ids_save_interval', default=60, cast=float)
+)
+atexit.register(file_ids.save)
+metrics.register_cache('file_ids', file_ids)
@@ -0,0 +1,135 @@
+"""
+Отложенная запись истории поиска в БД (write-behind).
+Записи копятся в ограниченной очереди и сохраняются фоновым потоком
+пачками одним INSERT по достижении размера пачки или по таймеру.
+"""
+import atexit
+import queue
+import threading
+import time
+import traceback
+
+from decouple import config
+from loguru import logger
+
+from botrequests import metrics, postgres_database
+
+_STOP = object()
+
+FAILURES = metrics.Counter('bot_history_write_failures_total',
+                           'Неудачные записи пачек истории: retry - повторена, dropped - потеряна',
+                           ('result',))
+
+
+class HistoryWriter:
+    """
+    Фоновый поток записи истории с ограниченной очередью.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int,
+                 retry_delay: float = 1) -> None:
+        """
+        :param batch_size: Максимальный размер пачки для одного INSERT.
+        :param flush_interval: Максимальное время ожидания записи в очереди, секунд.
+        :param max_queue: Максимальный размер очереди.
+        :param retry_delay: Пауза перед повторной записью неудачной пачки, секунд.
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, user_id: int, sortorder: str, date_time, history_data: str) -> None:
+        """
+        Постановка записи истории в очередь. Если очередь переполнена,
+        запись сохраняется сразу, чтобы не терять историю и не расти без ограничений.
+        :param user_id: Id пользователя отправившего команду
+        :param sortorder: Команда отправленная пользователям
+        :param date_time: Дата и время
+        :param history_data: Результаты отправленные пользователю в формате json.
+        :return:
+        """
+        self._ensure_started()
+        row = (user_id, sortorder, date_time, history_data)
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            logger.warning('history_writer - queue is full, writing synchronously')
+            self._write([row], retry=False)
+
+    def stop(self, timeout: float = 10) -> None:
+        """
+        Остановка потока с сохранением всех записей из очереди.
+        :param timeout: Максимальное время ожидания, секунд.
+        :return:
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self.queue.put(_STOP)
+        thread.join(timeout)
+
+    def _ensure_started(self) -> None:
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    if self._thread is not None:
+                        logger.error('history_writer - thread died, restarting')
+                    self._thread = threading.Thread(target=self._run, name='history-writer',
+                                                    daemon=True)
+                    self._thread.start()
+
+    def _write(self, batch: list, retry: bool = True) -> bool:
+        """
+        Запись пачки в БД. Любая ошибка записывается в лог и метрику FAILURES,
+        неудачная пачка повторяется один раз через retry_delay секунд.
+        :param batch: Список записей истории.
+        :param retry: Повторять ли неудачную запись.
+        :return: True, если пачка сохранена.
+        """
+        for attempt in range(2 if retry else 1):
+            if attempt:
+                time.sleep(self.retry_delay)
+            try:
+                if postgres_database.add_history_batch(batch):
+                    return True
+            except Exception:
+                logger.error(traceback.format_exc())
+            if retry and not attempt:
+                FAILURES.inc('retry')
+        FAILURES.inc('dropped')
+        logger.error('history_writer - {count} rows lost'.format(count=len(batch)))
+        return False
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            if batch[0] is _STOP:
+                break
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+            self._write(batch)
+
+
+history_writer = HistoryWriter(
+    batch_size=config('history_batch_size', default=100, cast=int),
+    flush_interval=config('history_flush_interval', default=2, cast=float),
+    max_queue=config('history_queue_size', default=10000, cast=int)
+)
+# при SIGTERM atexit не выполняется, поэтому main.shutdown останавливает запись явно
+atexit.register(history_writer.stop)
+metrics.register_gauge('bot_history_queue_size', 'Записи истории в очереди на запись',
+                       history_writer.queue.qsize)
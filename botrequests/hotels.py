@@ -0,0 +1,121 @@
+"""
+Компактная модель отеля: из объекта properties/list один раз при получении страницы
+извлекаются только поля, которые нужны карточке, фильтру bestdeal и истории.
+Дальше по всем этапам (кэш страниц, карточки, история) передается Hotel.
+"""
+import re
+
+from loguru import logger
+
+MILE_KM = 1.609344
+DISTANCE_PATTERN = re.compile(r'\d+(?:[.,]\d+)?')
+
+
+class Hotel:
+    """
+    Отель из properties/list с полями, которые использует бот.
+    """
+    __slots__ = ('id', 'name', 'star_rating', 'address', 'price', 'total_price',
+                 'distance', 'thumbnail')
+
+    def __init__(self, id: int, name: str, star_rating: float, address: str, price: str,
+                 total_price: str, distance: [float, None], thumbnail: str) -> None:
+        """
+        :param id: ID отеля.
+        :param name: Название.
+        :param star_rating: Количество звезд.
+        :param address: Адрес (улица и дом).
+        :param price: Цена за ночь, строкой как в api, например "$120".
+        :param total_price: Цена за весь период.
+        :param distance: Удаление от центра в километрах, None - если api его не отдал.
+        :param thumbnail: URL миниатюры для карточки.
+        """
+        self.id = id
+        self.name = name
+        self.star_rating = star_rating
+        self.address = address
+        self.price = price
+        self.total_price = total_price
+        self.distance = distance
+        self.thumbnail = thumbnail
+
+    def __repr__(self) -> str:
+        return 'Hotel(id={!r}, name={!r})'.format(self.id, self.name)
+
+    def as_dict(self) -> dict:
+        """
+        Запись для истории и json.
+        :return: Словарь с полями отеля, id и name под теми же ключами, что в api.
+        """
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Hotel':
+        """
+        Отель из записи as_dict.
+        :param data: Словарь с полями отеля.
+        :return: Hotel.
+        """
+        return cls(**{field: data[field] for field in cls.__slots__})
+
+
+def parse_distance(text: str) -> float:
+    """
+    Функция получения удаления отеля от центра в километрах.
+    Api отдает расстояние строкой вида "1.2 miles" или "0,8 km".
+    :param text: Расстояние из landmarks.
+    :return: Удаление в километрах.
+    """
+    distance = float(DISTANCE_PATTERN.search(text).group().replace(',', '.'))
+    if 'mile' in text:
+        distance *= MILE_KM
+    return distance
+
+
+def hotel_distance(result: dict) -> [float, None]:
+    """
+    Функция получения удаления отеля от центра из первого landmark. Удаление нужно
+    только фильтру bestdeal, поэтому его отсутствие не делает отель некорректным.
+    :param result: Объект с отелем из properties/list.
+    :return: Удаление в километрах или None.
+    """
+    try:
+        return parse_distance(result['landmarks'][0]['distance'])
+    except (KeyError, IndexError, TypeError, AttributeError, ValueError):
+        return None
+
+
+def parse_hotel(result: dict) -> Hotel:
+    """
+    Функция разбора одного отеля из properties/list.
+    :param result: Объект с отелем из properties/list.
+    :return: Hotel.
+    :raises KeyError: Если у отеля нет необходимых полей.
+    """
+    price = result['ratePlan']['price']
+    return Hotel(
+        id=result['id'],
+        name=result['name'],
+        star_rating=result['starRating'],
+        address=result['address']['streetAddress'],
+        price=price['current'],
+        total_price=price['fullyBundledPricePerStay'].replace('&nbsp;', ' '),
+        distance=hotel_distance(result),
+        thumbnail=result['optimizedThumbUrls']['srpDesktop']
+    )
+
+
+def parse_results(results) -> list:
+    """
+    Функция разбора страницы properties/list. Отели без необходимых полей
+    пропускаются, как раньше пропускались их карточки.
+    :param results: Список или генератор объектов с отелями из properties/list.
+    :return: Список Hotel в исходном порядке.
+    """
+    hotels = []
+    for result in results:
+        try:
+            hotels.append(parse_hotel(result))
+        except (KeyError, IndexError, TypeError, AttributeError, ValueError) as ex:
+            logger.error('hotels - skip {id} - {ex!r}'.format(id=result.get('id'), ex=ex))
+    return hotels
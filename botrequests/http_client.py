@@ -0,0 +1,118 @@
+"""
+Общий HTTP клиент для запросов к hotels4.p.rapidapi.com:
+    Одна сессия requests с keep-alive и пулом соединений
+    Таймауты для каждого метода api
+    Повтор идемпотентных GET запросов с экспоненциальной задержкой и jitter
+    Очередь с приоритетами и учетом квоты RapidAPI (api_scheduler), повтор после 429
+"""
+import random
+import threading
+
+import requests
+from decouple import config
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from botrequests import api_scheduler, metrics
+
+API_HOST = "hotels4.p.rapidapi.com"
+BASE_URL = config('api_base_url', default="https://{host}/".format(host=API_HOST))
+
+HEADERS = {
+    'x-rapidapi-host': API_HOST,
+    'x-rapidapi-key': config('rapid_api_key')
+}
+
+# (connect, read) таймауты в секундах для каждого метода api
+TIMEOUTS = {
+    'locations/v2/search': (
+        config('api_connect_timeout', default=3.05, cast=float),
+        config('api_search_timeout', default=10, cast=float)
+    ),
+    'properties/list': (
+        config('api_connect_timeout', default=3.05, cast=float),
+        config('api_list_timeout', default=30, cast=float)
+    ),
+    'properties/get-hotel-photos': (
+        config('api_connect_timeout', default=3.05, cast=float),
+        config('api_photo_timeout', default=15, cast=float)
+    ),
+}
+DEFAULT_TIMEOUT = (3.05, 30)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class JitterRetry(Retry):
+    """
+    Retry с полным jitter: задержка выбирается случайно от 0 до
+    экспоненциального значения, чтобы повторы разных потоков не совпадали.
+    """
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return 0
+        return random.uniform(0, backoff)
+
+
+def get_session() -> requests.Session:
+    """
+    Функция ленивого создания общей сессии. Размер пула соединений задается
+    значением api_pool_size из .env.
+    :return: Сессия requests.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = config('api_pool_size', default=10, cast=int)
+                retries = JitterRetry(
+                    total=config('api_retries', default=3, cast=int),
+                    backoff_factor=0.5,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=frozenset(['GET']),
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                      max_retries=retries)
+                session = requests.Session()
+                session.headers.update(HEADERS)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def get(endpoint: str, params: dict,
+        priority: [int, api_scheduler.Ticket] = api_scheduler.INTERACTIVE) -> requests.Response:
+    """
+    Функция GET запроса к методу api через общую сессию.
+    Запрос ждет своей очереди в api_scheduler, после ответа 429 повторяется
+    после паузы планировщика не более api_retries раз.
+    :param endpoint: Метод api, например 'properties/list'.
+    :param params: Параметры запроса.
+    :param priority: Класс приоритета api_scheduler или api_scheduler.Ticket.
+    :return: Ответ сервера со статусом 2xx или 3xx.
+    :raises requests.exceptions.HTTPError: Если ответ 4xx/5xx (5xx - после повторов адаптера)
+        или и после повторов ответ 429.
+    :raises api_scheduler.QuotaExceeded: Если месячная квота исчерпана.
+    """
+    retries = config('api_retries', default=3, cast=int)
+    for attempt in range(retries + 1):
+        api_scheduler.scheduler.acquire(priority)
+        with metrics.API.track(endpoint):
+            response = get_session().get(BASE_URL + endpoint, params=params,
+                                         timeout=TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+        api_scheduler.scheduler.on_response(response.status_code, response.headers)
+        if response.status_code >= 400:
+            metrics.API.errors.inc(endpoint, 'http_{status}'.format(status=response.status_code))
+        logger.debug('{endpoint} - {status} - {ms:.0f} ms'.format(
+            endpoint=endpoint, status=response.status_code,
+            ms=response.elapsed.total_seconds() * 1000))
+        if response.status_code != 429:
+            # ошибка не должна разбираться вызывающим кодом как ответ с данными
+            response.raise_for_status()
+            return response
+    response.raise_for_status()
@@ -0,0 +1,310 @@
+"""
+Метрики бота в формате Prometheus:
+    Гистограммы времени обработчиков, запросов к api и запросов к БД
+    Счетчики ошибок и количество выполняющихся вызовов
+    Попадания и промахи кэшей
+    HTTP сервер /metrics на локальном порту
+"""
+import asyncio
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from decouple import config
+from loguru import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_caches = {}
+_gauges = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+    Общая часть метрик: имя, описание, метки и значения по наборам меток.
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+    def _render_value(self, labelvalues: tuple, value) -> list:
+        return ['{}{} {}'.format(self.name, _labels(self.labelnames, labelvalues), _number(value))]
+
+
+class Counter(_Metric):
+    """
+    Счетчик, только растет.
+    """
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Текущее значение, может расти и уменьшаться.
+    """
+    kind = 'gauge'
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, *labelvalues, value: float) -> None:
+        with self._lock:
+            self._values[labelvalues] = value
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма с фиксированными границами корзин, в секундах.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, *labelvalues, value: float) -> None:
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> list:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            items = sorted((key, ([*value[0]], value[1], value[2]))
+                           for key, value in self._values.items())
+        for labelvalues, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    _labels(self.labelnames, labelvalues, 'le="{}"'.format(_number(bound))),
+                    cumulative))
+            labels = _labels(self.labelnames, labelvalues)
+            lines.append('{}_sum{} {}'.format(self.name, labels, _number(total)))
+            lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class Instrument:
+    """
+    Набор метрик для одного вида вызовов (обработчики, запросы к api, запросы к БД):
+    гистограмма времени, счетчик ошибок и количество выполняющихся вызовов.
+    """
+
+    def __init__(self, prefix: str, label: str, documentation: str) -> None:
+        """
+        :param prefix: Префикс имен метрик, например bot_handler.
+        :param label: Имя метки с названием вызова, например handler.
+        :param documentation: Описание вызовов для HELP.
+        """
+        self.duration = Histogram(prefix + '_duration_seconds',
+                                  documentation + ', время выполнения', (label,))
+        self.errors = Counter(prefix + '_errors_total',
+                              documentation + ', ошибки', (label, 'error'))
+        self.in_flight = Gauge(prefix + '_in_flight',
+                               documentation + ', выполняются сейчас', (label,))
+
+    @contextmanager
+    def track(self, name: str):
+        """
+        Контекстный менеджер замера одного вызова. Исключение считается ошибкой
+        и пробрасывается дальше.
+        :param name: Название вызова.
+        """
+        self.in_flight.inc(name)
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException as ex:
+            self.errors.inc(name, type(ex).__name__)
+            raise
+        finally:
+            self.duration.observe(name, value=time.perf_counter() - started)
+            self.in_flight.dec(name)
+
+    def timed(self, func=None, *, name: str = None):
+        """
+        Декоратор замера функции или корутины, по умолчанию под именем функции.
+        Применяется ближе всего к def, чтобы в бот регистрировалась уже обернутая функция.
+        """
+        if func is None:
+            return functools.partial(self.timed, name=name)
+        name = name or func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with self.track(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.track(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+HANDLERS = Instrument('bot_handler', 'handler', 'Обработчики сообщений и callback')
+API = Instrument('bot_api_request', 'endpoint', 'Запросы к hotels4 api')
+STAGES = Instrument('bot_stage', 'stage', 'Этапы поиска')
+DB = Instrument('bot_db_query', 'query', 'Запросы к БД')
+
+
+def register_cache(name: str, cache) -> None:
+    """
+    Регистрация кэша TTLCache: его статистика читается при каждом запросе /metrics.
+    :param name: Название кэша для метки cache.
+    :param cache: Объект с методом stats() -> dict(hits, misses, size, weight).
+    """
+    with _registry_lock:
+        _caches[name] = cache
+
+
+def register_gauge(name: str, documentation: str, func) -> None:
+    """
+    Регистрация значения, которое вычисляется при каждом запросе /metrics,
+    например длины очереди.
+    :param name: Имя метрики.
+    :param documentation: Описание для HELP.
+    :param func: Функция без аргументов, возвращающая число.
+    """
+    with _registry_lock:
+        _gauges.append((name, documentation, func))
+
+
+def _render_caches() -> list:
+    with _registry_lock:
+        caches = sorted(_caches.items())
+    if not caches:
+        return []
+    families = {
+        'bot_cache_hits_total': ('counter', 'Попадания в кэш'),
+        'bot_cache_misses_total': ('counter', 'Промахи кэша'),
+        'bot_cache_entries': ('gauge', 'Количество записей в кэше'),
+        'bot_cache_hit_ratio': ('gauge', 'Доля попаданий в кэш'),
+    }
+    samples = {family: [] for family in families}
+    for name, cache in caches:
+        stats = cache.stats()
+        labels = _labels(('cache',), (name,))
+        requests_count = stats['hits'] + stats['misses']
+        samples['bot_cache_hits_total'].append((labels, stats['hits']))
+        samples['bot_cache_misses_total'].append((labels, stats['misses']))
+        samples['bot_cache_entries'].append((labels, stats['size']))
+        samples['bot_cache_hit_ratio'].append(
+            (labels, stats['hits'] / requests_count if requests_count else 0.0))
+    lines = []
+    for family, (kind, documentation) in families.items():
+        lines.append('# HELP {} {}'.format(family, documentation))
+        lines.append('# TYPE {} {}'.format(family, kind))
+        lines.extend('{}{} {}'.format(family, labels, _number(value))
+                     for labels, value in samples[family])
+    return lines
+
+
+def render() -> str:
+    """
+    Все метрики в текстовом формате Prometheus.
+    :return: Текст ответа /metrics.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+        gauges = list(_gauges)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    lines.extend(_render_caches())
+    for name, documentation, func in gauges:
+        lines.append('# HELP {} {}'.format(name, documentation))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, _number(func())))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server() -> [ThreadingHTTPServer, None]:
+    """
+    Запуск HTTP сервера /metrics в фоновом потоке на metrics_host:metrics_port из .env.
+    metrics_port = 0 отключает сервер.
+    :return: Сервер или None, если отключен.
+    """
+    port = config('metrics_port', default=9108, cast=int)
+    if not port:
+        return None
+    host = config('metrics_host', default='127.0.0.1')
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Metrics on http://{host}:{port}/metrics'.format(host=host, port=port))
+    return server
@@ -1,86 +1,199 @@
 """
 Работа с БД:
+    Пул подключений к БД
+    Миграции схемы (schema.MIGRATIONS)
     Добавление пользователя
     Добавление истории
     Извлечение истории
-    Добавление ID города поиска
-    Добавление check-in
-    Извлечение check-in
-    Добавление check-out
-    Добавление минимальной цены (только для bestdeal)
-    Добавление максимальной цены (только для bestdeal)
-    Добавление минимальной дистанции (только для bestdeal)
-    Добавление максимальной дистанции (только для bestdeal)
-    Извлечение минимальной дистанции (только для bestdeal)
-    Извлечение максимальной дистанции (только для bestdeal)
     Извлечение полной информации
+    Сохранение параметров поиска одним запросом
+    Сохранение и загрузка незавершенных диалогов
 """
 import datetime
+import threading
+import time
 import traceback
+from contextlib import contextmanager
 from decouple import config
 import psycopg2
 import telebot.types
 from loguru import logger
-from psycopg2 import extras, errors
-
-logger.add('debug.log', format='{time} {level} {message}',
-           level='DEBUG', rotation='10 MB', compression='zip'
-           )
-
-
-def connect_database() -> psycopg2.connect:
-    """
-    Функция для подключения к БД.
-    :return: Подключение к БД.
-    """
-    try:
-        connect = psycopg2.connect(
-            database=config('database'),
-            user=config('user'),
-            password=config('password'),
-            host=config('host'),
-            port=config('port')
-        )
-        return connect
-    except psycopg2.OperationalError:
-        logger.error(traceback.format_exc())
-
-
-def add_tables() -> None:
-    """
-    Функция для создания таблиц в БД, при наличии таблиц
-    возвращает исключение, записывает его в logger и
-    выдает соответствующее сообщение в консоль.
+from psycopg2 import extras, errors, pool, extensions
+
+from botrequests import metrics, schema
+
+HISTORY_COMMANDS = {'DISTANCE_FROM_LANDMARK': 'Bestdeal', 'PRICE': 'Lowprice',
+                    'PRICE_HIGHEST_FIRST': 'Highprice'}
+
+HISTORY_QUERY = (
+    "SELECT command, datetime, ("
+    "SELECT json_agg(json_build_object('id', hotel->'id', 'name', hotel->'name')) "
+    "FROM json_array_elements(results) AS hotel), seq "
+    "FROM history WHERE id=%s AND json_typeof(results)='array' {keyset}"
+    "ORDER BY datetime DESC, seq DESC LIMIT %s;"
+)
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+# Подключения, простоявшие в пуле дольше стольких секунд, проверяются запросом SELECT 1:
+# закрытие сервером (idle timeout, перезапуск) по connect.closed не видно
+CHECK_IDLE = config('db_check_idle', default=30, cast=float)
+# Время возврата подключения в пул: id(подключения) -> time.monotonic()
+_returned_at = {}
+
+
+def get_pool() -> pool.ThreadedConnectionPool:
+    """
+    Функция ленивого создания пула подключений к БД.
+    Размер пула ограничен значениями db_pool_min и db_pool_max из .env.
+    :return: Пул подключений.
+    """
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                max_size = config('db_pool_max', default=10, cast=int)
+                _pool_slots = threading.BoundedSemaphore(max_size)
+                _pool = pool.ThreadedConnectionPool(
+                    minconn=config('db_pool_min', default=1, cast=int),
+                    maxconn=max_size,
+                    database=config('database'),
+                    user=config('user'),
+                    password=config('password'),
+                    host=config('host'),
+                    port=config('port'),
+                    connect_timeout=config('db_connect_timeout', default=5, cast=int)
+                )
+    return _pool
+
+
+def close_pool() -> None:
+    """
+    Функция закрытия всех подключений пула, вызывается при остановке бота.
     :return:
     """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _pool_slots = None
+            _returned_at.clear()
+
+
+def _is_healthy(connect: extensions.connection) -> bool:
+    """
+    Проверка подключения перед выдачей из пула: подключение не закрыто
+    и не осталось в незавершенной или сломанной транзакции. Подключение,
+    простоявшее без дела дольше CHECK_IDLE секунд, проверяется запросом SELECT 1.
+    :param connect: Подключение из пула.
+    :return: True, если подключение можно использовать.
+    """
+    if connect.closed:
+        return False
+    if connect.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+        return False
+    if time.monotonic() - _returned_at.get(id(connect), 0) < CHECK_IDLE:
+        return True
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        cursor.execute(
-            "CREATE TABLE users(id INT PRIMARY KEY,first_name TEXT,last_name TEXT,"
-            "user_name TEXT, check_in DATE, check_out DATE, destination_id INT,"
-            "command TEXT, price_min INT,price_max INT, distance_min INT, distance_max INT);"
-        )
-
-        connect.commit()
-
-    except psycopg2.errors.DuplicateTable:
-        logger.info("Таблица users уже создана")
-    else:
-        logger.info('Таблица "users" успешно создана')
-
+        with connect.cursor() as cursor:
+            cursor.execute('SELECT 1;')
+        connect.rollback()
+    except psycopg2.Error:
+        logger.warning('db - stale connection dropped')
+        return False
+    return True
+
+
+@contextmanager
+def pooled_cursor(name: str, cursor_factory=None):
+    """
+    Контекстный менеджер выдачи курсора из пула. Если все подключения заняты,
+    ожидает освобождения не дольше db_pool_timeout секунд. Подключение проверяется
+    перед выдачей, по выходу транзакция фиксируется (или откатывается при ошибке),
+    а подключение возвращается в пул. Время выполнения запроса пишется в logger
+    и в метрики metrics.DB.
+    :param name: Название запроса для лога.
+    :param cursor_factory: Фабрика курсора psycopg2 (например extras.DictCursor).
+    :return: Курсор БД.
+    """
+    db_pool = get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=config('db_pool_timeout', default=10, cast=float)):
+        raise psycopg2.OperationalError('Нет свободных подключений в пуле БД')
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        cursor.execute(
-            "CREATE TABLE history(id INT, command TEXT, "
-            "datetime TIMESTAMP, results JSON);"
-        )
-        connect.commit()
-    except psycopg2.errors.DuplicateTable:
-        logger.info("Таблица history уже создана")
-    else:
-        logger.info('Таблица "history" успешно создана')
+        connect = db_pool.getconn()
+        while not _is_healthy(connect):
+            _returned_at.pop(id(connect), None)
+            db_pool.putconn(connect, close=True)
+            connect = db_pool.getconn()
+
+        broken = False
+        started = time.perf_counter()
+        try:
+            with metrics.DB.track(name):
+                with connect.cursor(cursor_factory=cursor_factory) as cursor:
+                    yield cursor
+                connect.commit()
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        except BaseException:
+            if not connect.closed:
+                connect.rollback()
+            raise
+        finally:
+            logger.debug('{name} - {ms:.1f} ms'.format(
+                name=name, ms=(time.perf_counter() - started) * 1000))
+            close = broken or bool(connect.closed)
+            if close:
+                _returned_at.pop(id(connect), None)
+            else:
+                _returned_at[id(connect)] = time.monotonic()
+            db_pool.putconn(connect, close=close)
+    finally:
+        slots.release()
+
+
+def schema_version(cursor) -> int:
+    """
+    Последняя примененная версия схемы.
+    :param cursor: Курсор БД.
+    :return: Номер версии, 0 - если таблицы schema_version еще нет.
+    """
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+    return cursor.fetchone()[0]
+
+
+def migrate() -> int:
+    """
+    Функция применения миграций схемы schema.MIGRATIONS, которые еще не применены.
+    Все выполняется на одном подключении и в одной транзакции. Если схема актуальна,
+    это два коротких запроса без DDL, иначе берется pg_advisory_xact_lock, чтобы
+    одновременно запущенные процессы не применяли миграции дважды.
+    :return: Версия схемы после миграции.
+    """
+    with pooled_cursor('migrate') as cursor:
+        current = schema_version(cursor)
+        if current >= schema.LATEST:
+            return current
+        cursor.execute("SELECT pg_advisory_xact_lock(%s);", (schema.LOCK_KEY,))
+        cursor.execute(schema.VERSION_TABLE)
+        current = schema_version(cursor)
+        for version, name, statements in schema.pending(current):
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s);",
+                           (version, name))
+            logger.info('Схема БД: применена миграция {version} - {name}'.format(
+                version=version, name=name))
+            current = version
+    return current
 
 
 def add_user(message: telebot.types.Message) -> None:
@@ -90,16 +203,13 @@ def add_user(message: telebot.types.Message) -> None:
     :return:
     """
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
         user_id = str(message.from_user.id)
         first_name = str(message.from_user.first_name)
         last_name = str(message.from_user.last_name)
         user_name = str(message.from_user.username)
-        cursor.execute("INSERT INTO users (id, first_name, last_name, user_name) "
-                       "VALUES (%s, %s, %s, %s);", (user_id, first_name, last_name, user_name))
-        connect.commit()
-        connect.close()
+        with pooled_cursor('add_user') as cursor:
+            cursor.execute("INSERT INTO users (id, first_name, last_name, user_name) "
+                           "VALUES (%s, %s, %s, %s);", (user_id, first_name, last_name, user_name))
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
     except errors.UniqueViolation as ex:
@@ -117,301 +227,172 @@ def add_history(user_id: int, sortorder: str, date_time: datetime, history_data:
     :param history_data: Результаты отправленные пользователю в формате json.
     :return:
     """
-    try:
-        if sortorder == 'DISTANCE_FROM_LANDMARK':
-            sortorder = 'Bestdeal'
-        elif sortorder == 'PRICE':
-            sortorder = 'Lowprice'
-        elif sortorder == 'PRICE_HIGHEST_FIRST':
-            sortorder = 'Highprice'
-        connect = connect_database()
-        cursor = connect.cursor()
-
-        cursor.execute("INSERT INTO history (id, command, datetime, results) "
-                       "VALUES (%s, %s, %s, %s);", (user_id, sortorder, date_time, history_data))
-        connect.commit()
-        connect.close()
-    except psycopg2.OperationalError:
-        logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.add_history - ok'.format(id=user_id))
-
-
-def get_history(user_id: int) -> zip:
-    """
-    Функция извлечения истории для пользователя
-    :param user_id: ID пользователя
-    :return results: Zip объект включающий (команда, объект datetime) и json найденых отелей
-    """
-    try:
-        connect = connect_database()
-        cursor = connect.cursor(cursor_factory=extras.DictCursor)
-        cursor.execute(
-            "SELECT results FROM history WHERE id=%s "
-            "AND results IS NOT NULL;", (user_id,)
-                        )
-        history_data = cursor.fetchall()
-        cursor = connect.cursor()
-        cursor.execute(
-            "SELECT command, datetime FROM history WHERE id=%s "
-            "AND results IS NOT NULL;", (user_id,)
-                        )
-        command_datetime = cursor.fetchall()
-        connect.close()
-        if len(command_datetime) and len(history_data):
-            results = zip(command_datetime, history_data)
-        else:
-            results = None
-    except psycopg2.OperationalError:
-        logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.get_history - ok'.format(id=user_id))
-        return results
-
-
-def add_destination_id(message: telebot.types.CallbackQuery) -> None:
-    """
-    Функция добавления destination ID в БД.
-    :param message: Callback data содержит префикс сокращенной команды и ID
-    :return :
-    """
-    try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        command = 'PRICE'
-        user_id = message.from_user.id
-
-        if message.data.startswith('l'):
-            command = 'PRICE'
-        elif message.data.startswith('h'):
-            command = 'PRICE_HIGHEST_FIRST'
-        elif message.data.startswith('b'):
-            command = 'DISTANCE_FROM_LANDMARK'
-        destination_id = message.data[2:]
-        cursor.execute(
-            "UPDATE users SET destination_id=%s, command=%s WHERE id=%s;",
-            (destination_id, command,  user_id)
-                        )
-        connect.commit()
-        connect.close()
-
-    except psycopg2.OperationalError:
-        logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.add_destination - ok'.format(id=user_id))
-
-
-def add_check_in(chat_id: int, date: datetime) -> None:
-    """
-    Функция добавления check-in в БД.
-    :param date: Дата check-in
-    :param chat_id: ID пользователя
-    :return :
-    """
-    try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        check_in = date
-        cursor.execute(
-            "UPDATE users SET check_in=%s WHERE id=%s;",
-            (check_in, chat_id)
-                       )
-        connect.commit()
-        connect.close()
-
-    except psycopg2.OperationalError:
-        logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.add_check-in - ok'.format(id=chat_id))
-
-
-def get_check_in(chat_id: int) -> datetime:
-    """
-    Функция извлечения check-in для дальнейшего использования
-    :param chat_id: ID пользователя
-    :return date: Возвращает извлеченную из БД дату check-in
-    """
-    try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        select_query = "SELECT check_in FROM users WHERE id={chat_id};"
-        cursor.execute(select_query.format(chat_id=chat_id))
-        date = str(cursor.fetchall()[0][0])
-        cursor.close()
+    add_history_batch([(user_id, sortorder, date_time, history_data)])
 
-    except psycopg2.OperationalError:
-        logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.add_check-in - ok'.format(id=chat_id))
-        return date
 
-
-def add_check_out(chat_id: int, date: datetime) -> None:
+def add_history_batch(rows: list) -> bool:
     """
-    Функция добавления check-out в БД.
-    :param date: Дата check-out
-    :param chat_id: ID пользователя
-    :return :
+    Функция добавления нескольких записей истории одним INSERT.
+    :param rows: Список кортежей (user_id, sortorder, date_time, history_data)
+    :return: True, если записи сохранены.
     """
+    values = [(user_id, HISTORY_COMMANDS.get(sortorder, sortorder), date_time, history_data)
+              for user_id, sortorder, date_time, history_data in rows]
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        update_query = "UPDATE users SET check_out='{check_out}' WHERE id={chat_id};"
-        cursor.execute(update_query.format(check_out=date, chat_id=chat_id))
-        connect.commit()
-        connect.close()
-
+        with pooled_cursor('add_history') as cursor:
+            extras.execute_values(
+                cursor, "INSERT INTO history (id, command, datetime, results) VALUES %s;",
+                values, page_size=len(values)
+            )
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
+        return False
     else:
-        logger.info('{id} - post.add_check-out - ok'.format(id=chat_id))
+        logger.info('post.add_history - ok, {count} rows'.format(count=len(values)))
+        return True
 
 
-def add_price_min(chat_id: int, price_min: str) -> None:
-    """
-    Функция добавления минимальной цены в БД.
-    :param price_min: Минимальная цена
-    :param chat_id: ID пользователя
-    :return:
+def get_history(user_id: int, before: tuple = None, limit: int = 5) -> [list, None]:
     """
-    try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        update_query = "UPDATE users SET price_min='{price_min}' WHERE id={chat_id};"
-        cursor.execute(update_query.format(price_min=price_min, chat_id=chat_id))
-        connect.commit()
-        connect.close()
-
-    except psycopg2.OperationalError:
-        logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.add_price_min - ok'.format(id=chat_id))
-
-
-def add_price_max(chat_id: int, price_max: str) -> None:
-    """
-    Функция добавления максимальной цены в БД.
-    :param price_max: Максимальная цена
-    :param chat_id: ID пользователя
-    :return:
+    Функция извлечения страницы истории для пользователя, от новых записей к старым.
+    Один запрос по индексу (id, datetime DESC, seq DESC), из json результатов
+    извлекаются только id и name отелей.
+    :param user_id: ID пользователя
+    :param before: Ключ последней показанной записи (datetime, seq), None - первая страница
+    :param limit: Количество записей на странице
+    :return results: Список записей (команда, объект datetime, список отелей, seq)
+        до limit + 1 штук, лишняя запись означает, что есть следующая страница
     """
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        update_query = "UPDATE users SET price_max='{price_max}' WHERE id={chat_id};"
-        cursor.execute(update_query.format(price_max=price_max, chat_id=chat_id))
-        connect.commit()
-        connect.close()
-
+        with pooled_cursor('get_history') as cursor:
+            if before is None:
+                cursor.execute(HISTORY_QUERY.format(keyset=''), (user_id, limit + 1))
+            else:
+                cursor.execute(HISTORY_QUERY.format(keyset='AND (datetime, seq) < (%s, %s) '),
+                               (user_id, before[0], before[1], limit + 1))
+            results = cursor.fetchall()
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
     else:
-        logger.info('{id} - post.add_price_max - ok'.format(id=chat_id))
+        logger.info('{id} - post.get_history - ok'.format(id=user_id))
+        return results
 
 
-def add_distance_min(chat_id: int, distance: str) -> None:
+def get_full_info(chat_id: int) -> list:
     """
-    Функция добавления минимальной дистанции в БД.
-    :param distance: Минимальная дистанция
+    Функция извлечения полной информации из БД.
     :param chat_id: ID пользователя
-    :return:
+    :return results: Список основных данных из БД необходимых для отправки запроса
     """
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        update_query = "UPDATE users SET distance_min='{distance}' WHERE id={chat_id};"
-        cursor.execute(update_query.format(distance=distance, chat_id=chat_id))
-        connect.commit()
-        connect.close()
+        with pooled_cursor('get_full_info') as cursor:
+            cursor.execute(
+                "SELECT destination_id, check_in, check_out, command, "
+                "price_min, price_max, distance_min,"
+                "distance_max FROM users WHERE id=%s", (chat_id,)
+                            )
+            result = cursor.fetchall()[0]
 
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
     else:
-        logger.info('{id} - post.add_distance_min - ok'.format(id=chat_id))
+        logger.info('{id} - post.get_full_info - ok'.format(id=chat_id))
+        return result
 
 
-def add_distance_max(chat_id: int, distance: str) -> None:
+def save_search(chat_id: int, query: list) -> None:
     """
-    Функция добавления максимальной дистанции в БД.
-    :param distance: Максимальная дистанция
+    Функция сохранения всех параметров поиска одним запросом (upsert).
     :param chat_id: ID пользователя
+    :param query: Список параметров в порядке get_full_info
     :return:
     """
+    destination_id, check_in, check_out, command, price_min, price_max, \
+        distance_min, distance_max = [
+            round(value) if isinstance(value, float) else value for value in query
+        ]
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        update_query = "UPDATE users SET distance_max='{distance}' WHERE id={chat_id};"
-        cursor.execute(update_query.format(distance=distance, chat_id=chat_id))
-        connect.commit()
-        connect.close()
+        with pooled_cursor('save_search') as cursor:
+            cursor.execute(
+                "INSERT INTO users (id, destination_id, check_in, check_out, command, "
+                "price_min, price_max, distance_min, distance_max) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                "ON CONFLICT (id) DO UPDATE SET destination_id=EXCLUDED.destination_id, "
+                "check_in=EXCLUDED.check_in, check_out=EXCLUDED.check_out, "
+                "command=EXCLUDED.command, price_min=EXCLUDED.price_min, "
+                "price_max=EXCLUDED.price_max, distance_min=EXCLUDED.distance_min, "
+                "distance_max=EXCLUDED.distance_max;",
+                (chat_id, destination_id, check_in, check_out, command,
+                 price_min, price_max, distance_min, distance_max)
+            )
 
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
     else:
-        logger.info('{id} - post.add_distance_max - ok'.format(id=chat_id))
+        logger.info('{id} - post.save_search - ok'.format(id=chat_id))
 
 
-def get_distance_min(chat_id: int) -> int:
+def save_conversations(rows: list, deleted: list) -> bool:
     """
-    Функция извлечения минимальной дистанции из БД.
-    :param chat_id: ID пользователя
-    :return:
+    Функция сохранения незавершенных диалогов: upsert изменившихся и удаление завершенных
+    в одной транзакции.
+    :param rows: Список кортежей (chat_id, handlers json, session json, дата и время)
+    :param deleted: Список chat_id завершенных диалогов
+    :return: True, если изменения сохранены.
     """
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        select_query = "SELECT distance_min FROM users WHERE id={id}"
-        cursor.execute(select_query.format(id=chat_id))
-        result = cursor.fetchall()[0]
-        connect.close()
-
+        with pooled_cursor('save_conversations') as cursor:
+            if rows:
+                extras.execute_values(
+                    cursor, "INSERT INTO conversations (chat_id, handlers, session, updated) "
+                            "VALUES %s ON CONFLICT (chat_id) DO UPDATE SET "
+                            "handlers=EXCLUDED.handlers, session=EXCLUDED.session, "
+                            "updated=EXCLUDED.updated;",
+                    rows, page_size=len(rows)
+                )
+            if deleted:
+                cursor.execute("DELETE FROM conversations WHERE chat_id = ANY(%s);", (deleted,))
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
+        return False
     else:
-        logger.info('{id} - post.get_distance_min - ok'.format(id=chat_id))
-        return result
+        logger.debug('post.save_conversations - ok, {saved} saved, {deleted} deleted'.format(
+            saved=len(rows), deleted=len(deleted)))
+        return True
 
 
-def get_distance_max(chat_id: int) -> int:
+def load_conversations(max_age: float) -> list:
     """
-    Функция извлечения максимальной дистанции из БД.
-    :param chat_id: ID пользователя
-    :return:
+    Функция загрузки незавершенных диалогов одним запросом, устаревшие удаляются.
+    :param max_age: Возраст в секундах, после которого диалог считается устаревшим.
+    :return: Список кортежей (chat_id, handlers, session).
     """
+    since = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        select_query = "SELECT distance_max FROM users WHERE id={id}"
-        cursor.execute(select_query.format(id=chat_id))
-        result = cursor.fetchall()[0]
-        connect.close()
-
+        with pooled_cursor('load_conversations') as cursor:
+            cursor.execute("DELETE FROM conversations WHERE updated < %s;", (since,))
+            cursor.execute("SELECT chat_id, handlers, session FROM conversations;")
+            results = cursor.fetchall()
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.get_distance_max - ok'.format(id=chat_id))
-        return result
+        return []
+    logger.info('post.load_conversations - ok, {count} rows'.format(count=len(results)))
+    return results
 
 
-def get_full_info(chat_id: int) -> list:
+def load_conversation(chat_id: int, max_age: float) -> [tuple, None]:
     """
-    Функция извлечения полной информации из БД.
-    :param chat_id: ID пользователя
-    :return results: Список основных данных из БД необходимых для отправки запроса
+    Функция загрузки незавершенного диалога одного чата.
+    :param chat_id: ID чата.
+    :param max_age: Возраст в секундах, после которого диалог считается устаревшим.
+    :return: Кортеж (handlers, session) или None, если диалога нет или он устарел.
     """
+    since = datetime.datetime.now() - datetime.timedelta(seconds=max_age)
     try:
-        connect = connect_database()
-        cursor = connect.cursor()
-        cursor.execute(
-            "SELECT destination_id, check_in, check_out, command, "
-            "price_min, price_max, distance_min,"
-            "distance_max FROM users WHERE id=%s", (chat_id,)
-                        )
-        result = cursor.fetchall()[0]
-        connect.close()
-
+        with pooled_cursor('load_conversation') as cursor:
+            cursor.execute("SELECT handlers, session FROM conversations "
+                           "WHERE chat_id = %s AND updated >= %s;", (chat_id, since))
+            return cursor.fetchone()
     except psycopg2.OperationalError:
         logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - post.get_full_info - ok'.format(id=chat_id))
-        return result
+        return None
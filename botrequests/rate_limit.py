@@ -0,0 +1,111 @@
+"""
+Ограничение частоты запросов алгоритмом token bucket.
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: rate токенов в секунду, не более capacity накопленных.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """
+        :param rate: Скорость пополнения, токенов в секунду.
+        :param capacity: Максимальное количество накопленных токенов (размер всплеска).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        Попытка забрать токены без ожидания.
+        :param tokens: Количество токенов.
+        :return: 0, если токены получены, иначе сколько секунд нужно подождать.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1, timeout: float = None) -> bool:
+        """
+        Ожидание и получение токенов.
+        :param tokens: Количество токенов.
+        :param timeout: Максимальное время ожидания в секундах, None - без ограничения.
+        :return: True, если токены получены.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Обнуление накопленных токенов на seconds секунд, например после ответа 429.
+        :param seconds: Длительность паузы.
+        :return:
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class Pauses:
+    """
+    Потокобезопасные паузы по ключу до заданного момента, например пауза чата
+    после ответа 429 с retry_after. Запись хранится, пока пауза не закончилась,
+    независимо от времени жизни лимитеров в кэше.
+    """
+
+    def __init__(self) -> None:
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def pause(self, key, seconds: float) -> None:
+        """
+        Пауза по ключу на seconds секунд (более длинная из текущей и новой).
+        Закончившиеся паузы других ключей при этом удаляются.
+        :param key: Ключ, например ID чата.
+        :param seconds: Длительность паузы.
+        :return:
+        """
+        with self._lock:
+            now = time.monotonic()
+            for expired in [item for item, until in self._until.items() if until <= now]:
+                del self._until[expired]
+            self._until[key] = max(self._until.get(key, now), now + seconds)
+
+    def remaining(self, key) -> float:
+        """
+        Оставшееся время паузы.
+        :param key: Ключ.
+        :return: Секунды до конца паузы, 0 - паузы нет.
+        """
+        with self._lock:
+            until = self._until.get(key)
+            if until is None:
+                return 0
+            left = until - time.monotonic()
+            if left <= 0:
+                del self._until[key]
+                return 0
+            return left
+
+    def __len__(self) -> int:
+        return len(self._until)
@@ -0,0 +1,50 @@
+"""
+Версии схемы БД: миграции применяются по порядку и один раз, номера
+примененных миграций хранятся в таблице schema_version.
+Общие для postgres_database и async_postgres_database.
+Запросы миграций идемпотентны (IF NOT EXISTS), поэтому базы, созданные
+до появления schema_version, переводятся на версии без ошибок.
+"""
+
+VERSION_TABLE = (
+    "CREATE TABLE IF NOT EXISTS schema_version(version INT PRIMARY KEY, name TEXT, "
+    "applied TIMESTAMP DEFAULT now());"
+)
+
+# Ключ pg_advisory_xact_lock: миграции из нескольких процессов применяются по очереди
+LOCK_KEY = 720_240_001
+
+# (версия, название, запросы) по возрастанию версии, новые миграции добавляются в конец
+MIGRATIONS = (
+    (1, 'users and history', (
+        "CREATE TABLE IF NOT EXISTS users(id INT PRIMARY KEY,first_name TEXT,last_name TEXT,"
+        "user_name TEXT, check_in DATE, check_out DATE, destination_id INT,"
+        "command TEXT, price_min INT,price_max INT, distance_min INT, distance_max INT);",
+        "CREATE TABLE IF NOT EXISTS history(id INT, command TEXT, "
+        "datetime TIMESTAMP, results JSON);",
+        "CREATE INDEX IF NOT EXISTS history_id_datetime_idx ON history (id, datetime DESC);",
+    )),
+    (2, 'conversations', (
+        "CREATE TABLE IF NOT EXISTS conversations(chat_id BIGINT PRIMARY KEY, handlers JSON, "
+        "session JSON, updated TIMESTAMP);",
+    )),
+    # datetime хранится с точностью до секунды: seq упорядочивает записи одной секунды
+    # для постраничного вывода истории по ключу (datetime, seq)
+    (3, 'history seq', (
+        "ALTER TABLE history ADD COLUMN IF NOT EXISTS seq BIGSERIAL;",
+        "CREATE INDEX IF NOT EXISTS history_id_datetime_seq_idx "
+        "ON history (id, datetime DESC, seq DESC);",
+        "DROP INDEX IF EXISTS history_id_datetime_idx;",
+    )),
+)
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def pending(current: int) -> list:
+    """
+    Миграции, которые еще не применены.
+    :param current: Последняя примененная версия, 0 - схема пустая.
+    :return: Список (версия, название, запросы) по порядку.
+    """
+    return [migration for migration in MIGRATIONS if migration[0] > current]
@@ -0,0 +1,172 @@
+"""
+Состояние мастера поиска (lowprice, highprice, bestdeal) для каждого чата.
+Хранится в памяти процесса с TTL и записывается в БД одним запросом
+только при отправке поиска. Для продолжения диалога после перезапуска
+незавершенные сессии сохраняет модуль conversations.
+"""
+import datetime
+
+from decouple import config
+
+from botrequests import metrics
+from botrequests.cache import TTLCache
+
+COMMANDS = {'l': 'PRICE', 'h': 'PRICE_HIGHEST_FIRST', 'b': 'DISTANCE_FROM_LANDMARK'}
+
+
+class SearchSession:
+    """
+    Параметры поиска одного чата, заполняются по шагам мастера.
+    """
+    __slots__ = ('destination_id', 'command', 'check_in', 'check_out',
+                 'price_min', 'price_max', 'distance_min', 'distance_max')
+
+    def __init__(self, destination_id: int, command: str) -> None:
+        """
+        :param destination_id: ID местоположения.
+        :param command: Метод сортировки (PRICE, PRICE_HIGHEST_FIRST, DISTANCE_FROM_LANDMARK).
+        """
+        self.destination_id = destination_id
+        self.command = command
+        self.check_in: datetime.date = None
+        self.check_out: datetime.date = None
+        self.price_min: int = None
+        self.price_max: int = None
+        self.distance_min: float = None
+        self.distance_max: float = None
+
+    def query(self) -> list:
+        """
+        Параметры поиска в порядке postgres_database.get_full_info.
+        :return: Список (destination_id, check_in, check_out, command,
+            price_min, price_max, distance_min, distance_max).
+        """
+        return [self.destination_id, self.check_in, self.check_out, self.command,
+                self.price_min, self.price_max, self.distance_min, self.distance_max]
+
+    def as_dict(self) -> dict:
+        """
+        Сессия в виде json объекта, даты - строками ISO.
+        """
+        data = {field: getattr(self, field) for field in self.__slots__}
+        for field in ('check_in', 'check_out'):
+            if data[field] is not None:
+                data[field] = data[field].isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SearchSession':
+        """
+        Сессия из json объекта as_dict.
+        """
+        session = cls(data['destination_id'], data['command'])
+        for field in cls.__slots__[2:]:
+            value = data.get(field)
+            if value is not None and field in ('check_in', 'check_out'):
+                value = datetime.date.fromisoformat(value)
+            setattr(session, field, value)
+        return session
+
+
+_sessions = TTLCache(
+    maxsize=config('session_store_size', default=100000, cast=int),
+    ttl=config('session_ttl', default=60 * 60, cast=int)
+)
+metrics.register_cache('sessions', _sessions)
+
+# Функции listener(chat_id), вызываются при каждом изменении сессии чата
+_listeners = []
+
+
+def add_listener(listener) -> None:
+    """
+    Подписка на изменения сессий (начало, изменение полей, завершение),
+    например для сохранения диалогов в БД.
+    :param listener: Функция listener(chat_id).
+    """
+    _listeners.append(listener)
+
+
+def _notify(chat_id: int) -> None:
+    for listener in _listeners:
+        listener(chat_id)
+
+
+def start_session(chat_id: int, callback_data: str) -> SearchSession:
+    """
+    Создание новой сессии по выбранному местоположению.
+    :param chat_id: ID чата.
+    :param callback_data: Callback data содержит префикс сокращенной команды и ID.
+    :return: Новая сессия.
+    """
+    session = SearchSession(int(callback_data[2:]), COMMANDS.get(callback_data[0], 'PRICE'))
+    _sessions.set(chat_id, session)
+    _notify(chat_id)
+    return session
+
+
+def get_session(chat_id: int) -> [SearchSession, None]:
+    """
+    Получение сессии чата. Каждое обращение продлевает TTL сессии,
+    подписчики не уведомляются: поля меняются через update_session.
+    :param chat_id: ID чата.
+    :return: Сессия или None, если она не начиналась или устарела.
+    """
+    session = _sessions.get(chat_id)
+    if session is not None:
+        _sessions.set(chat_id, session)
+    return session
+
+
+def update_session(chat_id: int, **fields) -> [SearchSession, None]:
+    """
+    Изменение полей сессии чата с уведомлением подписчиков.
+    :param chat_id: ID чата.
+    :param fields: Новые значения полей SearchSession.
+    :return: Сессия или None, если она не начиналась или устарела.
+    """
+    session = get_session(chat_id)
+    if session is None:
+        return None
+    for field, value in fields.items():
+        setattr(session, field, value)
+    _notify(chat_id)
+    return session
+
+
+def peek_session(chat_id: int) -> [SearchSession, None]:
+    """
+    Получение сессии чата без продления TTL и без уведомления подписчиков.
+    :param chat_id: ID чата.
+    :return: Сессия или None.
+    """
+    return _sessions.get(chat_id)
+
+
+def restore_session(chat_id: int, session: SearchSession) -> None:
+    """
+    Восстановление сессии после перезапуска бота.
+    :param chat_id: ID чата.
+    :param session: Сессия.
+    """
+    _sessions.set(chat_id, session)
+
+
+def forget_session(chat_id: int) -> None:
+    """
+    Удаление сессии из памяти процесса без уведомления подписчиков
+    (сохраненный в БД диалог не меняется).
+    :param chat_id: ID чата.
+    """
+    _sessions.pop(chat_id)
+
+
+def end_session(chat_id: int) -> [SearchSession, None]:
+    """
+    Завершение сессии после отправки поиска.
+    :param chat_id: ID чата.
+    :return: Завершенная сессия или None.
+    """
+    session = _sessions.pop(chat_id)
+    _notify(chat_id)
+    return session
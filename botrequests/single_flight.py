@@ -0,0 +1,132 @@
+"""
+Объединение одинаковых одновременных запросов (single flight):
+пока запрос по ключу выполняется, повторные вызовы с тем же ключом
+не идут в api, а ждут и получают тот же результат или то же исключение.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+from loguru import logger
+
+from botrequests import metrics
+
+COALESCED = metrics.Counter('bot_coalesced_calls_total',
+                            'Вызовы single flight: leader - запрос к api, waiter - ожидание чужого',
+                            ('group', 'role'))
+
+
+class SingleFlight:
+    """
+    Single flight для потоков.
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        :param name: Название группы для метрик и лога.
+        """
+        self.name = name
+        self.leaders = 0
+        self.suppressed = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        """
+        Выполнение func(*args) не более одного раза одновременно для ключа.
+        :param key: Ключ запроса (все параметры, от которых зависит результат).
+        :param func: Функция запроса.
+        :return: Результат func, общий для всех ожидавших.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.suppressed += 1
+        if not leader:
+            COALESCED.inc(self.name, 'waiter')
+            logger.debug('{name} - coalesced {key}'.format(name=self.name, key=key))
+            return call.result()
+
+        COALESCED.inc(self.name, 'leader')
+        try:
+            result = func(*args)
+        except BaseException as ex:
+            call.set_exception(ex)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        Статистика для мониторинга.
+        :return: Словарь с ключами leaders (запросов выполнено), suppressed (запросов сэкономлено)
+            и in_flight (выполняется сейчас).
+        """
+        with self._lock:
+            return {'leaders': self.leaders, 'suppressed': self.suppressed,
+                    'in_flight': len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """
+    Single flight для корутин одного event loop.
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        :param name: Название группы для метрик и лога.
+        """
+        self.name = name
+        self.leaders = 0
+        self.suppressed = 0
+        self._calls = {}
+
+    async def do(self, key, func, *args):
+        """
+        Выполнение корутины func(*args) не более одного раза одновременно для ключа.
+        Отмена одного из ожидающих не отменяет запрос для остальных, а когда
+        отменены все ожидающие, отменяется и сам запрос.
+        :param key: Ключ запроса.
+        :param func: Корутинная функция запроса.
+        :return: Результат func, общий для всех ожидавших.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            # [задача, количество ожидающих]
+            call = self._calls[key] = [asyncio.ensure_future(func(*args)), 0]
+            call[0].add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+            COALESCED.inc(self.name, 'leader')
+        else:
+            self.suppressed += 1
+            COALESCED.inc(self.name, 'waiter')
+            logger.debug('{name} - coalesced {key}'.format(name=self.name, key=key))
+        task = call[0]
+        call[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            call[1] -= 1
+            if not call[1] and not task.done():
+                # ожидающих не осталось: запрос никому не нужен
+                self._forget(key, call)
+                task.cancel()
+
+    def _forget(self, key, call: list) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        """
+        Статистика для мониторинга, как у SingleFlight.stats.
+        """
+        return {'leaders': self.leaders, 'suppressed': self.suppressed,
+                'in_flight': len(self._calls)}
@@ -0,0 +1,73 @@
+"""
+Время запуска бота по этапам (импорт модулей, миграции, восстановление диалогов,
+сервер метрик, до первого обновления): отчет пишется в лог и в метрики,
+чтобы запуск после деплоя оставался быстрым.
+Модуль импортируется первым, время импорта считается от его загрузки.
+"""
+import time
+
+from loguru import logger
+
+from botrequests import metrics
+
+PHASES = metrics.Gauge('bot_startup_seconds', 'Время этапов запуска бота', ('phase',))
+
+
+class StartupTimer:
+    """
+    Замер этапов запуска: каждый этап длится от конца предыдущего до отметки.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.phases = {}
+        self._last = self.started
+
+    def mark(self, phase: str) -> float:
+        """
+        Отметка окончания этапа.
+        :param phase: Название этапа.
+        :return: Длительность этапа в секундах.
+        """
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self.phases[phase] = elapsed
+        PHASES.set(phase, value=elapsed)
+        return elapsed
+
+    def total(self) -> float:
+        """
+        :return: Секунды от импорта модуля до последней отметки.
+        """
+        return self._last - self.started
+
+    def report(self, stage: str) -> None:
+        """
+        Запись этапов в лог одной строкой.
+        :param stage: Момент отчета, например "ready" или "first update".
+        """
+        PHASES.set('total', value=self.total())
+        logger.info('startup - {stage} in {total:.0f} ms: {phases}'.format(
+            stage=stage, total=self.total() * 1000,
+            phases=', '.join('{} {:.0f} ms'.format(name, seconds * 1000)
+                             for name, seconds in self.phases.items())))
+
+    def watch(self, bot) -> None:
+        """
+        Отметка первого обновления, которое получил бот: process_new_updates
+        экземпляра подменяется обёрткой, которая после первого вызова убирается.
+        :param bot: Экземпляр TeleBot или AsyncTeleBot (корутина возвращается как есть).
+        """
+        process_new_updates = bot.process_new_updates
+
+        def first_updates(updates) -> None:
+            bot.process_new_updates = process_new_updates
+            self.mark('first_update')
+            self.report('first update')
+            return process_new_updates(updates)
+
+        bot.process_new_updates = first_updates
+
+
+timer = StartupTimer()
@@ -0,0 +1,399 @@
+"""
+Многопроцессный режим бота (bot_workers > 1 в .env):
+    Супервизор получает обновления (long polling или webhook) и передает каждое
+    процессу-обработчику по chat_id, поэтому сессия мастера поиска
+    и register_next_step_handler чата остаются в одном процессе
+    Чат закреплен за процессом, пока в нем есть активность (session_ttl), поэтому
+    изменение числа процессов не прерывает начатые диалоги: новые процессы получают
+    только новые чаты, а лишние перестают получать новые чаты и завершаются,
+    когда закрепленных за ними чатов не осталось
+    Лимиты api, Telegram и размер пула подключений к БД делятся между процессами
+    Состояние процессов и длина их очередей - в метриках и в логе
+"""
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+
+import telebot
+from decouple import config
+from loguru import logger
+
+from botrequests import metrics, webhook
+from botrequests.cache import TTLCache
+
+WORKER_UP = metrics.Gauge('bot_worker_up', 'Процесс-обработчик работает', ('worker',))
+WORKER_QUEUE = metrics.Gauge('bot_worker_queue', 'Обновления в очереди процесса-обработчика',
+                             ('worker',))
+WORKER_RESTARTS = metrics.Counter('bot_worker_restarts_total', 'Перезапуски процессов-обработчиков',
+                                  ('worker',))
+WORKER_UPDATES = metrics.Counter('bot_worker_updates_total',
+                                 'Обновления, переданные процессам-обработчикам', ('worker',))
+
+# Лимиты из .env и их значения по умолчанию: у каждого процесса свой лимитер,
+# поэтому процесс получает свою долю, чтобы в сумме лимит не превышался.
+# Доля считается при запуске процесса: после увеличения числа процессов старые
+# процессы сохраняют прежнюю долю, превышение частоты api сглаживает api_scheduler после 429
+SHARED_LIMITS = {
+    'api_rate_limit': 5.0,
+    'api_burst': 5.0,
+    'telegram_global_rate': 30.0,
+    'db_pool_max': 10,
+}
+
+# Период проверки процессом-обработчиком, что супервизор еще работает, секунд
+PARENT_CHECK_INTERVAL = 5
+
+
+def update_chat_id(update: dict) -> [int, None]:
+    """
+    Чат сообщения или пользователь callback и inline запроса
+    (для личных чатов бота это одно и то же).
+    :param update: Обновление Telegram в виде json объекта.
+    :return: ID чата или None для обновлений других типов.
+    """
+    for kind in ('message', 'edited_message', 'callback_query', 'inline_query'):
+        item = update.get(kind)
+        if item:
+            return item['chat']['id'] if 'chat' in item else item['from']['id']
+    return None
+
+
+def chat_key(update: dict) -> int:
+    """
+    Ключ распределения обновления по процессам.
+    :param update: Обновление Telegram в виде json объекта.
+    :return: ID чата, для обновлений других типов - update_id.
+    """
+    chat_id = update_chat_id(update)
+    return update['update_id'] if chat_id is None else chat_id
+
+
+def worker_env(index: int, workers: int) -> dict:
+    """
+    Переменные окружения процесса-обработчика: доля общих лимитов,
+    свой порт метрик и свои файлы file_ids и индекса городов (каждый процесс
+    переписывает свой файл целиком). Счетчик запросов к api - общий файл
+    для всех процессов, квота не делится, чтобы не терять ее при изменении
+    числа процессов.
+    :param index: Номер процесса.
+    :param workers: Количество процессов, между которыми делятся лимиты.
+    :return: Словарь переменных окружения.
+    """
+    env = {}
+    for name, default in SHARED_LIMITS.items():
+        value = config(name, default=default, cast=type(default))
+        if isinstance(default, int):
+            env[name] = str(max(1, value // workers) if value > 0 else 0)
+        else:
+            env[name] = str(value / workers)
+    env['db_pool_min'] = str(min(config('db_pool_min', default=1, cast=int),
+                                 int(env['db_pool_max'])))
+
+    metrics_port = config('metrics_port', default=9108, cast=int)
+    env['metrics_port'] = str(metrics_port + 1 + index if metrics_port else 0)
+    env['api_usage_path'] = config('api_usage_path', default='api_usage.json')
+    for name, default in (('file_ids_path', 'file_ids.json'),
+                          ('destinations_index_path', 'destinations.json')):
+        path = config(name, default=default)
+        if path:
+            root, ext = os.path.splitext(path)
+            path = '{}.worker{}{}'.format(root, index, ext)
+        env[name] = path
+    return env
+
+
+class Worker:
+    """
+    Процесс-обработчик со своей очередью обновлений.
+    """
+
+    def __init__(self, index: int, workers: int, target, context, queue_size: int) -> None:
+        """
+        :param index: Номер процесса.
+        :param workers: Количество процессов при запуске, для доли лимитов.
+        :param target: Функция процесса target(updates), определенная на уровне модуля.
+        :param context: Контекст multiprocessing.
+        :param queue_size: Максимальный размер очереди.
+        """
+        self.index = index
+        self.name = 'worker-{}'.format(index)
+        self.env = worker_env(index, workers)
+        self.target = target
+        self.context = context
+        self.queue = context.Queue(maxsize=queue_size)
+        self.process = None
+        self.draining = False
+        self.stopping = False
+        self.last_update = time.monotonic()
+
+    def start(self) -> None:
+        """
+        Запуск процесса. Процесс получает окружение супервизора с переменными self.env,
+        модули бота читают настройки при импорте уже с ними.
+        """
+        saved = {name: os.environ.get(name) for name in self.env}
+        os.environ.update(self.env)
+        try:
+            self.process = self.context.Process(target=self.target, args=(self.queue,),
+                                                name=self.name)
+            self.process.start()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        logger.info('supervisor - {name} started, pid {pid}'.format(name=self.name,
+                                                                    pid=self.process.pid))
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def qsize(self) -> int:
+        """
+        Длина очереди, -1 если платформа ее не сообщает.
+        """
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def stop(self) -> None:
+        """
+        Просьба завершиться: процесс обработает уже полученные обновления и выйдет.
+        """
+        self.stopping = True
+        self.queue.put(None)
+
+
+class Supervisor:
+    """
+    Распределение обновлений по процессам-обработчикам, перезапуск упавших процессов
+    и изменение их количества без потери начатых диалогов.
+    """
+
+    def __init__(self, target, workers: int, queue_size: int = 1000, sticky_ttl: float = 3600,
+                 check_interval: float = 10) -> None:
+        """
+        :param target: Функция процесса-обработчика target(updates), определенная
+            на уровне модуля (запускается через spawn).
+        :param workers: Начальное количество процессов.
+        :param queue_size: Размер очереди каждого процесса.
+        :param sticky_ttl: Сколько секунд без обновлений чат остается закрепленным за процессом.
+        :param check_interval: Период проверки процессов, секунд.
+        """
+        self.target = target
+        self.queue_size = queue_size
+        self.sticky_ttl = sticky_ttl
+        self.check_interval = check_interval
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.target_count = workers
+        self._assignments = TTLCache(maxsize=config('session_store_size', default=100000, cast=int),
+                                     ttl=sticky_ttl)
+        self._next_index = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._monitor = threading.Thread(target=self._run_monitor, name='supervisor', daemon=True)
+
+    def start(self) -> None:
+        self._scale()
+        self._monitor.start()
+
+    def put(self, update: dict, block: bool = False) -> bool:
+        """
+        Передача обновления процессу, за которым закреплен чат, новый чат
+        закрепляется за процессом по chat_id среди процессов, принимающих новые чаты.
+        :param update: Обновление Telegram в виде json объекта.
+        :param block: Ждать места в очереди процесса.
+        :return: False, если очередь процесса переполнена.
+        """
+        key = chat_key(update)
+        with self._lock:
+            worker = self._assignments.get(key)
+            if worker is None or worker.stopping:
+                active = [item for item in self.workers if not item.draining]
+                worker = active[key % len(active)]
+            self._assignments.set(key, worker)
+            worker.last_update = time.monotonic()
+        try:
+            worker.queue.put(update, block=block)
+        except queue.Full:
+            return False
+        WORKER_UPDATES.inc(worker.name)
+        return True
+
+    def resize(self, delta: int) -> None:
+        """
+        Изменение количества процессов, применяется потоком проверки.
+        Безопасно вызывать из обработчика сигнала.
+        :param delta: +1 или -1.
+        """
+        self.target_count = max(1, self.target_count + delta)
+        self._wakeup.set()
+
+    def stats(self) -> list:
+        """
+        Состояние процессов для мониторинга.
+        :return: Список словарей name, pid, alive, draining, queue.
+        """
+        with self._lock:
+            workers = list(self.workers)
+        return [{'name': worker.name, 'pid': worker.process.pid if worker.process else None,
+                 'alive': worker.is_alive(), 'draining': worker.draining,
+                 'queue': worker.qsize()} for worker in workers]
+
+    def stop(self, timeout: float = 30) -> None:
+        """
+        Завершение всех процессов: каждый обрабатывает уже полученные обновления.
+        :param timeout: Сколько секунд ждать каждый процесс до принудительного завершения.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        with self._lock:
+            workers = list(self.workers)
+        for worker in workers:
+            if not worker.stopping:
+                worker.stop()
+        for worker in workers:
+            if worker.process is None:
+                continue
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                logger.warning('supervisor - {name} terminated'.format(name=worker.name))
+                worker.process.terminate()
+
+    def _scale(self) -> None:
+        with self._lock:
+            active = [worker for worker in self.workers if not worker.draining]
+            for worker in active[self.target_count:]:
+                worker.draining = True
+                logger.info('supervisor - {name} draining'.format(name=worker.name))
+            for _ in range(self.target_count - len(active)):
+                worker = Worker(self._next_index, self.target_count, self.target, self.context,
+                                self.queue_size)
+                self._next_index += 1
+                worker.start()
+                self.workers.append(worker)
+
+    def _run_monitor(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return
+            self._scale()
+            self._check()
+
+    def _check(self) -> None:
+        """
+        Проверка процессов: упавшие перезапускаются с той же очередью, лишние
+        завершаются, когда за ними не осталось закрепленных чатов, метрики обновляются.
+        """
+        now = time.monotonic()
+        with self._lock:
+            workers = list(self.workers)
+        for worker in workers:
+            alive = worker.is_alive()
+            if worker.stopping and not alive:
+                with self._lock:
+                    self.workers.remove(worker)
+                WORKER_UP.set(worker.name, value=0)
+                WORKER_QUEUE.set(worker.name, value=0)
+                logger.info('supervisor - {name} stopped'.format(name=worker.name))
+                continue
+            if not alive and not worker.stopping:
+                WORKER_RESTARTS.inc(worker.name)
+                logger.error('supervisor - {name} exited with code {code}, restarting'.format(
+                    name=worker.name, code=worker.process.exitcode))
+                worker.start()
+            elif (worker.draining and not worker.stopping and worker.qsize() <= 0
+                  and now - worker.last_update > self.sticky_ttl):
+                worker.stop()
+            WORKER_UP.set(worker.name, value=1 if worker.is_alive() else 0)
+            WORKER_QUEUE.set(worker.name, value=worker.qsize())
+        logger.debug('supervisor - ' + ', '.join(
+            '{name}: alive={alive} draining={draining} queue={queue}'.format(**item)
+            for item in self.stats()))
+
+
+def serve_worker(bot: telebot.TeleBot, updates, on_chat=None) -> None:
+    """
+    Цикл процесса-обработчика: обновления из очереди супервизора обрабатываются
+    пулом потоков webhook.UpdateWorkers, None - сигнал завершения.
+    :param bot: Экземпляр бота этого процесса.
+    :param updates: Очередь multiprocessing от супервизора.
+    :param on_chat: Функция on_chat(chat_id), вызывается перед передачей обновления
+        чата в пул потоков, например для загрузки диалога чата.
+    :return:
+    """
+    # Ctrl+C и SIGTERM при остановке сервиса получает вся группа процессов,
+    # завершением процессов управляет супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    parent = os.getppid()
+    workers = webhook.UpdateWorkers(bot, workers=config('worker_threads', default=4, cast=int),
+                                    queue_size=config('worker_queue_size', default=1000, cast=int))
+    workers.start()
+    logger.info('worker {pid} - ready'.format(pid=os.getpid()))
+    while True:
+        try:
+            update = updates.get(timeout=PARENT_CHECK_INTERVAL)
+        except queue.Empty:
+            if os.getppid() != parent:
+                # супервизор завершился, не остановив процесс (например, SIGKILL)
+                logger.warning('worker {pid} - supervisor is gone'.format(pid=os.getpid()))
+                break
+            continue
+        if update is None:
+            break
+        chat_id = update_chat_id(update)
+        if on_chat is not None and chat_id is not None:
+            try:
+                on_chat(chat_id)
+            except Exception:
+                logger.error(traceback.format_exc())
+        workers.put(update, block=True)
+    workers.queue.join()
+    logger.info('worker {pid} - stopped'.format(pid=os.getpid()))
+
+
+def run(bot: telebot.TeleBot, target, workers: int) -> None:
+    """
+    Запуск бота в многопроцессном режиме. Количество процессов меняется сигналами
+    SIGTTIN (+1) и SIGTTOU (-1), как у gunicorn. SIGTERM и Ctrl+C останавливают
+    получение обновлений, процессы обрабатывают полученные обновления и завершаются.
+    :param bot: Экземпляр бота (для получения обновлений).
+    :param target: Функция процесса-обработчика target(updates), определенная на уровне модуля.
+    :param workers: Начальное количество процессов.
+    :return:
+    """
+    supervisor = Supervisor(target, workers,
+                            queue_size=config('worker_queue_size', default=1000, cast=int),
+                            sticky_ttl=config('session_ttl', default=60 * 60, cast=int),
+                            check_interval=config('supervisor_check_interval', default=10,
+                                                  cast=float))
+    webhook.stop_on_sigterm()
+    supervisor.start()
+    if hasattr(signal, 'SIGTTIN'):
+        signal.signal(signal.SIGTTIN, lambda *_: supervisor.resize(1))
+        signal.signal(signal.SIGTTOU, lambda *_: supervisor.resize(-1))
+    metrics.register_gauge('bot_workers', 'Количество процессов-обработчиков',
+                           lambda: len(supervisor.workers))
+    logger.info('Supervisor mode, {count} workers'.format(count=workers))
+    try:
+        if config('bot_mode', default='polling') == 'webhook':
+            webhook.run_webhook(bot, router=supervisor)
+        else:
+            webhook.run_polling_router(bot, supervisor)
+    except KeyboardInterrupt:
+        logger.info('Supervisor stopping')
+    finally:
+        # повторный SIGTERM не прерывает ожидание процессов
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        supervisor.stop()
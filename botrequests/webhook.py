@@ -0,0 +1,252 @@
+"""
+Получение обновлений от Telegram:
+    Webhook режим: встроенный HTTP сервер, проверка секретного токена,
+    ограниченная очередь обновлений и пул обработчиков
+    Long polling режим (запасной): фильтр allowed_updates и
+    экспоненциальная задержка при ошибках
+    Оба режима могут передавать обновления не боту, а супервизору процессов (supervisor.py)
+    SIGTERM завершает оба режима так же, как Ctrl+C
+"""
+import hmac
+import json
+import queue
+import random
+import secrets
+import signal
+import ssl
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import telebot
+from decouple import config
+from loguru import logger
+
+# Типы обновлений, которые обрабатывает бот
+ALLOWED_UPDATES = ['message', 'callback_query', 'inline_query']
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateWorkers:
+    """
+    Ограниченная очередь обновлений и пул потоков, передающих их боту.
+    """
+
+    def __init__(self, bot: telebot.TeleBot, workers: int, queue_size: int) -> None:
+        """
+        :param bot: Экземпляр бота.
+        :param workers: Количество потоков-обработчиков.
+        :param queue_size: Максимальный размер очереди.
+        """
+        self.bot = bot
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = [threading.Thread(target=self._work, name='update-worker-{}'.format(i),
+                                         daemon=True) for i in range(workers)]
+
+    def start(self) -> None:
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, update: dict, block: bool = False) -> bool:
+        """
+        Постановка обновления в очередь.
+        :param update: Обновление Telegram в виде json объекта.
+        :param block: Ждать места в очереди.
+        :return: False, если очередь переполнена.
+        """
+        try:
+            self.queue.put(update, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def _work(self) -> None:
+        while True:
+            update = self.queue.get()
+            try:
+                self.bot.process_new_updates([telebot.types.Update.de_json(update)])
+            except Exception:
+                logger.error(traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+
+def _interrupt(signum, frame) -> None:
+    raise KeyboardInterrupt('signal {}'.format(signum))
+
+
+def stop_on_sigterm() -> None:
+    """
+    SIGTERM (kill, остановка при деплое) завершает главный поток так же, как Ctrl+C:
+    polling telebot останавливается штатно, выполняются блоки finally
+    и остановка фоновой записи.
+    Вызывается из главного потока.
+    """
+    signal.signal(signal.SIGTERM, _interrupt)
+
+
+def _make_handler(workers, path: str, secret: str):
+    """
+    Создание класса обработчика HTTP запросов webhook.
+    :param workers: Очередь обновлений: UpdateWorkers или supervisor.Supervisor.
+    :param path: Путь webhook.
+    :param secret: Секретный токен.
+    :return: Класс BaseHTTPRequestHandler.
+    """
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self) -> None:
+            if self.path != path:
+                self.send_error(404)
+                return
+            if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), secret):
+                logger.warning('webhook - wrong secret token from {}'.format(self.client_address[0]))
+                self.send_error(403)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                update = json.loads(self.rfile.read(length))
+                if not isinstance(update, dict) or 'update_id' not in update:
+                    raise ValueError('not an update')
+            except ValueError:
+                self.send_error(400)
+                return
+            if not workers.put(update):
+                # Telegram повторит доставку обновления позже
+                logger.warning('webhook - update queue is full')
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format: str, *args) -> None:
+            logger.debug('webhook - ' + format % args)
+
+    return WebhookHandler
+
+
+def run_webhook(bot: telebot.TeleBot, router=None) -> None:
+    """
+    Запуск бота в webhook режиме: регистрирует webhook в Telegram
+    и обслуживает входящие обновления встроенным HTTP сервером.
+    :param bot: Экземпляр бота.
+    :param router: Получатель обновлений с методом put(update, block) -> bool,
+        None - пул потоков UpdateWorkers этого процесса.
+    :return:
+    """
+    secret = config('webhook_secret', default='') or secrets.token_urlsafe(32)
+    path = '/{}'.format(config('webhook_path', default='telegram'))
+    workers = router
+    if workers is None:
+        workers = UpdateWorkers(bot, workers=config('webhook_workers', default=4, cast=int),
+                                queue_size=config('webhook_queue_size', default=1000, cast=int))
+        workers.start()
+
+    server = ThreadingHTTPServer(
+        (config('webhook_listen', default='0.0.0.0'), config('webhook_port', default=8443, cast=int)),
+        _make_handler(workers, path, secret)
+    )
+    ssl_cert = config('webhook_ssl_cert', default='')
+    if ssl_cert:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(ssl_cert, config('webhook_ssl_key'))
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+
+    # secret_token появился в Bot API 6.1, поэтому запрос отправляется напрямую
+    telebot.apihelper._make_request(bot.token, 'setWebhook', method='post', params={
+        'url': config('webhook_url').rstrip('/') + path,
+        'secret_token': secret,
+        'allowed_updates': json.dumps(ALLOWED_UPDATES),
+        'max_connections': config('webhook_max_connections', default=40, cast=int)
+    })
+    logger.info('Webhook mode, listening on {}:{}{}'.format(*server.server_address, path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+class PollingErrors(telebot.ExceptionHandler):
+    """
+    Запоминает ошибку, на которой остановился bot.polling(non_stop=False):
+    ошибки api polling записывает в лог и просто завершается, а по этой отметке
+    run_polling отличает ошибку от обычной остановки.
+    """
+
+    def __init__(self) -> None:
+        self.error = None
+
+    def handle(self, exception) -> bool:
+        self.error = exception
+        return False
+
+
+def run_polling(bot: telebot.TeleBot) -> None:
+    """
+    Запуск бота в режиме long polling. Polling запускается без non_stop, поэтому
+    ошибки сети и api не повторяются внутри telebot, а завершают polling,
+    и запуск повторяется с экспоненциальной задержкой и jitter.
+    :param bot: Экземпляр бота.
+    :return:
+    """
+    bot.remove_webhook()
+    errors = PollingErrors()
+    bot.exception_handler = errors
+    max_delay = config('polling_max_backoff', default=300, cast=float)
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        errors.error = None
+        try:
+            bot.polling(non_stop=False, interval=0,
+                        timeout=config('polling_timeout', default=20, cast=int),
+                        long_polling_timeout=config('polling_long_timeout', default=50, cast=int),
+                        allowed_updates=ALLOWED_UPDATES)
+            if errors.error is None:
+                return
+        except (requests.exceptions.RequestException, telebot.apihelper.ApiException):
+            logger.error(traceback.format_exc())
+        if time.monotonic() - started > max_delay:
+            attempt = 0
+        delay = random.uniform(0, min(max_delay, 2 ** attempt))
+        attempt += 1
+        logger.info('Polling restart in {:.1f} s'.format(delay))
+        time.sleep(delay)
+
+
+def run_polling_router(bot: telebot.TeleBot, router) -> None:
+    """
+    Long polling для супервизора процессов: обновления не обрабатываются ботом,
+    а передаются router. Следующий getUpdates подтверждает обновления, которые
+    уже поставлены в очередь, при переполненной очереди получение обновлений ждет.
+    :param bot: Экземпляр бота (нужен токен).
+    :param router: Получатель обновлений с методом put(update, block) -> bool.
+    :return:
+    """
+    bot.remove_webhook()
+    max_delay = config('polling_max_backoff', default=300, cast=float)
+    offset = None
+    attempt = 0
+    while True:
+        try:
+            updates = telebot.apihelper.get_updates(
+                bot.token, offset=offset,
+                timeout=config('polling_timeout', default=20, cast=int),
+                allowed_updates=ALLOWED_UPDATES,
+                long_polling_timeout=config('polling_long_timeout', default=50, cast=int))
+        except (requests.exceptions.RequestException, telebot.apihelper.ApiException):
+            logger.error(traceback.format_exc())
+            delay = random.uniform(0, min(max_delay, 2 ** attempt))
+            attempt += 1
+            logger.info('Polling retry in {:.1f} s'.format(delay))
+            time.sleep(delay)
+            continue
+        attempt = 0
+        for update in updates:
+            router.put(update, block=True)
+            offset = update['update_id'] + 1
@@ -2,30 +2,32 @@
 Телеграм бот для получения отелей по запросу с сайта hotels.com
 посредством request запросов на api dojo hotels.com
 """
+from botrequests import startup  # первым: от его импорта считается время запуска
 import json
-import re
 import datetime
-import random
-import time
 import traceback
 
-import requests.exceptions
+import requests
 import telebot
-from telegram_bot_calendar import DetailedTelegramCalendar, LSTEP
 from loguru import logger
 from decouple import config
 from telebot import types
-from botrequests import bestdeal, api_requests, postgres_database
+from botrequests import bestdeal, api_requests, postgres_database, delivery, cards, webhook, sessions, \
+    metrics, destinations, api_scheduler, supervisor, conversations, calendar_keyboard
+from botrequests.history_writer import history_writer
+from botrequests.hotels import Hotel
 
 logger.add('debug.log', format='{time} {level} {message}',
            level='DEBUG', rotation='10 MB', compression='zip'
            )
 
-bot = telebot.TeleBot(config('Token'))
+bot = telebot.TeleBot(config('Token'), next_step_backend=conversations.handler_backend)
+delivery_engine = delivery.DeliveryEngine(bot)
 
 
 @logger.catch
 @bot.message_handler(commands=['start'])
+@metrics.HANDLERS.timed
 def start_message(message: types.Message) -> None:
     """
     Функция обработчик команды start, добавляет пользователя в БД,
@@ -41,6 +43,7 @@ def start_message(message: types.Message) -> None:
 
 @logger.catch
 @bot.message_handler(commands=['lowprice'])
+@metrics.HANDLERS.timed
 def low_price(message: types.Message) -> None:
     """
     Функция обработчик команды lowprice, отправляет сообщение пользователю и
@@ -48,12 +51,13 @@ def low_price(message: types.Message) -> None:
     :param message: Команда от пользователя.
     :return:
     """
-    bot.send_message(message.chat.id, 'Введите город в котором необходимо найти отели. Латиницей.')
+    bot.send_message(message.chat.id, 'Введите город в котором необходимо найти отели.')
     bot.register_next_step_handler(message, get_city, command='l')
 
 
 @logger.catch
 @bot.message_handler(commands=['highprice'])
+@metrics.HANDLERS.timed
 def high_price(message: types.Message) -> None:
     """
     Функция обработчик команды highprice, отправляет сообщение пользователю и
@@ -61,12 +65,13 @@ def high_price(message: types.Message) -> None:
     :param message: Команда от пользователя.
     :return:
     """
-    bot.send_message(message.chat.id, 'Введите город в котором необходимо найти отели. Латиницей.')
+    bot.send_message(message.chat.id, 'Введите город в котором необходимо найти отели.')
     bot.register_next_step_handler(message, get_city, command='h')
 
 
 @logger.catch
 @bot.message_handler(commands=['bestdeal'])
+@metrics.HANDLERS.timed
 def best_deal(message: types.Message) -> None:
     """
     Функция обработчик команды bestdeal, отправляет сообщение пользователю и
@@ -74,47 +79,70 @@ def best_deal(message: types.Message) -> None:
     :param message: Команда от пользователя.
     :return:
     """
-    bot.send_message(message.chat.id, 'Введите город в котором необходимо найти отели. Латиницей.')
+    bot.send_message(message.chat.id, 'Введите город в котором необходимо найти отели.')
     bot.register_next_step_handler(message, get_city, command='b')
 
 
 @logger.catch
 @bot.message_handler(commands=['history'])
+@metrics.HANDLERS.timed
 def history(message: types.Message) -> None:
     """
-    Функция обработчик для команды history, делает запрос в БД,
-    получает zip объект по которому проходится циклом и отправляет пользователю информацию.
+    Функция обработчик для команды history, отправляет пользователю
+    первую страницу истории.
     :param message: Сообщение команда "history"
     :return:
     """
-    try:
-        results = postgres_database.get_history(message.from_user.id)
-        for info, result in results:
-            keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
-            hotels_name = []
-
-            for hotel in result[0]:
-                url = 'https://hotels.com/ho{id}'.format(id=hotel['id'])
-                url_button = telebot.types.InlineKeyboardButton(text=hotel['name'], url=url)
-                hotels_name.append(hotel['name'])
-                keyboard.add(url_button)
-
-            hotels_name = ", ".join(hotels_name)
-            text_message = f"Command: {info[0]}\n" \
-                           f"Date and Time: {info[1]}\n" \
-                           f"Hotel name: {hotels_name}"
-            bot.send_message(message.from_user.id, text_message, reply_markup=keyboard)
-    except TypeError:
-        logger.info('{id} - history - empty'.format(id=str(message.from_user.id)))
-        bot.send_message(message.from_user.id, 'История пуста.')
-    except IndexError:
-        logger.error(traceback.format_exc())
-    else:
-        logger.info('{id} - history - ok'.format(id=str(message.from_user.id)))
+    send_history_page(message.from_user.id)
+
+
+@logger.catch
+@bot.callback_query_handler(func=lambda c: c.data.startswith('n'))
+@metrics.HANDLERS.timed
+def history_next_page(callback_query: types.CallbackQuery) -> None:
+    """
+    Функция обработчик inline кнопки следующей страницы истории.
+    :param callback_query: запрос обратного вызова, содержит ключ (дату и время, seq)
+        последней показанной записи
+    """
+    bot.edit_message_reply_markup(callback_query.message.chat.id,
+                                  callback_query.message.message_id)
+    send_history_page(callback_query.from_user.id,
+                      cards.parse_history_cursor(callback_query.data))
+
+
+def send_history_page(user_id: int, before: tuple = None) -> None:
+    """
+    Функция отправки страницы истории: делает запрос в БД, проходится циклом по записям
+    и отправляет пользователю информацию, при наличии следующей страницы
+    добавляет кнопку "Показать еще".
+    :param user_id: ID пользователя
+    :param before: Ключ (datetime, seq) последней показанной записи
+    :return:
+    """
+    page_size = config('history_page_size', default=5, cast=int)
+    results = postgres_database.get_history(user_id, before, page_size)
+    if not results:
+        logger.info('{id} - history - empty'.format(id=str(user_id)))
+        bot.send_message(user_id, 'История пуста.' if before is None else 'Больше записей нет.')
+        return
+
+    for command, date_time, hotels, _ in results[:page_size]:
+        text_message, keyboard = cards.history_message(command, date_time, hotels or [])
+        bot.send_message(user_id, text_message, reply_markup=keyboard)
+
+    if len(results) > page_size:
+        _, date_time, _, seq = results[page_size - 1]
+        keyboard = telebot.types.InlineKeyboardMarkup()
+        keyboard.add(telebot.types.InlineKeyboardButton(
+            text='Показать еще', callback_data=cards.history_cursor(date_time, seq)))
+        bot.send_message(user_id, 'Показаны последние записи.', reply_markup=keyboard)
+    logger.info('{id} - history - ok'.format(id=str(user_id)))
 
 
 @logger.catch
 @bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
 def get_text_messages(message: types.Message) -> None:
     """
     Функция обработчик любого текстового сообщения, отправляет сообщение.
@@ -126,7 +154,24 @@ def get_text_messages(message: types.Message) -> None:
     bot.send_message(message.chat.id, text_message)
 
 
+@logger.catch
+@bot.inline_handler(func=lambda inline_query: True)
+@metrics.HANDLERS.timed
+def inline_destinations(inline_query: types.InlineQuery) -> None:
+    """
+    Функция обработчик inline запроса (@bot Par...), отвечает вариантами местоположения
+    из локального индекса destinations без запроса к api.
+    :param inline_query: Inline запрос пользователя.
+    :return:
+    """
+    matches = destinations.index.search(inline_query.query, limit=20)
+    captions = [(entry['caption'], entry['id']) for _, entry in matches]
+    bot.answer_inline_query(inline_query.id, cards.inline_destinations(captions),
+                            cache_time=config('inline_cache_time', default=300, cast=int))
+
+
 @bot.callback_query_handler(func=lambda c: c.data.startswith('q'))
+@metrics.HANDLERS.timed
 def get_photo_answer(callback_query):
     """
         Функция обработчик inline кнопки получения фотографии,
@@ -142,26 +187,28 @@ def get_photo_answer(callback_query):
 
 @logger.catch
 @bot.callback_query_handler(func=lambda c: c.data.startswith('b'))
+@metrics.HANDLERS.timed
 def get_city_callback_bestdeal(callback_query):
     """
     Функция обработчик города следования для команды bestdeal, получает ответ пользователя,
-    передает его в БД, переходит к следующему шагу.
+    начинает сессию поиска, переходит к следующему шагу.
     :param callback_query: запрос обратного вызова с сообщением
     """
-    postgres_database.add_destination_id(callback_query)
+    sessions.start_session(callback_query.from_user.id, callback_query.data)
     bot.send_message(callback_query.from_user.id, 'Введите минимальную стоимость в USD за ночь')
     bot.register_next_step_handler_by_chat_id(callback_query.from_user.id, get_price_min)
 
 
 @logger.catch
 @bot.callback_query_handler(func=lambda c: c.data.startswith('l') or c.data.startswith('h'))
+@metrics.HANDLERS.timed
 def get_city_callback_low_and_high_price(callback_query: types.CallbackQuery):
     """
     Функция обработчик города следования для команд lowprice и hig  hprice,
-    получает ответ пользователя, передает его в БД, переходит к следующему шагу.
+    получает ответ пользователя, начинает сессию поиска, переходит к следующему шагу.
     :param callback_query: запрос обратного вызова с сообщение
     """
-    postgres_database.add_destination_id(callback_query)
+    sessions.start_session(callback_query.from_user.id, callback_query.data)
     get_check_in(callback_query)
 
 
@@ -173,28 +220,28 @@ def get_check_in(callback_query: [types.Message, types.CallbackQuery]):
     """
     text = "Выберите дату заезда"
     bot.send_message(callback_query.from_user.id, text)
-    date_today = datetime.date.today()
-    calendar, step = DetailedTelegramCalendar(
-        calendar_id=1, locale='ru', min_date=date_today
-    ).build()
-    bot.send_message(callback_query.from_user.id, f"Выберите {LSTEP[step]}", reply_markup=calendar)
+    calendar, text = calendar_keyboard.build(1, datetime.date.today())
+    bot.send_message(callback_query.from_user.id, text, reply_markup=calendar)
 
 
 @logger.catch
-@bot.callback_query_handler(func=DetailedTelegramCalendar.func(calendar_id=1))
+@bot.callback_query_handler(func=calendar_keyboard.callback_filter(1))
+@metrics.HANDLERS.timed
 def calendar_1(callback_query: types.CallbackQuery) -> None:
     """
         Функция обработчик календаря, выводит клавиатуру с календарем и ожидает ответ,
-        передает ответ в БД,
+        записывает ответ в сессию поиска,
         и переходит к следующему шагу
         :param callback_query: запрос обратного вызова с сообщением
     """
-    date = datetime.date.today()
-    result, key, step = DetailedTelegramCalendar(
-        calendar_id=1, locale='ru', min_date=date
-    ).process(callback_query.data)
+    # навигация по календарю только читает сессию, без записи диалога в БД
+    session = sessions.peek_session(callback_query.message.chat.id)
+    if session is None:
+        session_expired(callback_query.message.chat.id)
+        return
+    result, key, text = calendar_keyboard.process(1, datetime.date.today(), callback_query.data)
     if not result and key:
-        bot.edit_message_text(f"Выберите {LSTEP[step]}",
+        bot.edit_message_text(text,
                               callback_query.message.chat.id,
                               callback_query.message.message_id,
                               reply_markup=key)
@@ -202,42 +249,42 @@ def calendar_1(callback_query: types.CallbackQuery) -> None:
         bot.edit_message_text(f"Вы выбрали {result}",
                               callback_query.message.chat.id,
                               callback_query.message.message_id)
-        postgres_database.add_check_in(chat_id=callback_query.message.chat.id, date=str(result))
-        get_check_out(callback_query.message.chat.id)
+        sessions.update_session(callback_query.message.chat.id, check_in=result)
+        get_check_out(callback_query.message.chat.id, result)
 
 
 @logger.catch
-def get_check_out(chat_id: int) -> None:
+def get_check_out(chat_id: int, check_in: datetime.date) -> None:
     """
         Функция вызова даты выезда
         :param chat_id: ID чата
+        :param check_in: Дата заезда
     """
-    date_today = (datetime.datetime.strptime(postgres_database.get_check_in(chat_id=chat_id),
-                                             "%Y-%m-%d") + datetime.timedelta(days=1)).date()
+    date_today = check_in + datetime.timedelta(days=1)
     text = "Выберите дату выезда"
     bot.send_message(chat_id, text)
-    calendar, step = DetailedTelegramCalendar(
-        calendar_id=2, locale='ru', min_date=date_today
-    ).build()
-    bot.send_message(chat_id, f"Выберите {LSTEP[step]}", reply_markup=calendar)
+    calendar, text = calendar_keyboard.build(2, date_today)
+    bot.send_message(chat_id, text, reply_markup=calendar)
 
 
 @logger.catch
-@bot.callback_query_handler(func=DetailedTelegramCalendar.func(calendar_id=2))
+@bot.callback_query_handler(func=calendar_keyboard.callback_filter(2))
+@metrics.HANDLERS.timed
 def calendar_2(callback_query: types.CallbackQuery) -> None:
     """
         Функция обработчик календаря, выводит клавиатуру с календарем и ожидает ответ,
-        передает ответ в БД,
+        записывает ответ в сессию поиска,
         и переходит к следующему шагу
     :param callback_query: запрос обратного вызова с сообщением
     """
-    date_today = (datetime.datetime.strptime(postgres_database.get_check_in(
-        chat_id=callback_query.message.chat.id), "%Y-%m-%d") + datetime.timedelta(days=1)).date()
-
-    result, key, step = DetailedTelegramCalendar(calendar_id=2, locale='ru',
-                                                 min_date=date_today).process(callback_query.data)
+    session = sessions.peek_session(callback_query.message.chat.id)
+    if session is None or session.check_in is None:
+        session_expired(callback_query.message.chat.id)
+        return
+    date_today = session.check_in + datetime.timedelta(days=1)
+    result, key, text = calendar_keyboard.process(2, date_today, callback_query.data)
     if not result and key:
-        bot.edit_message_text(f"Выберите {LSTEP[step]}",
+        bot.edit_message_text(text,
                               callback_query.message.chat.id,
                               callback_query.message.message_id,
                               reply_markup=key)
@@ -245,7 +292,7 @@ def calendar_2(callback_query: types.CallbackQuery) -> None:
         bot.edit_message_text(f"Вы выбрали {result}",
                               callback_query.message.chat.id,
                               callback_query.message.message_id)
-        postgres_database.add_check_out(chat_id=callback_query.from_user.id, date=str(result))
+        sessions.update_session(callback_query.message.chat.id, check_out=result)
         send_message_how_much_results(callback_query.from_user.id)
 
 
@@ -263,30 +310,25 @@ def send_message_how_much_results(user_id: int) -> None:
 
 
 @logger.catch
+@metrics.HANDLERS.timed
 def get_city(message: types.Message, command: str) -> None:
     """
     Функция отправки inline кнопок уточняющих у пользователя необходимое ему местоположение.
-    Получает город, отправляет в функцию api_request запрос полученный результат записывает
-    в city_json_data, проходит циклом по city_json_data и отправляет пользователю
-    возможные варианты, не более 10.
+    Получает город (латиницей или кириллицей), запрашивает варианты в api_requests
+    (с кэшем и локальным индексом), записывает их в suggestions, проходит циклом
+    по suggestions и отправляет пользователю возможные варианты, не более 10.
     :param message: Сообщение от пользователя должно содержать город поиска.
     :param command: Сокращенное обозначение команды от пользователя.
     :return:
     """
     try:
-        if re.search(r'[а-яА-ЯёЁ]', message.text):
-            raise TypeError
+        if not message.text:
+            raise LookupError
         bot.send_message(message.chat.id, "Работаю.")
-        city_json_data = api_requests.get_request_search(message)
-        buttons = {}
-        pattern2 = r"<span class=\'highlighted\'>"
-        pattern1 = r"</span>"
-
-        for entities in city_json_data['suggestions'][0]['entities']:
-            key = entities['caption']
-            key = re.sub(pattern1, '', key)
-            key = re.sub(pattern2, '', key)
-            buttons[key] = entities['destinationId']
+        suggestions = api_requests.get_city_suggestions(message)
+        buttons = dict(suggestions['captions'])
+        if not buttons:
+            raise LookupError
 
         keyboard = telebot.types.InlineKeyboardMarkup()
 
@@ -295,32 +337,36 @@ def get_city(message: types.Message, command: str) -> None:
                 text=str(item), callback_data='{} {}'.format(command, value))
             keyboard.add(button)
         text_messege = 'Найдено {} совпадений выберите более подходящий вариант.'.format(
-            city_json_data['moresuggestions'])
+            suggestions['moresuggestions'])
         bot.send_message(message.chat.id, text_messege, reply_markup=keyboard)
 
-    except TypeError:
+    except LookupError:
         bot.send_message(
-            message.from_user.id, 'Название города должно быть написано латиницей.\n'
+            message.from_user.id, 'Не нашел такой город.\n'
                                   'Давайте попробуем еще раз.\n'
                                   'Введите город в котором необходимо найти отели.')
         bot.register_next_step_handler(message, get_city, command=command)
     else:
-        logger.info('{id} - get_photo_answer - ok'.format(id=str(message.from_user.id)))
+        logger.info('{id} - get_city - ok'.format(id=str(message.from_user.id)))
 
 
 @logger.catch
 @bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
 def get_price_min(message: types.Message) -> None:
     """
         Функция для получения минимальной стоимости команды bestdeal,
-        полученное значение отправляет в БД, и переходит к следующему шагу.
+        полученное значение записывает в сессию поиска, и переходит к следующему шагу.
         Функция обрабатывает полученное значение на тип.
         :param message:
         :return:
         """
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        session_expired(message.from_user.id)
+        return
     try:
-        float(message.text)
-        postgres_database.add_price_min(message.from_user.id, message.text)
+        sessions.update_session(message.from_user.id, price_min=int(float(message.text)))
         bot.send_message(message.from_user.id, 'Введите максимальную стоимость в USD за ночь.')
         bot.register_next_step_handler_by_chat_id(
             message.from_user.id, get_price_max, price_min=message.text
@@ -337,19 +383,24 @@ def get_price_min(message: types.Message) -> None:
 
 @logger.catch
 @bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
 def get_price_max(message: types.Message, price_min: str) -> None:
     """
         Функция для получения минимальной стоимости команды bestdeal,
-        полученное значение отправляет в БД, и переходит к следующему шагу.
+        полученное значение записывает в сессию поиска, и переходит к следующему шагу.
         Функция обрабатывает полученное значение на тип.
         :param price_min: Минимальная цена, которую пользователь ввел на прошлом шагу.
         :param message:
         :return:
         """
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        session_expired(message.from_user.id)
+        return
     try:
         if float(message.text) < float(price_min):
             raise ImportError
-        postgres_database.add_price_max(message.from_user.id, message.text)
+        sessions.update_session(message.from_user.id, price_max=int(float(message.text)))
         text_message = 'Введите минимальное удаление от центра. В километрах.'
         bot.send_message(message.from_user.id, text_message)
         bot.register_next_step_handler_by_chat_id(message.from_user.id, get_distance_min)
@@ -375,19 +426,21 @@ def get_price_max(message: types.Message, price_min: str) -> None:
 
 @logger.catch
 @bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
 def get_distance_min(message: types.Message) -> None:
     """
     Функция для получения минимальной дистанции команды bestdeal,
-    полученное значение отправляет в БД, и переходит к следующему шагу.
+    полученное значение записывает в сессию поиска, и переходит к следующему шагу.
     Функция обрабатывает полученное значение на тип.
     :param message:
     :return:
     """
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        session_expired(message.from_user.id)
+        return
     try:
-        float(message.text)
-        postgres_database.add_distance_min(
-            message.from_user.id, message.text
-        )
+        sessions.update_session(message.from_user.id, distance_min=float(message.text))
         text_message = 'Введите максимальное удаление от центра. В километрах.'
         bot.send_message(message.from_user.id, text_message)
         bot.register_next_step_handler_by_chat_id(
@@ -406,20 +459,25 @@ def get_distance_min(message: types.Message) -> None:
 
 @logger.catch
 @bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
 def get_distance_max(message: types.Message, distance_min: str) -> None:
     """
         Функция для получения минимальной дистанции команды bestdeal,
-        полученное значение отправляет в БД, и переходит к следующему шагу.
+        полученное значение записывает в сессию поиска, и переходит к следующему шагу.
         Функция обрабатывает полученное значение на тип.
         :param distance_min: Минимальная дистанция, которую пользователь ввел на прошлом шагу.
         :param message: Сообщение от пользователя.
         :return:
         """
+    session = sessions.get_session(message.from_user.id)
+    if session is None:
+        session_expired(message.from_user.id)
+        return
     try:
         if float(message.text) < float(distance_min):
             raise ValueError
 
-        postgres_database.add_distance_max(message.from_user.id, message.text)
+        sessions.update_session(message.from_user.id, distance_max=float(message.text))
         get_check_in(message)
     except ImportError:
         bot.send_message(message.from_user.id,
@@ -446,117 +504,133 @@ def get_distance_max(message: types.Message, distance_min: str) -> None:
 
 @logger.catch
 @bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
 def results_to_user(message: types.Message, user_id: int) -> None:
     """
     Функция отправки пользователю найденного результата.
-    Делает запрос в БД для получения информации по поиску,
-    потом отправляет эту информацию в функцию request'а,
-    полученный результат записывается в переменную results, проходится циклом по results
-    используя функцию send_media_result отправляет из пользователю,
-    в конце отправляет пользователю сообщение об окончании работы.
+    Берет параметры поиска из сессии, сохраняет их в БД одним запросом,
+    потом отправляет эту информацию в функцию request'а. Отели приходят генератором
+    по мере поиска, карточки из build_media_result отправляются через delivery_engine
+    сразу, не дожидаясь конца поиска, а сообщение о запросе обновляется с количеством
+    найденных отелей. Найденные отели ставятся в очередь отложенной записи истории
+    history_writer, в конце отправляет пользователю сообщение об окончании работы.
     :param message: Количество результатов для показа пользователя
     :param user_id: ID пользователя
     :return:
     """
+    session = sessions.get_session(user_id)
+    if session is None:
+        session_expired(user_id)
+        return
     try:
-        bot.send_message(user_id, 'Делаю запрос. Это может занять несколько минут.')
-        query = postgres_database.get_full_info(user_id)
-        sortorder: str = query[3]
-        results = None
+        hotels_number = min(int(message.text), 10)
+        if hotels_number < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        bot.send_message(user_id, 'Количество отелей должно быть целым числом от 1 до 10.\n'
+                                  'Давайте попробуем еще раз.')
+        bot.register_next_step_handler_by_chat_id(user_id, results_to_user, user_id=user_id)
+        return
 
-        if int(message.text) > 10:
-            hotels_number = 10
-        else:
-            hotels_number = int(message.text)
+    found = []
+    try:
+        status = bot.send_message(user_id, 'Делаю запрос. Это может занять несколько минут.')
+        query = session.query()
+        postgres_database.save_search(user_id, query)
+        sortorder: str = query[3]
+        hotels = ()
 
         if sortorder == "DISTANCE_FROM_LANDMARK":
-            results = bestdeal.best_deal_request(user_id, hotels_number, query)
+            hotels = bestdeal.iter_best_deal(user_id, hotels_number, query)
         elif sortorder in ('PRICE_HIGHEST_FIRST', 'PRICE'):
-            results = api_requests.get_properties_list(user_id, hotels_number, query)
+            hotels = api_requests.get_properties_list(user_id, hotels_number, query) or ()
 
-        date_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        history_data = json.dumps(results)
-        postgres_database.add_history(user_id, sortorder, date_time, history_data)
-        for result in results:
-            send_media_result(user_id, result)
+        def hotel_cards():
+            for result in hotels:
+                found.append(result)
+                yield build_media_result(result)
+
+        delivery_engine.deliver(user_id, hotel_cards(), on_sent=lambda sent: update_status(
+            status, 'Ищу отели. Найдено: {sent} из {total}...'.format(sent=sent, total=hotels_number)))
+        update_status(status, 'Поиск завершен. Найдено отелей: {}.'.format(len(found)))
 
-    except TypeError:
-        bot.send_message(user_id, "Похоже я ничего не нашел по вашему запросу.")
+        date_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        history_data = json.dumps([hotel.as_dict() for hotel in found] or None)
+        history_writer.add(user_id, sortorder, date_time, history_data)
+
+    except api_scheduler.QuotaExceeded:
+        logger.warning('{id} - results_to_user - api quota exceeded'.format(id=user_id))
+        bot.send_message(user_id, "Лимит запросов к сервису отелей исчерпан. Попробуйте позже.")
+    except requests.exceptions.Timeout:
+        logger.warning('{id} - results_to_user - api timeout'.format(id=user_id))
+        bot.send_message(user_id, "Превышено максимальное ожидание от сервера. Попробуйте чуть позже")
+    except requests.exceptions.RequestException as ex:
+        logger.warning('{id} - results_to_user - {ex!r}'.format(id=user_id, ex=ex))
+        bot.send_message(user_id, "Сервер отелей не отвечает. Попробуйте чуть позже")
     else:
+        if not found:
+            bot.send_message(user_id, "Похоже я ничего не нашел по вашему запросу.")
+            return
+        sessions.end_session(user_id)
         bot.send_message(user_id, "Это всё что я смог найти для Вас.")
-        logger.info(str(message.from_user.id), ' - results_to_user - ok\nSession Complete')
+        logger.info('{id} - results_to_user - ok\nSession Complete'.format(id=user_id))
+
+
+def update_status(status: types.Message, text: str) -> None:
+    """
+    Функция обновления сообщения о ходе поиска. Ошибка редактирования
+    не прерывает поиск, сообщение просто остается прежним.
+    :param status: Сообщение, которое редактируется.
+    :param text: Новый текст.
+    :return:
+    """
+    try:
+        delivery_engine.call(status.chat.id, bot.edit_message_text, text,
+                             status.chat.id, status.message_id)
+    except telebot.apihelper.ApiTelegramException as ex:
+        logger.warning('{id} - update_status - {ex}'.format(id=status.chat.id, ex=ex))
 
 
 @logger.catch
 def send_media_result(user_id, result):
     """
-    Функция для отправки результатов пользователю, обрабатывает исключение KeyError.
+    Функция для отправки одного результата пользователю.
     :param user_id: ID пользователя
-    :param result: Объект с отелями
+    :param result: Отель hotels.Hotel
     """
-    try:
-        image = result['optimizedThumbUrls']['srpDesktop']
-        hotel_id = result['id']
-        hotel_name = result['name']
-        star_rating = result['starRating']
-        address = result['address']['streetAddress']
-        price = result['ratePlan']['price']['current']
-        total_price = re.sub(
-            r'&nbsp;', ' ', result['ratePlan']['price']['fullyBundledPricePerStay']
-        )
-
-        message_text = f'Hotel ID: {hotel_id}\n' \
-                       f'Name: {hotel_name}\n' \
-                       f'Start rating: {star_rating}\n' \
-                       f'Address: {address}\n' \
-                       f'Price: {price} ' \
-                       f'Total price: {total_price}'
-        keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
+    delivery_engine.send_card(user_id, build_media_result(result))
 
-        url = 'https://hotels.com/ho{id}'.format(id=result['id'])
-        url_button = telebot.types.InlineKeyboardButton(text="Перейти на Hotels.com", url=url)
 
-        inline_button_1 = telebot.types.InlineKeyboardButton(
-            text='Хочу фотографии!', callback_data='q{hotel_id}'.format(hotel_id=result['id'])
-        )
-        keyboard.add(inline_button_1, url_button)
-        bot.send_photo(
-            user_id, image, caption=message_text, parse_mode='HTML', reply_markup=keyboard
-        )
-    except KeyError:
-        logger.error(result['id'])
-        logger.error(traceback.format_exc())
+def build_media_result(result: Hotel) -> dict:
+    """
+    Функция подготовки карточки отеля для отправки.
+    Заодно запускает фоновую предзагрузку фотографий показанного отеля.
+    :param result: Отель hotels.Hotel
+    :return: Словарь карточки для delivery_engine
+    """
+    api_requests.prefetch_photos([result.id])
+    return cards.hotel_card(result)
 
 
 @logger.catch
 @bot.message_handler(content_types=['text'])
+@metrics.HANDLERS.timed
 def get_photo_number(message: types.Message, hotel_id: str) -> None:
     """
     Функция для отправки фотографий по определенному отелю пользователю,
     делает запрос в api_requests
-    результат записывается в json_data, циклом проходит по json_data и
-    отправляет полученный результат пользователю.
+    результат записывается в json_data, выбранные фотографии отправляются
+    пользователю через delivery_engine (уже отправлявшиеся - по file_id).
     :param message:
     :param hotel_id:
     :return:
     """
     try:
-        to_send_message = []
         json_data = api_requests.get_photo(hotel_id)
-        sub_pattern = r'{size}.jpg'
-        for _ in range(int(message.text)):
-            random_photo = random.randint(0, len(json_data['hotelImages']) - 1)
-            suffix = '{}.jpg'.format(json_data['hotelImages'][random_photo]['sizes'][0]['suffix'])
-            img_url = re.sub(sub_pattern, suffix, json_data['hotelImages'][random_photo]['baseUrl'])
-            to_send_message.append(types.InputMediaPhoto(img_url))
-
-        bot.send_media_group(message.from_user.id, to_send_message)
-        keyboard = telebot.types.InlineKeyboardMarkup(row_width=1)
-        inline_button_1 = telebot.types.InlineKeyboardButton(
-            text='Еще фотографий!', callback_data='q{hotel_id}'.format(hotel_id=hotel_id))
-        keyboard.add(inline_button_1)
+        delivery_engine.send_photos(message.from_user.id,
+                                    cards.photo_urls(json_data, int(message.text)))
         bot.send_message(message.from_user.id, 'Hotel Id: {hotel_id}'.format(hotel_id=hotel_id),
-                         reply_markup=keyboard)
+                         reply_markup=cards.more_photos_keyboard(hotel_id))
     except BaseException:
         logger.error(traceback.format_exc())
     else:
@@ -564,22 +638,74 @@ def get_photo_number(message: types.Message, hotel_id: str) -> None:
 
 
 @logger.catch
-def request_mistake(user_id: str) -> None:
+def session_expired(user_id: int) -> None:
     """
-    Функция для отправки сообщения, если по запросу ничего не найдено.
+    Функция для отправки сообщения, если сессия поиска устарела или не начиналась.
     :param user_id: ID пользователя.
     :return:
     """
-    bot.send_message(user_id, 'К сожалению по вашему запросу ничего не найдено.')
+    bot.send_message(user_id, 'Поиск устарел, начните заново с команды\n'
+                              r'/lowprice''\n'r'/highprice''\n'r'/bestdeal')
+
+
+def run_worker(updates) -> None:
+    """
+    Функция процесса-обработчика многопроцессного режима: модуль main
+    импортируется в процессе заново, обновления приходят от супервизора.
+    :param updates: Очередь обновлений от супервизора.
+    :return:
+    """
+    startup.timer.mark('imports')
+    metrics.start_server()
+    startup.timer.mark('metrics')
+    # диалоги загружаются по одному при первом обновлении чата в этом процессе:
+    # процесс получает только закрепленные за ним чаты
+    namespace = globals()
+    startup.timer.report('ready')
+    startup.timer.watch(bot)
+    try:
+        supervisor.serve_worker(
+            bot, updates,
+            on_chat=lambda chat_id: conversations.store.ensure_loaded(chat_id, namespace))
+    finally:
+        shutdown()
+
+
+def shutdown() -> None:
+    """
+    Функция штатной остановки бота: записывает в БД историю из очереди history_writer
+    и изменившиеся диалоги. atexit при SIGTERM не выполняется, поэтому функция
+    вызывается явно после остановки получения обновлений.
+    :return:
+    """
+    history_writer.stop()
+    conversations.store.flush()
+    logger.info('Bot stopped')
 
 
 if __name__ == '__main__':
-    while True:
+    startup.timer.mark('imports')
+    logger.info("Start main.py")
+    postgres_database.migrate()
+    startup.timer.mark('migrations')
+    metrics.start_server()
+    startup.timer.mark('metrics')
+    bot_workers = config('bot_workers', default=1, cast=int)
+    if bot_workers > 1:
+        startup.timer.report('ready')
+        supervisor.run(bot, run_worker, bot_workers)
+    else:
+        conversations.store.restore(globals())
+        startup.timer.mark('conversations')
+        startup.timer.report('ready')
+        startup.timer.watch(bot)
+        webhook.stop_on_sigterm()
         try:
-            logger.info("Start main.py")
-            postgres_database.add_tables()
-            bot.polling(none_stop=True, interval=5)
-        except requests.exceptions.ReadTimeout as ex:
-            logger.error(traceback.format_exc())
-            logger.error(ex)
-            time.sleep(1200)
+            if config('bot_mode', default='polling') == 'webhook':
+                webhook.run_webhook(bot)
+            else:
+                webhook.run_polling(bot)
+        except KeyboardInterrupt:
+            logger.info('Bot stopping')
+        finally:
+            shutdown()